@@ -0,0 +1,126 @@
+import io
+import os
+import random
+import tempfile
+import zipfile
+from typing import Dict, List
+from xml.sax.saxutils import escape
+
+# Deterministic study notes of a given number of pages, written as TXT, PDF and DOCX without any extra dependency.
+# PDFs have real text layers (one content stream per page), so extraction cost is comparable to lecture slides.
+
+WORDS_PER_PAGE = 400
+LINE_CHARS = 90
+FORMATS = ("txt", "pdf", "docx")
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "memora-bench-corpora")
+
+TOPICS = ["photosynthesis", "mitochondria", "enzymes", "osmosis", "ribosomes", "glycolysis", "meiosis", "homeostasis",
+          "transcription", "translation", "chloroplasts", "diffusion", "hormones", "neurons", "antibodies", "alleles"]
+VERBS = ["regulates", "depends on", "produces", "converts", "inhibits", "transports", "signals", "catalyses"]
+NOUNS = ["glucose", "ATP", "proteins", "membranes", "ions", "DNA", "RNA", "water", "oxygen", "carbon dioxide", "lipids", "cells"]
+QUALIFIERS = ["in most tissues", "under stress", "during rest", "at high temperature", "in plant cells", "in the liver",
+              "when energy is low", "after a meal", "in the presence of light", "through active transport"]
+
+def page_text(page: int, seed: int = 0) -> str:
+    rng = random.Random(seed * 1_000_003 + page)
+    heading = f"Lecture {page // 10 + 1}, page {page + 1}: {rng.choice(TOPICS).title()}"
+    words = heading.split()
+    sentences = [heading + "."]
+    while len(words) < WORDS_PER_PAGE:
+        sentence = f"{rng.choice(TOPICS).capitalize()} {rng.choice(VERBS)} {rng.choice(NOUNS)} {rng.choice(QUALIFIERS)}"
+        if rng.random() < 0.3:
+            sentence += f", which is why {rng.choice(TOPICS)} {rng.choice(VERBS)} {rng.choice(NOUNS)}"
+        sentences.append(sentence + ".")
+        words += sentence.split()
+    return " ".join(sentences)
+
+def pages(n: int, seed: int = 0) -> List[str]:
+    return [page_text(i, seed) for i in range(n)]
+
+def wrap(text: str, width: int = LINE_CHARS) -> List[str]:
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    return lines + ([line] if line else [])
+
+def to_txt(texts: List[str]) -> bytes:
+    return "\n\n".join(texts).encode("utf-8")
+
+def to_pdf(texts: List[str]) -> bytes:
+    # Objects: 1 catalog, 2 page tree, 3 font, then a page and its content stream for every page
+    def literal(line: str) -> str:
+        return "(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+    objects: Dict[int, bytes] = {}
+    kids = []
+    for i, text in enumerate(texts):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        kids.append(f"{page_id} 0 R")
+        stream = "BT /F1 10 Tf 13 TL 50 790 Td\n" + "\n".join(f"{literal(line)} '" for line in wrap(text)) + "\nET"
+        data = stream.encode("latin-1")
+        objects[content_id] = b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content_id} 0 R "
+                            f"/Resources << /Font << /F1 3 0 R >> >> >>").encode("ascii")
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(texts)} >>".encode("ascii")
+    objects[3] = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = out.tell()
+        out.write(b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for number in sorted(objects):
+        out.write(b"%010d 00000 n \n" % offsets[number])
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+_DOCX_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>"""
+_DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/></Relationships>"""
+
+def to_docx(texts: List[str]) -> bytes:
+    body = []
+    for i, text in enumerate(texts):
+        if i:
+            body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        body.append(f"<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>")
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+                + "".join(body) + "</w:body></w:document>")
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", _DOCX_TYPES)
+        docx.writestr("_rels/.rels", _DOCX_RELS)
+        docx.writestr("word/document.xml", document)
+    return out.getvalue()
+
+WRITERS = {"txt": to_txt, "pdf": to_pdf, "docx": to_docx}
+
+def corpus(n: int, fmt: str, cache_dir: str = CACHE_DIR) -> bytes:
+    # Generated once per size and format, then read back from the cache directory
+    path = os.path.join(cache_dir, f"notes-{n}p.{fmt}")
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return f.read()
+    data = WRITERS[fmt](pages(n))
+    os.makedirs(cache_dir, exist_ok = True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return data
+
+def flashcard_bank(cards: int, seed: int = 0) -> str:
+    # Generator output: "Q: ...\nA: ..." pairs separated by blank lines
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(cards):
+        topic, verb, noun = rng.choice(TOPICS), rng.choice(VERBS), rng.choice(NOUNS)
+        pairs.append(f"Q: What does {topic} do to {noun} (card {i})?\nA: {topic.capitalize()} {verb} {noun} {rng.choice(QUALIFIERS)}.")
+    return "\n\n".join(pairs)
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import openai
+from stubs import StubModel
+
+# Several "UI workers" (threads standing in for Streamlit processes) index files, run generation jobs and ask
+# questions against either one shared engine over HTTP or one in-process engine each, all backed by the stub model.
+
+TOPICS = ["photosynthesis", "mitochondria", "enzymes", "osmosis", "ribosomes", "glycolysis", "meiosis", "homeostasis"]
+
+def synthetic_file(n: int, sentences: int = 120) -> bytes:
+    lines = [f"Note {n}.{i}: {TOPICS[(n + i) % len(TOPICS)]} relates to {TOPICS[(n * 3 + i) % len(TOPICS)]} through process {i}."
+             for i in range(sentences)]
+    return " ".join(lines).encode("utf-8")
+
+def synthetic_chunks(n: int, size: int = 400) -> List[str]:
+    return [f"Section {i}: " + " ".join(TOPICS[(i + j) % len(TOPICS)] for j in range(size // 10)) for i in range(n)]
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def start_server(**engine_kwargs) -> str:
+    import src.engine_server as es
+    loop = asyncio.new_event_loop()
+    threading.Thread(target = loop.run_forever, name = "engine-server", daemon = True).start()
+    async def setup():
+        runner = await es.serve("127.0.0.1", 0, **engine_kwargs)
+        return runner.addresses[0][1]
+    port = asyncio.run_coroutine_threadsafe(setup(), loop).result()
+    return f"http://127.0.0.1:{port}"
+
+def run_worker(client, worker: int, args) -> Dict[str, List[float]]:
+    files = {f"notes_{n}.txt": synthetic_file(n) for n in range(args.files)}
+    timings = {"index": [], "job": [], "ask": [], "failed_jobs": 0}
+    start = time.perf_counter()
+    shards = client.index(files)
+    timings["index"].append(time.perf_counter() - start)
+    jobs = []
+    for j in range(args.jobs):
+        chunks = synthetic_chunks(args.chunks)
+        jobs.append((time.perf_counter(), client.submit("flashcards", chunks, f"Worker {worker} deck {j}")))
+    for i in range(args.asks):
+        start = time.perf_counter()
+        # Half of the questions repeat across workers, so a shared engine can answer them from its cache
+        question = f"How does {TOPICS[i % len(TOPICS)]} work?" if i % 2 else f"Worker {worker}: what is {TOPICS[i % len(TOPICS)]}?"
+        client.ask(question, shards)
+        timings["ask"].append(time.perf_counter() - start)
+    for submitted, job in jobs:
+        while job["state"] in ("queued", "running"):
+            time.sleep(0.05)
+            job = client.job(job["id"])
+        timings["job"].append(time.perf_counter() - submitted)
+        timings["failed_jobs"] += job["state"] != "done"
+    return timings
+
+def run_mode(mode: str, stub: StubModel, args) -> Dict:
+    import src.engine as en
+    import src.engine_server as es
+    import src.resources as rs
+    stub.reset()
+    engine_kwargs = {"concurrency": args.concurrency, "rpm": args.rpm, "tpm": args.tpm}
+    if mode == "shared":
+        url = start_server(root = tempfile.mkdtemp(prefix = "memora-load-"), **engine_kwargs)
+        clients = [es.HTTPClient(url) for _ in range(args.workers)]
+    else:
+        # Nothing shared but the process-wide LLM scheduler, as with one engine per Streamlit page
+        clients = [en.LocalClient(root = tempfile.mkdtemp(prefix = "memora-load-"), resources = rs.ResourceManager(), **engine_kwargs)
+                   for _ in range(args.workers)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = args.workers) as pool:
+        results = list(pool.map(lambda w: run_worker(clients[w], w, args), range(args.workers)))
+    elapsed = time.perf_counter() - start
+    merged = {key: [v for r in results for v in r[key]] for key in ("index", "job", "ask")}
+    report = {
+        "mode": mode, "workers": args.workers, "seconds": round(elapsed, 2),
+        "jobs": len(merged["job"]), "failed_jobs": sum(r["failed_jobs"] for r in results),
+        "job_p50_s": round(percentile(merged["job"], 0.5), 2), "job_p95_s": round(percentile(merged["job"], 0.95), 2),
+        "ask_p50_s": round(percentile(merged["ask"], 0.5), 3), "ask_p95_s": round(percentile(merged["ask"], 0.95), 3),
+        "index_mean_s": round(statistics.mean(merged["index"]), 2),
+        "chunks_per_s": round(len(merged["job"]) * args.chunks / elapsed, 1),
+        "stub": stub.stats(),
+    }
+    if mode == "shared":
+        report["answer_cache"] = clients[0].stats()["answer_cache"]
+    return report
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description = "Load test of the Memora engine against a local stub model.")
+    parser.add_argument("--mode", choices = ["shared", "separate", "both"], default = "both",
+                        help = "one engine over HTTP for every worker, one in-process engine per worker, or both (default: %(default)s)")
+    parser.add_argument("--workers", type = int, default = 4, help = "simulated UI processes (default: %(default)s)")
+    parser.add_argument("--jobs", type = int, default = 2, help = "generation jobs per worker (default: %(default)s)")
+    parser.add_argument("--chunks", type = int, default = 12, help = "chunks per job (default: %(default)s)")
+    parser.add_argument("--asks", type = int, default = 6, help = "questions per worker (default: %(default)s)")
+    parser.add_argument("--files", type = int, default = 2, help = "synthetic files indexed by every worker (default: %(default)s)")
+    parser.add_argument("--latency", type = float, default = 0.2, help = "stub model latency in seconds (default: %(default)s)")
+    parser.add_argument("--concurrency", type = int, default = 8, help = "engine LLM calls in flight (default: %(default)s)")
+    parser.add_argument("--rpm", type = int, default = 1200, help = "engine requests per minute (default: %(default)s)")
+    parser.add_argument("--tpm", type = int, default = 10**7, help = "engine tokens per minute (default: %(default)s)")
+    parser.add_argument("--json", action = "store_true", help = "print the reports as JSON")
+    args = parser.parse_args(argv)
+    stub = StubModel(latency = args.latency)
+    openai.api_base = stub.start()
+    openai.api_key = os.environ["OPENAI_API_KEY"] = "stub"
+    modes = ["shared", "separate"] if args.mode == "both" else [args.mode]
+    reports = [run_mode(mode, stub, args) for mode in modes]
+    stub.stop()
+    if args.json:
+        print(json.dumps(reports, indent = 2))
+        return
+    for report in reports:
+        stub_stats = report.pop("stub")
+        print(f"[{report.pop('mode')}] " + ", ".join(f"{k}={v}" for k, v in report.items()))
+        # Every engine in a process shares its LLM scheduler, so both modes stay under --concurrency and --rpm
+        print(f"    stub: max chat calls in flight {stub_stats['max_in_flight'].get('chat', 0)} (limit {args.concurrency}), {stub_stats['requests_per_minute']} chat requests/min "
+              f"(limit {args.rpm}), requests {stub_stats['requests']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import openai
+from stubs import StubModel
+
+# Connections opened and request latency for OpenAI calls against the local stub, with the openai client's own
+# sessions (one requests.Session per thread, one aiohttp session per async call) and with the shared pool.
+# Sync calls run as a series of short-lived threads, like Streamlit reruns; async calls run as one gen_concurrent-style burst.
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def sync_calls(args) -> List[float]:
+    timings = []
+    def rerun(n):
+        for i in range(args.calls):
+            start = time.perf_counter()
+            openai.Embedding.create(input = [f"rerun {n} text {i}"], model = "text-embedding-ada-002")
+            timings.append(time.perf_counter() - start)
+    for batch in range(0, args.reruns, args.threads):
+        threads = [threading.Thread(target = rerun, args = (n,)) for n in range(batch, min(args.reruns, batch + args.threads))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return timings
+
+async def async_calls(args, pool = None) -> List[float]:
+    if pool is not None:
+        pool.use_async()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timings = []
+    async def call(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await openai.ChatCompletion.acreate(model = "gpt-3.5-turbo", messages = [{"role": "user", "content": f"chunk {i}"}])
+            timings.append(time.perf_counter() - start)
+    try:
+        await asyncio.gather(*(call(i) for i in range(args.chunks)))
+    finally:
+        if pool is not None:
+            await pool.aclose()
+    return timings
+
+def run_mode(mode: str, stub: StubModel, args) -> Dict:
+    import src.http_pool as hp
+    pool = hp.HTTPPool(per_host = args.per_host) if mode == "pooled" else None
+    openai.requestssession = pool.session() if pool is not None else None
+    report = {"mode": mode}
+    stub.reset()
+    start = time.perf_counter()
+    timings = sync_calls(args)
+    report["sync"] = {"requests": len(timings), "connections": stub.stats()["connections"], "seconds": round(time.perf_counter() - start, 2),
+                      "p50_ms": round(1000 * percentile(timings, 0.5), 1), "p95_ms": round(1000 * percentile(timings, 0.95), 1)}
+    stub.reset()
+    start = time.perf_counter()
+    timings = asyncio.run(async_calls(args, pool))
+    report["async"] = {"requests": len(timings), "connections": stub.stats()["connections"], "seconds": round(time.perf_counter() - start, 2),
+                       "p50_ms": round(1000 * percentile(timings, 0.5), 1), "p95_ms": round(1000 * percentile(timings, 0.95), 1)}
+    if pool is not None:
+        report["pool"] = pool.stats()
+        pool.session().close()
+    openai.requestssession = None
+    return report
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description = "Connection reuse of OpenAI calls with and without the shared HTTP pool, against a local stub model.")
+    parser.add_argument("--mode", choices = ["default", "pooled", "both"], default = "both")
+    parser.add_argument("--reruns", type = int, default = 40, help = "short-lived threads making sync calls (default: %(default)s)")
+    parser.add_argument("--threads", type = int, default = 4, help = "reruns running at once (default: %(default)s)")
+    parser.add_argument("--calls", type = int, default = 5, help = "sync embedding calls per rerun (default: %(default)s)")
+    parser.add_argument("--chunks", type = int, default = 200, help = "async chat calls in the burst (default: %(default)s)")
+    parser.add_argument("--concurrency", type = int, default = 10, help = "async calls in flight (default: %(default)s)")
+    parser.add_argument("--per-host", type = int, default = 20, help = "pool connections per host (default: %(default)s)")
+    parser.add_argument("--latency", type = float, default = 0.02, help = "stub model latency in seconds (default: %(default)s)")
+    parser.add_argument("--json", action = "store_true", help = "print the reports as JSON")
+    args = parser.parse_args(argv)
+    stub = StubModel(latency = args.latency, jitter = 0.0)
+    openai.api_base = stub.start()
+    openai.api_key = "stub"
+    modes = ["default", "pooled"] if args.mode == "both" else [args.mode]
+    reports = [run_mode(mode, stub, args) for mode in modes]
+    stub.stop()
+    if args.json:
+        print(json.dumps(reports, indent = 2))
+        return
+    for report in reports:
+        for kind in ("sync", "async"):
+            print(f"[{report['mode']} {kind}] " + ", ".join(f"{k}={v}" for k, v in report[kind].items()))
+        if "pool" in report:
+            print(f"    pool: sync reuse {report['pool']['sync']['reuse_rate']:.0%}, async reuse {report['pool']['async']['reuse_rate']:.0%}, "
+                  f"async max in flight {report['pool']['async']['max_in_flight']} (per-host limit {report['pool']['per_host_limit']})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import ast
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PAGES = [os.path.join(ROOT, "📖_Study_Assistant.py")] + sorted(glob.glob(os.path.join(ROOT, "pages", "*.py")))
+HEAVY_MODULES = ("langchain", "streamlit", "faiss", "tiktoken", "pypdf", "docx2txt", "gtts", "PIL")
+LOGO = os.path.join(ROOT, "static", "logo_2.png")
+
+# Runs in a fresh interpreter: executes a page's top-level imports (and lazy_import assignments), nothing else
+_PROBE = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+source = {source!r}
+start = time.perf_counter()
+exec(compile(source, "imports", "exec"), {{}})
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules and type(sys.modules[m]).__name__ != "_LazyModule"]
+print(json.dumps({{"seconds": elapsed, "loaded": heavy}}))
+"""
+
+def import_source(page: str) -> str:
+    with open(os.path.join(ROOT, page), "r", encoding = "utf-8") as f:
+        tree = ast.parse(f.read())
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            nodes.append(node)
+        elif (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)
+              and isinstance(node.value.func, ast.Attribute) and node.value.func.attr == "lazy_import"):
+            nodes.append(node)
+    return ast.unparse(ast.Module(body = nodes, type_ignores = []))
+
+def cold_import(page: str, runs: int) -> Dict:
+    probe = _PROBE.format(root = ROOT, source = import_source(page), heavy = HEAVY_MODULES)
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", probe], cwd = ROOT, capture_output = True, text = True, check = True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {"page": os.path.basename(page), "seconds": statistics.median(r["seconds"] for r in results), "loaded": results[-1]["loaded"]}
+
+def per_call(fn: Callable, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls
+
+def rerun_costs(calls: int) -> List[Dict]:
+    # What a widget interaction pays for the per-rerun setup of each page, uncached vs process-wide cached
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    from PIL import Image
+    import src.processing as pr
+    import src.el_professor as ep
+    import src.lazy as lz
+    key = "sk-benchmark"
+    cases = [
+        ("LLM clients", lambda: pr.initialise_llms_with_key.__wrapped__(key), lambda: pr.initialise_llms_with_key(key)),
+        ("embedder", lambda: ep.embed_type_chooser.__wrapped__("o", key), lambda: ep.embed_type_chooser("o", key)),
+        ("QA prompt", ep._make_prompt_assist.__wrapped__, ep._make_prompt_assist),
+        ("logo", lambda: Image.open(LOGO).load(), lambda: lz.static_image(LOGO)),
+    ]
+    rows = []
+    for name, uncached, cached in cases:
+        cached()
+        rows.append({"setup": name, "uncached_ms": 1000 * per_call(uncached, calls), "cached_ms": 1000 * per_call(cached, calls)})
+    return rows
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description = "Cold import time of each Streamlit page and per-rerun setup cost.")
+    parser.add_argument("--runs", type = int, default = 3, help = "fresh interpreters per page, the median is reported (default: %(default)s)")
+    parser.add_argument("--calls", type = int, default = 50, help = "calls per rerun-cost measurement (default: %(default)s)")
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    args = parser.parse_args(argv)
+    imports = [cold_import(page, args.runs) for page in PAGES]
+    reruns = rerun_costs(args.calls)
+    if args.json:
+        print(json.dumps({"imports": imports, "reruns": reruns}, indent = 2))
+        return
+    print(f"{'page':<45} {'import s':>9}  modules loaded")
+    for row in imports:
+        print(f"{row['page']:<45} {row['seconds']:>9.3f}  {', '.join(row['loaded'])}")
+    print()
+    print(f"{'per-rerun setup':<45} {'uncached ms':>12} {'cached ms':>10}")
+    for row in reruns:
+        print(f"{row['setup']:<45} {row['uncached_ms']:>12.3f} {row['cached_ms']:>10.4f}")
+
+if __name__ == "__main__":
+    main()
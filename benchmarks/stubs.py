@@ -0,0 +1,162 @@
+import asyncio
+import base64
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List
+import numpy as np
+from aiohttp import web
+
+# OpenAI-compatible stand-in for load tests: chat completions and embeddings on localhost with a fixed latency.
+# Point the openai client at it with `openai.api_base = stub.url` and no real API calls are made.
+
+STUB_DIM = 1536
+
+def _digest(value: Any) -> bytes:
+    return hashlib.md5(repr(value).encode("utf-8")).digest()
+
+def stub_vector(value: Any, dim: int = STUB_DIM) -> np.ndarray:
+    rng = np.random.default_rng(int.from_bytes(_digest(value)[:8], "little"))
+    vector = rng.standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+def stub_reply(prompt: str, cards: int = 3) -> str:
+    tag = _digest(prompt).hex()[:6]
+    return "\n".join(f"Q: What does point {i + 1} of section {tag} state? A: Point {i + 1} of section {tag} states a stub fact." for i in range(cards))
+
+class StubEncoding:
+    # Offline stand-in for tiktoken's cl100k_base: words, punctuation and whitespace runs as tokens, each with its leading
+    # space like BPE. Counts are in the same range as the real encoding; ids are assigned in order of first appearance.
+    name = "stub"
+    _PIECE = re.compile(r"\s?\w+|\s?[^\w\s]|\s+")
+
+    def __init__(self):
+        self._ids: Dict[bytes, int] = {}
+        self._pieces: List[bytes] = []
+
+    def _id(self, piece: bytes) -> int:
+        token = self._ids.get(piece)
+        if token is None:
+            token = self._ids[piece] = len(self._pieces)
+            self._pieces.append(piece)
+        return token
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return [self._id(match.group().encode("utf-8")) for match in self._PIECE.finditer(text)]
+
+    def decode_tokens_bytes(self, tokens: List[int]) -> List[bytes]:
+        return [self._pieces[token] for token in tokens]
+
+    def decode(self, tokens: List[int]) -> str:
+        return b"".join(self.decode_tokens_bytes(tokens)).decode("utf-8", errors = "replace")
+
+def install_stub_encoding():
+    # Every tiktoken.get_encoding() call in this process gets the one StubEncoding
+    import tiktoken
+    encoding = StubEncoding()
+    tiktoken.get_encoding = lambda name: encoding
+    tiktoken.encoding_for_model = lambda name: encoding
+
+class StubModel:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.05, dim: int = STUB_DIM, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.dim = dim
+        self._random = random.Random(seed)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+        self.reset()
+
+    def reset(self):
+        self.requests: Dict[str, int] = {}
+        self.starts: List[float] = []
+        self.in_flight: Dict[str, int] = {}
+        self.max_in_flight: Dict[str, int] = {}
+        # Client addresses seen, one per TCP connection the clients opened
+        self.connections: set = set()
+
+    async def _respond(self, kind: str, make_body):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        if kind == "chat":
+            self.starts.append(time.monotonic())
+        self.in_flight[kind] = self.in_flight.get(kind, 0) + 1
+        self.max_in_flight[kind] = max(self.max_in_flight.get(kind, 0), self.in_flight[kind])
+        try:
+            await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+            return web.json_response(make_body())
+        finally:
+            self.in_flight[kind] -= 1
+
+    async def _chat(self, request):
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        reply = stub_reply(prompt)
+        return await self._respond("chat", lambda: {
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(reply) // 4, "total_tokens": (len(prompt) + len(reply)) // 4},
+        })
+
+    async def _embeddings(self, request):
+        body = await request.json()
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        as_base64 = body.get("encoding_format") == "base64"
+        def make_body():
+            data = []
+            for i, item in enumerate(inputs):
+                vector = stub_vector(item, self.dim)
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii") if as_base64 else vector.tolist()
+                data.append({"object": "embedding", "index": i, "embedding": embedding})
+            return {"object": "list", "data": data, "model": body.get("model", "stub"), "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+        return await self._respond("embeddings", make_body)
+
+    @web.middleware
+    async def _count_connections(self, request, handler):
+        self.connections.add(request.transport.get_extra_info("peername") if request.transport else None)
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares = [self._count_connections], client_max_size = 200 * 2**20)
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/engines/{engine}/chat/completions", self._chat)
+        app.router.add_post("/v1/embeddings", self._embeddings)
+        app.router.add_post("/v1/engines/{engine}/embeddings", self._embeddings)
+        return app
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        # Serves from a background thread; returns the base URL for openai.api_base
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target = self._loop.run_forever, name = "stub-model", daemon = True).start()
+        async def setup():
+            self._runner = web.AppRunner(self.app())
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, host, port)
+            await site.start()
+            return self._runner.addresses[0][1]
+        bound = asyncio.run_coroutine_threadsafe(setup(), self._loop).result()
+        self.url = f"http://{host}:{bound}/v1"
+        return self.url
+
+    def stop(self):
+        if self._runner is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._runner = None
+
+    def stats(self) -> Dict[str, Any]:
+        # Rates count chat requests, the ones the LLM scheduler governs
+        starts = sorted(self.starts)
+        peak = 0
+        j = 0
+        for i, start in enumerate(starts):
+            while starts[j] < start - 60:
+                j += 1
+            peak = max(peak, i - j + 1)
+        span = starts[-1] - starts[0] if len(starts) > 1 else 0.0
+        return {"requests": dict(self.requests), "max_in_flight": dict(self.max_in_flight), "connections": len(self.connections),
+                "requests_per_minute": round(60 * (len(starts) - 1) / span, 1) if span else 0.0, "peak_per_60s": peak}
@@ -0,0 +1,300 @@
+import argparse
+import ast
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import corpora
+from stubs import StubModel, install_stub_encoding, stub_vector
+
+# Offline benchmark of the pipeline stages on generated notes of 10, 100 and 1000 pages. Every stage is timed
+# (median of --repeat runs) and its peak Python heap measured in a separate run under tracemalloc, then compared
+# with the stored baseline. A stage that regresses beyond the tolerances makes the run exit with status 1.
+# Chunking needs tiktoken's cl100k_base files cached locally (run anything that chunks text once while online);
+# --stub-encoder runs without them on a deterministic stand-in, whose results are only compared with a baseline recorded the same way.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = (10, 100, 1000)
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.25
+# Below these a difference is noise, whatever the ratio
+MIN_SECONDS = 0.01
+MIN_MB = 1.0
+QUESTIONS = 20
+CARDS_PER_PAGE = 5
+GENERATION_CHUNKS = 60
+
+def page_function(page: str, name: str) -> Callable:
+    # Loads a function defined in a Streamlit page without running the page (decorators such as st.cache_data dropped)
+    with open(os.path.join(ROOT, page), "r", encoding = "utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            node.decorator_list = []
+            namespace: Dict[str, Any] = {}
+            exec(compile(ast.Module(body = [node], type_ignores = []), page, "exec"), namespace)
+            return namespace[name]
+    raise KeyError(f"{name} not found in {page}")
+
+class StubEmbeddings:
+    # Deterministic, offline stand-in for OpenAIEmbeddings with the same dimension
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [stub_vector(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return stub_vector(text).tolist()
+
+class Corpus:
+    # Inputs for one corpus size, built on first use and shared by the stages that need them
+    def __init__(self, pages: int):
+        self.pages = pages
+        self._cache: Dict[str, Any] = {}
+
+    def _get(self, key: str, build: Callable[[], Any]) -> Any:
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    def file(self, fmt: str) -> bytes:
+        return self._get(f"file.{fmt}", lambda: corpora.corpus(self.pages, fmt))
+
+    @property
+    def text(self) -> str:
+        import src.processing as pr
+        return self._get("text", lambda: pr.extract_text("notes.txt", self.file("txt")))
+
+    @property
+    def chunks(self) -> List[str]:
+        import src.processing as pr
+        return self._get("chunks", lambda: pr.generation_chunks(self.text))
+
+    @property
+    def index(self):
+        import src.el_professor as ep
+        import src.lexical as lx
+        def build():
+            docstore = ep.build_docstore(self.text, StubEmbeddings(), source = "notes.txt")
+            return docstore, lx.BM25Index.from_faiss(docstore)
+        return self._get("index", build)
+
+    @property
+    def bank(self) -> str:
+        return self._get("bank", lambda: corpora.flashcard_bank(self.pages * CARDS_PER_PAGE))
+
+    @property
+    def anki(self) -> str:
+        import src.generatorGPT as gen
+        return self._get("anki", lambda: gen.anki_formatter(self.bank))
+
+# ------------------------------ Stages ------------------------------ #
+# Each takes the corpus and returns the callable to measure; preparing inputs is not measured.
+
+def stage_text_process(fmt: str):
+    def prepare(corpus: Corpus):
+        import src.processing as pr
+        data = corpus.file(fmt)
+        return lambda: pr.generation_chunks(pr.extract_text(f"notes.{fmt}", data))
+    return prepare
+
+def stage_ingest(corpus: Corpus):
+    # The bounded-memory path large uploads take: page by page into an on-disk chunk store
+    import src.chunk_store as cs
+    data = corpus.file("pdf")
+    return lambda: cs.ingest([("notes.pdf", data)]).close()
+
+def stage_text_splitter(corpus: Corpus):
+    import src.processing as pr
+    text = corpus.text
+    return lambda: pr.text_splitter(text)
+
+def stage_index_build(corpus: Corpus):
+    import src.el_professor as ep
+    import src.lexical as lx
+    text = corpus.text
+    embeddings = StubEmbeddings()
+    def run():
+        docstore = ep.build_docstore(text, embeddings, source = "notes.txt")
+        return lx.BM25Index.from_faiss(docstore)
+    return run
+
+def stage_context_selection(corpus: Corpus):
+    # The retrieval half of answer_question: search, fusion, MMR, compression and the token budget
+    import src.el_professor as ep
+    docstore, lexical = corpus.index
+    questions = [f"How does {corpora.TOPICS[i % len(corpora.TOPICS)]} affect {corpora.NOUNS[i % len(corpora.NOUNS)]}?" for i in range(QUESTIONS)]
+    return lambda: [ep.retrieve_context(docstore, question, lexical = lexical) for question in questions]
+
+def stage_format_output(corpus: Corpus):
+    format_output = page_function("pages/2_📝_Flashcards_Generator.py", "format_output")
+    anki = corpus.anki
+    return lambda: format_output(anki)
+
+def stage_format_input(corpus: Corpus):
+    format_input = page_function("pages/3_❓_Test_Yourself.py", "format_input")
+    bank = corpus.bank
+    return lambda: format_input(bank)
+
+def stage_anki_formatter(corpus: Corpus):
+    import src.generatorGPT as gen
+    bank = corpus.bank
+    return lambda: gen.anki_formatter(bank)
+
+def stage_gen_concurrent(corpus: Corpus):
+    # Against the zero-latency stub server: measures our overhead (chains, HTTP, scheduling), not the model
+    import openai
+    import src.async_generator as ag
+    import src.generatorGPT as gen
+    import src.processing as pr
+    import src.scheduler as sch
+    chunks = corpus.chunks[:GENERATION_CHUNKS]
+    chat3_5, _ = pr.initialise_llms_with_key(openai.api_key)
+    # Rate ceilings off, as with the limiter below; the scheduler's own cost still counts
+    sch.default_scheduler().configure(rpm = 10**9, tpm = 10**12)
+    chain = gen.initialise_chain_no_mem(chat3_5, type = "QA")
+    async def run():
+        results, _ = await ag.gen_concurrent(chunks, chain, "Biology", semaphore = asyncio.Semaphore(ag.CONCURRENT_CALLS_LIMIT),
+                                             limiter = ag.RateLimiter(10**9))
+        import src.http_pool as hp
+        await hp.default_pool().aclose()
+        if any(result is None for result in results):
+            raise RuntimeError("stub model calls failed")
+    return lambda: asyncio.run(run())
+
+STAGES: Dict[str, Callable] = {
+    **{f"text_process.{fmt}": stage_text_process(fmt) for fmt in corpora.FORMATS},
+    "ingest.pdf": stage_ingest,
+    "text_splitter": stage_text_splitter,
+    "index_build": stage_index_build,
+    "context_selection": stage_context_selection,
+    "format_output": stage_format_output,
+    "format_input": stage_format_input,
+    "anki_formatter": stage_anki_formatter,
+    "gen_concurrent": stage_gen_concurrent,
+}
+
+# ------------------------------ Measurement ------------------------------ #
+
+def measure(run: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    # tracemalloc slows everything down, so memory gets its own run
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(statistics.median(times), 4), "peak_mb": round(peak / 2**20, 2)}
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            time_tolerance: float = TIME_TOLERANCE, memory_tolerance: float = MEMORY_TOLERANCE) -> List[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + time_tolerance) and result["seconds"] - base["seconds"] > MIN_SECONDS:
+            regressions.append(f"{key}: {result['seconds']:.3f} s vs baseline {base['seconds']:.3f} s")
+        if result["peak_mb"] > base["peak_mb"] * (1 + memory_tolerance) and result["peak_mb"] - base["peak_mb"] > MIN_MB:
+            regressions.append(f"{key}: peak {result['peak_mb']:.1f} MB vs baseline {base['peak_mb']:.1f} MB")
+    return regressions
+
+def encoding_available() -> bool:
+    try:
+        import tiktoken
+        tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return False
+    return True
+
+def load_baseline(path: str) -> Dict[str, Any]:
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description = "Offline benchmarks of the Memora pipeline, compared with a stored baseline.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = list(SIZES), help = "corpus sizes in pages (default: %(default)s)")
+    parser.add_argument("--stages", nargs = "+", choices = list(STAGES), default = list(STAGES), metavar = "STAGE",
+                        help = f"stages to run (default: all of {', '.join(STAGES)})")
+    parser.add_argument("--repeat", type = int, default = 3, help = "timed runs per stage, the median counts (default: %(default)s)")
+    parser.add_argument("--baseline", default = BASELINE, help = "baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument("--update-baseline", action = "store_true", help = "store these results as the new baseline for the stages run")
+    parser.add_argument("--time-tolerance", type = float, default = TIME_TOLERANCE, help = "allowed slowdown as a fraction (default: %(default)s)")
+    parser.add_argument("--memory-tolerance", type = float, default = MEMORY_TOLERANCE, help = "allowed peak memory growth as a fraction (default: %(default)s)")
+    parser.add_argument("--stub-encoder", action = "store_true", help = "chunk with a deterministic offline stand-in for tiktoken's cl100k_base")
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    args = parser.parse_args(argv)
+
+    encoder = "stub" if args.stub_encoder else "cl100k_base"
+    if args.stub_encoder:
+        install_stub_encoding()
+    elif not encoding_available():
+        print("The tiktoken cl100k_base encoding is not cached and could not be downloaded. Run once while online "
+              "(or set TIKTOKEN_CACHE_DIR to a cached copy), or pass --stub-encoder.", file = sys.stderr)
+        return 2
+    stored = load_baseline(args.baseline)
+    if stored and not args.update_baseline and stored.get("encoder", "cl100k_base") != encoder:
+        print(f"The baseline was recorded with the {stored.get('encoder', 'cl100k_base')} encoder, this run would use {encoder}. "
+              f"Match it{' with --stub-encoder' if stored.get('encoder') == 'stub' else ''} or record a new baseline with --update-baseline.", file = sys.stderr)
+        return 2
+
+    stub = None
+    if "gen_concurrent" in args.stages:
+        import openai
+        stub = StubModel(latency = 0.0, jitter = 0.0)
+        openai.api_base = stub.start()
+        openai.api_key = os.environ["OPENAI_API_KEY"] = "stub"
+    results: Dict[str, Dict[str, float]] = {}
+    try:
+        for pages in args.sizes:
+            corpus = Corpus(pages)
+            for stage in args.stages:
+                key = f"{stage}@{pages}"
+                results[key] = measure(STAGES[stage](corpus), args.repeat)
+                if not args.json:
+                    print(f"{key:32s} {results[key]['seconds']:9.4f} s  {results[key]['peak_mb']:9.2f} MB", file = sys.stderr)
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    baseline = stored.get("stages", {}) if stored.get("encoder", "cl100k_base") == encoder else {}
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    if args.json:
+        print(json.dumps({"results": results, "regressions": regressions}, indent = 2))
+    if args.update_baseline:
+        stored = {"machine": {"platform": platform.platform(), "python": platform.python_version(), "processor": platform.processor()},
+                  "encoder": encoder, "recorded": time.strftime("%Y-%m-%d"), "stages": {**baseline, **results}}
+        with open(args.baseline, "w") as f:
+            json.dump(stored, f, indent = 2, sort_keys = True)
+        print(f"Baseline for {len(results)} stage(s) written to {args.baseline}", file = sys.stderr)
+        return 0
+    if not baseline:
+        print(f"No baseline at {args.baseline}, record one with --update-baseline", file = sys.stderr)
+        return 0
+    missing = [key for key in results if key not in baseline]
+    if missing:
+        print(f"Not in the baseline: {', '.join(missing)}", file = sys.stderr)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file = sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,17 @@
-import io
 import time
 import streamlit as st
-import asyncio
-from pypdf import PdfReader
-import docx2txt
-from PIL import Image
-import tiktoken
-import src.processing as pr
-import src.generatorGPT as gen
-import src.async_generator as ag
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import src.engine as en
+import src.export as ex
+import src.lazy as lz
+import src.debug_panel as dp
+import src.resources as rs
+import src.chunk_store as cs
+import src.ocr as ocr
+
+tiktoken = lz.lazy_import("tiktoken")
+
+JOB_POLL_SECONDS = 0.5
 
 def clear_cache():
     st.cache_data.clear()
@@ -17,43 +20,41 @@ def clear_cache():
     if 'doc' in st.session_state:
         del st.session_state['doc']
 
-@st.cache_resource
-def cache_chain(_chat):
-    cached_chain = gen.initialise_chain_no_mem(chat = _chat) # No memory
-    # cached_chain = gen.initialise_chain(chat = _chat, llm = _llm) # With memory
-    return cached_chain
-
-@st.cache_data(ttl = 2*3600, max_entries = 5)
 def text_process(uploads):
-    text = ""
-    for doc in uploads:
-        if doc.name.endswith(".txt"):
-            stringio = io.StringIO(doc.getvalue().decode("utf-8"))
-            text += stringio.read()
-        if doc.name.endswith(".pdf"):
-            pdf_reader = PdfReader(doc)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text()
-        if doc.name.endswith(".docx"):
-            text += docx2txt.process(doc)
-    chunks = pr.text_splitter(text)
-    return chunks
-
-async def print_progress(progress_queue):
-    last_processed_chunks = 0
-    while True:
-        processed_chunks = await progress_queue.get()
-        if processed_chunks != last_processed_chunks:
-            prog_value.text(f"Step: {processed_chunks}/{size}")
-            last_processed_chunks = processed_chunks
-
-async def main_loop_async(chunks, chain, subject):
-    progress_queue = asyncio.Queue()
-    progress_task = asyncio.create_task(print_progress(progress_queue))
-    results, processed_chunks = await ag.gen_concurrent(chunks, chain , subject, progress_queue)
-    progress_task.cancel()
-    return results, processed_chunks
+    # A handle on chunks shared by every session (and page) that uploads the same files
+    # getbuffer() reads the upload in place; large uploads are chunked into a store on disk
+    files = [(doc.name, doc.getbuffer()) for doc in uploads]
+    key = rs.content_key("chunks", *(part for file in files for part in file))
+    return rs.default_manager().acquire(key, lambda: cs.load_chunks(files))
+
+def token_cost(text: str) -> float:
+    return len(tiktoken.get_encoding('cl100k_base').encode(text))*0.000002
+
+def engine():
+    # In-process engine, or the shared one at MEMORA_ENGINE_URL
+    return en.connect(api_key = st.secrets["openai_api_key"])
+
+def run_job(kind, chunks, subject, **options):
+    # The job runs in the engine, so after a rerun clicking again follows the same job instead of starting over
+    state_key = f"{kind}_job"
+    job = None
+    if st.session_state.get(state_key, {}).get("subject") == subject:
+        try:
+            job = engine().job(st.session_state[state_key]["id"])
+        except KeyError:
+            job = None
+    if job is None:
+        # Jobs from this session take turns with other sessions' jobs in the engine's LLM scheduler
+        job = engine().submit(kind, chunks, subject, session = get_script_run_ctx().session_id, **options)
+        st.session_state[state_key] = {"subject": subject, "id": job["id"]}
+    while job["state"] in ("queued", "running"):
+        prog_value.text(f"Step: {job['done']}/{job['total']}")
+        time.sleep(JOB_POLL_SECONDS)
+        job = engine().job(job["id"])
+    del st.session_state[state_key]
+    if job["trace"]:
+        dp.remember(lambda: engine().trace(job["trace"]))
+    return job
 
 @st.cache_data(ttl = 2*3600, max_entries = 5)
 def format_output(input_file: str) -> dict:
@@ -97,16 +98,11 @@ def format_output(input_file: str) -> dict:
 
 # ------------------------------ Page Logic --------------------------------
 
-logo = Image.open("./static/logo_2.png")
+logo = lz.static_image("./static/logo_2.png")
 st.set_page_config(page_title = "Memora - Study Wise", page_icon = logo, layout="wide")
 
-chat3_5, chat4 = pr.initialise_llms_with_key(st.secrets["openai_api_key"])
-
-chain = cache_chain(chat3_5)
-
 prog = 0
 bank = ""
-encs = tiktoken.get_encoding('cl100k_base')
 
 col1, col2= st.columns([0.5, 2])
 col1.image(logo, output_format="PNG", clamp=True, use_column_width=True)
@@ -115,8 +111,10 @@ with col2:
     st.title("Memora - Study Wise")
     st.subheader("Flashcards Generator")
     st.markdown("##### Upload your lecture notes and generate Q&A flashcards.")
-    st.markdown("###### You can study the flashcards on the 'Test Yourself' page or if you prefer Anki, you can choose the 'Format for Anki' option to download a file is formatted to be easily imported into Anki.")
-    st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "If the tool says 0 words recognised, ignore this as it has still worked.")
+    st.markdown("###### You can study the flashcards on the 'Test Yourself' page or if you prefer Anki, you can choose an Anki download format to get a file that can be easily imported into Anki.")
+    # Scanned pages are OCR'd on the server when Tesseract is installed
+    if not ocr.available():
+        st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "If the tool says 0 words recognised, ignore this as it has still worked.")
 
 uploaded_files = st.file_uploader("Upload Study Materials", type = ["pdf","txt","docx"], accept_multiple_files=True, on_change = clear_cache, key = "gen_uploads")
 
@@ -134,16 +132,24 @@ with st.sidebar:
                     7. Download generated document to import into Anki or use on Test Yourself page.""")
 
 if uploaded_files:
-    chunks = text_process(uploaded_files)
-    st.session_state["chunks"] = chunks
+    try:
+        with dp.traced("upload"), ocr.collect() as ocr_pages:
+            rs.hold(st.session_state, "chunks", text_process(uploaded_files))
+    except cs.IngestMemoryError as e:
+        st.error(f"These files are too large to process on this server. {e}")
+        st.stop()
+    if ocr_pages:
+        with st.expander(ocr.summary(ocr_pages)):
+            st.table(ocr.rows(ocr_pages))
     st.session_state.upld_filename = [doc.name for doc in uploaded_files]
 
-if 'chunks' in st.session_state and st.session_state.chunks is not None and st.session_state.chunks != []:
+if 'chunks' in st.session_state and st.session_state.chunks.value:
     st.caption("Files uploaded (upload new files or refresh to replace these)")
-    chunks = st.session_state["chunks"]
-    cost = len(encs.encode(str(chunks)))*0.000002
+    chunks = st.session_state["chunks"].value
     size = len(chunks)
-    anki_format = st.checkbox("Format Q&A pairs for Anki Import?", value = False, key = "anki_format", help = "When unchecked, the output will be a text file with questions and answers separated by a line break. Otherwise, the output will be a text file with questions and answers separated by '::' that you can use to easily import into Anki.")
+    export_format = st.selectbox("Download format", list(ex.EXPORT_FORMATS), key = "export_format", help = "'Text (Q/A)' can be used on the Test Yourself page. 'Anki text (::)' is a text file with questions and answers separated by '::' and 'Anki package (.apkg)' is a deck that can be opened directly in Anki.")
+    extension, mime = ex.EXPORT_FORMATS[export_format]
+    dedup_choice = st.checkbox("Remove near-duplicate questions", value = True, key = "dedup_choice", help = "Overlapping notes often produce the same question worded slightly differently. When checked, only the first of each group of near-identical questions is kept.")
     subject = st.text_input("Enter the name of the subject/module: (required)", key="subject")
     gen_button = st.button("Generate Questions", key="gen_button", type="primary")
     if gen_button and subject:
@@ -151,37 +157,33 @@ if 'chunks' in st.session_state and st.session_state.chunks is not None and st.s
         prog_value.text(f"Step: starting process...")
         stay_open = st.empty()
         stay_open.info("Please do not close the page until the process is complete.")
-        if "doc" in st.session_state and st.session_state.doc is not None and st.session_state.doc["name"] == subject and st.session_state.doc["anki"] == anki_format:
+        if "doc" in st.session_state and st.session_state.doc is not None and st.session_state.doc["name"] == subject:
             st.success("Questions already generated! (If you want to regenerate, rename the subject/module e.g. add a number to the end)")
-            download = st.download_button("Download", st.session_state.doc["doc"], file_name = f"{st.session_state.doc['name']}.txt", key="download_button")
+            download = st.download_button("Download", ex.export_deck(st.session_state.doc["doc"], export_format, subject), file_name = f"{st.session_state.doc['name']}{extension}", mime = mime, key="download_button")
             if download:
                 time.sleep(3)
                 clear_cache()
         else:
             with st.spinner("Generating questions..."):
-                try:
-                    bank_gen, prog = asyncio.run(main_loop_async(chunks, chain = chain, subject = subject))
-                except NameError:
-                    st.error("Please provide a valid API key to use this feature.")
-                try:
-                    bank = " ".join(bank_gen).replace(". Q:", ".\n\nQ:")
-                except TypeError:
-                    filtered = list(filter(None, bank_gen))
-                    bank = " ".join(filtered).replace(". Q:", ".\n\nQ:")
+                job = run_job("flashcards", chunks, subject, dedup = dedup_choice)
             stay_open.empty()
-            cost += len(encs.encode(bank))*0.000002
-            print(f"Cost: {round(cost, 2)+0.0011*size}")
-            if anki_format:
-                doc = gen.anki_formatter(bank)
+            if job["state"] != "done":
+                st.error(f"Generation stopped ({job['error'] or job['state']}). Please check your API key and click 'Generate Questions' again.")
             else:
-                doc = bank + "\n\nGenerated by Memora - Study Wise"
-            st.session_state["doc"] = {"name": subject, "doc": doc, "anki" : anki_format}
-            st.success("Flashcards generated! Head to the 'Test Yourself' page to use them.")
-            download = st.download_button("Download", st.session_state.doc["doc"], file_name=f"{subject}.txt", key="download_button")
-            # download_pdf = st.download_button(label = "Download PDF", data = create_pdf(st.session_state.doc["doc"]), file_name=f"{subject}.pdf", mime="application/pdf", key = "pdf_download_button", help = "This feature is still in beta so the questions and answers may contain missing symbols. I recommend downloading both the text file and the pdf file.")
-            if download:
-                time.sleep(3)
-                clear_cache()
+                doc = job["result"]
+                cost = sum(token_cost(chunk) for chunk in chunks) + token_cost(doc)
+                if job["removed"]:
+                    st.caption(f"Removed {job['removed']} near-duplicate questions.")
+                print(f"Cost: {round(cost, 2)+0.0011*size}")
+                st.session_state["doc"] = {"name": subject, "doc": doc}
+                st.success("Flashcards generated! Head to the 'Test Yourself' page to use them.")
+                download = st.download_button("Download", ex.export_deck(st.session_state.doc["doc"], export_format, subject), file_name=f"{subject}{extension}", mime = mime, key="download_button")
+                # download_pdf = st.download_button(label = "Download PDF", data = create_pdf(st.session_state.doc["doc"]), file_name=f"{subject}.pdf", mime="application/pdf", key = "pdf_download_button", help = "This feature is still in beta so the questions and answers may contain missing symbols. I recommend downloading both the text file and the pdf file.")
+                if download:
+                    time.sleep(3)
+                    clear_cache()
+
+dp.render(profiling = False)
 
 st.divider()
 st.caption("*If something stops working, refresh the page twice and try again.")
@@ -1,22 +1,39 @@
 import streamlit as st
-from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from io import StringIO, BytesIO
 import random
-from gtts import gTTS
-import src.generatorGPT as gen
-import src.processing as pr
+import src.lazy as lz
+import src.debug_panel as dp
+import src.scheduler as sch
+
+# Flashcard review needs neither langchain nor gTTS until an answer is explained or read out
+gen = lz.lazy_import("src.generatorGPT")
+pr = lz.lazy_import("src.processing")
+gtts = lz.lazy_import("gtts")
+
+def models():
+    return pr.initialise_llms_with_key(st.secrets["openai_api_key"])
 
 def clear_cache():
     st.cache_data.clear()
     if 'doc' in st.session_state:
         del st.session_state['doc']
 
-def regen(question: str, answer: str) -> str:
-    if model_choice:
-        new_answer = gen.regen_answer_gen(question = question, answer = answer, model = chat4)
-        return new_answer
-    new_answer = gen.regen_answer_gen(question = question, answer = answer, model = chat3_5)
-    return new_answer
+def regen(question: str, answer: str, card: str = "") -> str:
+    chat3_5, chat4 = models()
+    with dp.traced("explain"):
+        if model_mode == "gpt4":
+            return gen.regen_answer_gen(question = question, answer = answer, model = chat4, card = card)
+        strong_model = chat4 if model_mode == "auto" else None
+        return gen.regen_answer_gen(question = question, answer = answer, model = chat3_5, card = card, strong_model = strong_model)
+
+def prefetch(card: str, answer: str):
+    chat3_5, chat4 = models()
+    if model_mode == "gpt4":
+        gen.prefetch_explanation(card = card, answer = answer, model = chat4)
+        return
+    strong_model = chat4 if model_mode == "auto" else None
+    gen.prefetch_explanation(card = card, answer = answer, model = chat3_5, strong_model = strong_model)
 
 @st.cache_data(ttl = 2*3600, max_entries = 5)
 def format_input(input_file: str) -> dict:
@@ -56,10 +73,12 @@ def clear_explain_q():
 
 # ------------------------------ Page Logic --------------------------------
 
-logo = Image.open("./static/logo_2.png")
-st.set_page_config(page_title = "Memora - Study Wise", page_icon = logo, layout = "wide")
+MODEL_LABELS = {"gpt3_5": "GPT-3.5 (fastest)", "auto": "Auto (GPT-3.5, switches to GPT-4 when unsure)", "gpt4": "GPT-4 (slower but better output)"}
 
-chat3_5, chat4 = pr.initialise_llms_with_key(st.secrets["openai_api_key"])
+logo = lz.static_image("./static/logo_2.png")
+st.set_page_config(page_title = "Memora - Study Wise", page_icon = logo, layout = "wide")
+# Explanations from this session take turns with other sessions' calls in the LLM scheduler
+sch.bind(session = get_script_run_ctx().session_id)
 
 logo_col, appinfo_col= st.columns([0.5, 2])
 logo_col.image(logo, output_format="PNG", clamp=True, use_column_width=True)
@@ -96,9 +115,10 @@ else:
         uploaded = True
 
 with st.sidebar:
-    model_choice = st.checkbox(":sparkle: Use GPT-4 (slower but better output)", key = "model_choice_test")
+    model_mode = st.radio(":sparkle: Model", ["gpt3_5", "auto", "gpt4"], format_func = MODEL_LABELS.get, key = "model_mode_test", help = "'Auto' explains with GPT-3.5 and switches to GPT-4 only when the explanation strays from the flashcard. Make sure you have access to GPT-4 API before using the GPT-4 or Auto options.")
     st.divider()
     tts_choice = st.checkbox(":sound: Text-to-Speech", key = "tts_choice")
+    prefetch_choice = st.checkbox(":zap: Prepare explanations in advance", value = False, key = "prefetch_choice", help = "Explanations for the current and next question are generated in the background while you study, so 'Explain the answer' responds instantly. This uses more API credits.")
     random_choice = st.checkbox(":twisted_rightwards_arrows: Randomise order of Q&A", value = False, key = "random_toggle", on_change = reset_counter_func)
     reset_counter = st.button("Reset counter", on_click = reset_counter_func)
     st.divider()
@@ -175,13 +195,20 @@ if uploaded:
         with st.expander("View Answer", expanded=False):
             st.write(f"A: {st.session_state.a}")
             if tts_choice:
-                tts = gTTS(st.session_state.a, lang='en')
+                tts = gtts.gTTS(st.session_state.a, lang='en')
                 tts.write_to_fp(sound_file)
                 st.audio(sound_file)
+    if prefetch_choice and 'a' in st.session_state and st.session_state.a is not None:
+        prefetch(card = st.session_state.q, answer = st.session_state.a)
+        if not random_choice:
+            next_q, next_a = list(qa_dict.items())[(st.session_state.counter + 1) % len(qa_dict)]
+            prefetch(card = next_q, answer = next_a)
     explain_q = st.text_input("Optional: Enter a question if you want a specific part of the answer to be explained...", key = "explain_q")
     if 'a' in st.session_state and st.session_state.a is not None:
         if explain or (explain_q and explain_q != "" and explain_q != " "):
-            st.write(f"Explanation: {regen(question = explain_q, answer = st.session_state.a)}")
+            st.write(f"Explanation: {regen(question = explain_q, answer = st.session_state.a, card = st.session_state.q)}")
+dp.render()
+
 st.divider()
 st.caption("*If something stops working, refresh the page twice and try again.")
 
@@ -1,83 +1,86 @@
-import io
 import time
 import streamlit as st
-import asyncio
-from pypdf import PdfReader
-import docx2txt
-from PIL import Image
-import src.processing as pr
-import src.generatorGPT as gen
-import src.async_generator as ag
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import src.engine as en
+import src.lazy as lz
+import src.debug_panel as dp
+import src.resources as rs
+import src.chunk_store as cs
+import src.ocr as ocr
+
+JOB_POLL_SECONDS = 0.5
 
 def clear_cache():
     st.cache_data.clear()
     if 'doc' in st.session_state:
         del st.session_state['doc']
 
-@st.cache_data(ttl = 2*3600, max_entries = 5)
 def text_process(uploads):
-    text = ""
-    for doc in uploads:
-        if doc.name.endswith(".txt"):
-            stringio = io.StringIO(doc.getvalue().decode("utf-8"))
-            text += stringio.read()
-        if doc.name.endswith(".pdf"):
-            pdf_reader = PdfReader(doc)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text()
-        if doc.name.endswith(".docx"):
-            text += docx2txt.process(doc)
-    chunks = pr.text_splitter(text)
-    return chunks
-
-@st.cache_resource
-def cache_chain(_chat):
-    cached_chain = gen.initialise_chain_no_mem(chat = _chat, type = "guide")
-    return cached_chain
-
-async def print_progress(progress_queue):
-    last_processed_chunks = 0
-    while True:
-        processed_chunks = await progress_queue.get()
-        if processed_chunks != last_processed_chunks:
-            prog_value.text(f"Step: {processed_chunks}/{size}")
-            last_processed_chunks = processed_chunks
-
-async def main(chunks, chain, subject):
-    progress_queue = asyncio.Queue()
-    progress_task = asyncio.create_task(print_progress(progress_queue))
-    results, processed_chunks = await ag.gen_concurrent(chunks, chain , subject, progress_queue)
-    progress_task.cancel()
-    return results, processed_chunks
+    # A handle on chunks shared by every session (and page) that uploads the same files
+    # getbuffer() reads the upload in place; large uploads are chunked into a store on disk
+    files = [(doc.name, doc.getbuffer()) for doc in uploads]
+    key = rs.content_key("chunks", *(part for file in files for part in file))
+    return rs.default_manager().acquire(key, lambda: cs.load_chunks(files))
+
+def engine():
+    # In-process engine, or the shared one at MEMORA_ENGINE_URL
+    return en.connect(api_key = st.secrets["openai_api_key"])
+
+def run_job(kind, chunks, subject, **options):
+    # The job runs in the engine, so after a rerun clicking again follows the same job instead of starting over
+    state_key = f"{kind}_job"
+    job = None
+    if st.session_state.get(state_key, {}).get("subject") == subject:
+        try:
+            job = engine().job(st.session_state[state_key]["id"])
+        except KeyError:
+            job = None
+    if job is None:
+        # Jobs from this session take turns with other sessions' jobs in the engine's LLM scheduler
+        job = engine().submit(kind, chunks, subject, session = get_script_run_ctx().session_id, **options)
+        st.session_state[state_key] = {"subject": subject, "id": job["id"]}
+    while job["state"] in ("queued", "running"):
+        stage = job.get("stage", "generate")
+        prog_value.text(f"Step: {job['done']}/{job['total']}" if stage == "generate" else f"Step ({stage}): {job['done']}/{job['total']}")
+        time.sleep(JOB_POLL_SECONDS)
+        job = engine().job(job["id"])
+    del st.session_state[state_key]
+    if job["trace"]:
+        dp.remember(lambda: engine().trace(job["trace"]))
+    return job
 
 # ------------------------------ Page Logic --------------------------------
 
-logo = Image.open("./static/logo_2.png")
+logo = lz.static_image("./static/logo_2.png")
 st.set_page_config(page_title = "Memora - Study Wise", page_icon = logo, layout="wide")
 
-chat3_5, chat4 = pr.initialise_llms_with_key(st.secrets["openai_api_key"])
-
-chain = cache_chain(chat3_5)
-
 col1, col2= st.columns([0.5, 2])
 col1.image(logo, output_format="PNG", clamp=True, use_column_width=True)
 
 with col2:
     st.title("Memora - Study Wise")
     st.subheader("Learning Guide Generator (Beta)")
-    st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "If the tool says 0 words recognised, ignore this as it has still worked.")
+    # Scanned pages are OCR'd on the server when Tesseract is installed
+    if not ocr.available():
+        st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "If the tool says 0 words recognised, ignore this as it has still worked.")
     st.caption("Tired of cramming? Upload your study materials and generate a detailed learning guide to help you study more effectively!")
 
 uploaded_pdfs = st.file_uploader("Upload Study Materials", type = ["pdf","txt","docx"], accept_multiple_files = True, help = "Due to cserver limitations, there is currently a limit of 100 mb per document.", on_change = clear_cache, key = "plan_uploads")
 
 if uploaded_pdfs:
     st.caption("Files uploaded (upload new files or refresh to replace these)")
-    chunks = text_process(uploaded_pdfs)
-    st.session_state["plan_chunks"] = chunks
-
-if 'plan_chunks' in st.session_state and st.session_state.plan_chunks is not None and st.session_state.plan_chunks != []:
-    chunks = st.session_state["plan_chunks"]
+    try:
+        with dp.traced("upload"), ocr.collect() as ocr_pages:
+            rs.hold(st.session_state, "plan_chunks", text_process(uploaded_pdfs))
+    except cs.IngestMemoryError as e:
+        st.error(f"These files are too large to process on this server. {e}")
+        st.stop()
+    if ocr_pages:
+        with st.expander(ocr.summary(ocr_pages)):
+            st.table(ocr.rows(ocr_pages))
+
+if 'plan_chunks' in st.session_state and st.session_state.plan_chunks.value:
+    chunks = st.session_state["plan_chunks"].value
     size = len(chunks)
     subject = st.text_input("Enter the name of the subject/module:", key="plan_subject")
     gen_button = st.button("Generate Plan", key="gen_plan_button", type="primary")
@@ -95,20 +98,22 @@ if 'plan_chunks' in st.session_state and st.session_state.plan_chunks is not Non
                 clear_cache()
         else:
             with st.spinner("Generating plan..."):
-                bank_gen, prog = asyncio.run(main(chunks, chain = chain, subject = subject))
-                try:
-                    bank = "\n\n".join(bank_gen)
-                except TypeError:
-                    filtered = list(filter(None, bank_gen))
-                    bank = " ".join(filtered)
+                job = run_job("guide", chunks, subject)
             stay_open.empty()
-            doc = bank + "\n\nGenerated by Memora - Study Wise"
-            st.session_state["plan_doc"] = {"name" : subject, "doc" : doc}
-            st.success("Plan generated!")
-            download = st.download_button("Download", st.session_state.plan_doc["doc"], file_name=filename, key="plan_download_button")
-            if download:
-                time.sleep(3)
-                clear_cache()
+            if job["state"] != "done":
+                st.error(f"Generation stopped ({job['error'] or job['state']}). Please check your API key and click 'Generate Plan' again.")
+            else:
+                st.session_state["plan_doc"] = {"name" : subject, "doc" : job["result"]}
+                st.success("Plan generated!")
+                if job.get("reduce") and job["reduce"]["depth"]:
+                    stats = job["reduce"]
+                    st.caption(f"{stats['segments']} segments merged into {stats['sections']} sections over {stats['depth']} round(s), {stats['mean_fan_in']} segments per merge on average.")
+                download = st.download_button("Download", st.session_state.plan_doc["doc"], file_name=filename, key="plan_download_button")
+                if download:
+                    time.sleep(3)
+                    clear_cache()
+
+dp.render(profiling = False)
 
 st.divider()
 st.caption("*If something stops working, refresh the page twice and try again.")
@@ -10,10 +10,14 @@ from langchain.chains.retrieval_qa.base import BaseRetrievalQA
 class RetrievalQA(BaseRetrievalQA):
     fetch_size: int = 100000
     k: int
+    # Documents already selected by the caller, so the chain does not search again
+    docs: Optional[List[Document]] = None
 
-    docstore: FAISS = Field(exclude=True)
+    docstore: FAISS | Any = Field(exclude=True)
     
     def _get_docs(self, question: str) -> List[Document]:
+        if self.docs is not None:
+            return self.docs
         return self.docstore.similarity_search(question, k = self.k, fetch_k = self.fetch_size)
     
     def _aget_docs(self, question: str) -> List[Document]:
@@ -1,10 +1,19 @@
 import os
 import time
-from typing import List
+from typing import Any, Callable, Dict, List
 from dotenv import load_dotenv
 from langchain.chains import LLMChain
 import asyncio
+try:
+    import src.http_pool as hp
+    import src.scheduler as sch
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import http_pool as hp
+    import scheduler as sch
+    import tracing as tr
 
+@tr.traced("llm.generate")
 async def run_chain(chain: LLMChain, chunk, num ,subject):
     text = ""
     resp = await chain.arun(chunk=chunk, subject=subject, num=num)
@@ -12,30 +21,132 @@ async def run_chain(chain: LLMChain, chunk, num ,subject):
     return text
 
 CONCURRENT_CALLS_LIMIT = 10
+REQUESTS_PER_MINUTE = 120
+# Tree reduce: each merge call gets at most REDUCE_FAN_IN adjacent segments and REDUCE_INPUT_TOKENS of them
+# (room for the prompt and the answer in a 4k context); rounds stop once the result fits in REDUCE_TARGET_TOKENS
+REDUCE_FAN_IN = 4
+REDUCE_INPUT_TOKENS = 2400
+REDUCE_TARGET_TOKENS = 6000
+SEGMENT_SEPARATOR = "\n\n----------------------------------------\n\n"
 
-async def gen_concurrent(chunks, chain, subject, progress_queue):
-    semaphore = asyncio.Semaphore(CONCURRENT_CALLS_LIMIT)
+class RateLimiter:
+    # Spaces out request starts so every task sharing it stays under one requests-per-minute budget
+    def __init__(self, rpm: int = REQUESTS_PER_MINUTE):
+        self.interval = 60 / rpm
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+@tr.traced("gen_concurrent")
+async def gen_concurrent(chunks, chain, subject, progress_queue = None, semaphore = None, limiter = None):
+    # The semaphore caps this run's calls in flight or queued in the scheduler. The limiter paces their starts
+    # (a RateLimiter, or the scheduler itself when its rate limits are enough); without one each call waits 2 s
+    semaphore = semaphore or asyncio.Semaphore(CONCURRENT_CALLS_LIMIT)
+    # Set before the tasks are created so they inherit the loop's pooled session instead of one session per call
+    hp.default_pool().use_async()
     processed_chunks = 0
     results = [None] * len(chunks)
     tasks = []
 
-    async def process_chunk(chunk, index):
+    async def process_chunk(index):
+        # Chunks are read once a slot is free, so a lazy sequence (chunk_store.ChunkStore) is never held in memory whole
         nonlocal processed_chunks
-        async with semaphore:
-            await asyncio.sleep(2)
-            result = await run_chain(chain, chunk, index, subject)
-            results[index] = result
-            processed_chunks += 1
-            await progress_queue.put(processed_chunks)
+        # Self time of a chunk's span is the wait for a semaphore slot
+        with tr.span("generate.chunk", index = index):
+            async with semaphore:
+                with tr.span("generate.rate_limit"):
+                    if limiter is None:
+                        await asyncio.sleep(2)
+                    else:
+                        await limiter.acquire()
+                result = await run_chain(chain, chunks[index], index, subject)
+                results[index] = result
+                processed_chunks += 1
+                if progress_queue is not None:
+                    await progress_queue.put(processed_chunks)
 
-    for i, chunk in enumerate(chunks):
-        task = asyncio.create_task(process_chunk(chunk, i))
-        tasks.append(task)
+    # Generation calls queue behind interactive ones in the process-wide scheduler; the tasks inherit the priority
+    with sch.context(priority = sch.BATCH):
+        for i in range(len(chunks)):
+            task = asyncio.create_task(process_chunk(i))
+            tasks.append(task)
 
     await asyncio.gather(*tasks, return_exceptions=True)
 
     return results, processed_chunks
 
+def _token_counter():
+    import tiktoken
+    enc = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(enc.encode(text, disallowed_special = ()))
+
+def plan_round(sizes: List[int], budget: int = REDUCE_INPUT_TOKENS, fan_in: int = REDUCE_FAN_IN) -> List[List[int]]:
+    # Adjacent segments grouped greedily under the token budget, at most fan_in to a group. A segment over the budget on
+    # its own, or one that fits with neither neighbour, is a group of one and passes through the round unchanged.
+    groups: List[List[int]] = []
+    group: List[int] = []
+    tokens = 0
+    for i, size in enumerate(sizes):
+        if group and (len(group) == fan_in or tokens + size > budget):
+            groups.append(group)
+            group, tokens = [], 0
+        group.append(i)
+        tokens += size
+    if group:
+        groups.append(group)
+    return groups
+
+@tr.traced("reduce_concurrent")
+async def reduce_concurrent(segments: List[str], chain, subject, progress_queue = None, semaphore = None, limiter = None,
+                            on_round: Callable[[int, int], None] | None = None, fan_in: int = REDUCE_FAN_IN,
+                            budget: int = REDUCE_INPUT_TOKENS, target: int = REDUCE_TARGET_TOKENS):
+    # Merges adjacent segments in rounds until they fit in `target` tokens; each round's merge calls run concurrently
+    # through gen_concurrent, so a guide of n segments takes O(log n) sequential rounds. Returns the sections and
+    # per-round depth and fan-in statistics. A failed merge keeps its segments as they were, and segments too long to
+    # merge are never cut: they stay as sections of their own, so the result can end up over `target`.
+    count = _token_counter()
+    level = [segment for segment in segments if segment]
+    sizes = [count(segment) for segment in level]
+    rounds: List[Dict[str, Any]] = []
+    while len(level) > 1 and sum(sizes) > target:
+        groups = plan_round(sizes, budget, fan_in)
+        merges = [group for group in groups if len(group) > 1]
+        if not merges:
+            break
+        if on_round is not None:
+            on_round(len(rounds) + 1, len(merges))
+        inputs = [SEGMENT_SEPARATOR.join(level[i] for i in group) for group in merges]
+        start = time.perf_counter()
+        with tr.span("reduce.round", round = len(rounds) + 1, segments = len(level), calls = len(merges)):
+            results, _ = await gen_concurrent(inputs, chain, subject, progress_queue, semaphore = semaphore, limiter = limiter)
+        merged = iter(results)
+        next_level, failed = [], 0
+        for group in groups:
+            result = next(merged) if len(group) > 1 else level[group[0]]
+            if not result:
+                failed += 1
+                result = "\n\n".join(level[i] for i in group)
+            next_level.append(result)
+        fan_ins = [len(group) for group in merges]
+        rounds.append({"round": len(rounds) + 1, "segments_in": len(level), "segments_out": len(next_level), "calls": len(merges),
+                       "failed": failed, "max_fan_in": max(fan_ins), "mean_fan_in": round(sum(fan_ins) / len(fan_ins), 2),
+                       "tokens_in": sum(sizes), "seconds": round(time.perf_counter() - start, 2)})
+        level = next_level
+        sizes = [count(segment) for segment in level]
+        rounds[-1]["tokens_out"] = sum(sizes)
+    calls = sum(r["calls"] for r in rounds)
+    stats = {"depth": len(rounds), "segments": len(segments), "sections": len(level), "calls": calls,
+             "mean_fan_in": round(sum(r["segments_in"] - r["segments_out"] + r["calls"] for r in rounds) / calls, 2) if calls else 0.0,
+             "tokens": sum(sizes), "rounds": rounds}
+    return level, stats
+
 # async def gen_concurrent(chunks, chain, subject, progress_queue):
 #     semaphore = asyncio.Semaphore(CONCURRENT_CALLS_LIMIT)
 #     processed_chunks = 0
@@ -86,7 +197,7 @@ if __name__ == "__main__":
     print("Extracting text from PDFs...")
     text = pr.extract_text_loaders(loaders)
     print("Splitting text into chunks...")
-    chunks = pr.text_splitter(text)
+    chunks = pr.generation_chunks(text)
     print(f"Generated {len(chunks)} chunks.")
 
     s = time.perf_counter()
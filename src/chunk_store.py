@@ -0,0 +1,154 @@
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from collections.abc import Sequence
+from typing import Iterable, Iterator, List, Tuple
+import numpy as np
+try:
+    import src.processing as pr
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import processing as pr
+    import tracing as tr
+
+# Uploads above SPILL_MB (all files together) are ingested page by page into an on-disk ChunkStore instead of a list
+# of strings; ingestion fails rather than hold more than INGEST_MEMORY_MB of text at once. Only what ingestion owns
+# counts (the page being chunked and the chunker's window), not the process's RSS, so other sessions don't eat into it.
+# Scanned PDF pages are OCR'd processing.STREAM_PDF_PAGES at a time, which bounds the images held separately.
+# Streamlit itself still holds each upload in memory (server.maxUploadSize), nothing else keeps a copy of it.
+SPILL_MB = int(os.getenv("MEMORA_SPILL_MB", "20"))
+INGEST_MEMORY_MB = int(os.getenv("MEMORA_INGEST_MEMORY_MB", "512"))
+SPILL_ROOT = os.getenv("MEMORA_SPILL_DIR") or None
+DATA_FILE = "chunks.txt"
+OFFSETS_FILE = "offsets.npy"
+
+class IngestMemoryError(MemoryError):
+    pass
+
+class ChunkStore(Sequence):
+    # Read-only sequence of chunks: UTF-8 text memory-mapped from one file, chunk i at bytes offsets[i]:offsets[i + 1].
+    # Only the chunks being read are decoded into memory. A temporary store deletes its directory once closed or dropped.
+    def __init__(self, directory: str, temporary: bool = False):
+        self.directory = directory
+        self.temporary = temporary
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode = "r")
+        self._file = open(os.path.join(directory, DATA_FILE), "rb")
+        size = int(self.offsets[-1]) if len(self.offsets) else 0
+        self._data = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ) if size else b""
+
+    @classmethod
+    def write(cls, chunks: Iterable[str], directory: str | None = None) -> "ChunkStore":
+        writer = ChunkWriter(directory)
+        try:
+            for chunk in chunks:
+                writer.add(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.finish()
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets[-1])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int | slice) -> str | List[str]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return self._data[int(self.offsets[index]):int(self.offsets[index + 1])].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"ChunkStore({len(self)} chunks, {self.nbytes / 2**20:.1f} MB at {self.directory})"
+
+    def close(self):
+        if self._file.closed:
+            return
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+        self.offsets = np.zeros(1, dtype = np.int64)
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors = True)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class ChunkWriter:
+    # Builds a ChunkStore one chunk at a time, for producers that can't hand over an iterable (e.g. an HTTP body)
+    def __init__(self, directory: str | None = None):
+        self.temporary = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix = "memora-chunks-", dir = SPILL_ROOT)
+        self.offsets = [0]
+        self._file = open(os.path.join(self.directory, DATA_FILE), "wb")
+
+    def add(self, chunk: str):
+        data = chunk.encode("utf-8")
+        self._file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def finish(self) -> ChunkStore:
+        try:
+            self._file.close()
+            np.save(os.path.join(self.directory, OFFSETS_FILE), np.array(self.offsets, dtype = np.int64))
+        except BaseException:
+            self.abort()
+            raise
+        return ChunkStore(self.directory, temporary = self.temporary)
+
+    def abort(self):
+        self._file.close()
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors = True)
+
+def should_spill(files: List[Tuple[str, bytes]], spill_mb: int = SPILL_MB) -> bool:
+    return sum(len(data) for _, data in files) > spill_mb * 2**20
+
+def _bounded(texts: Iterable[str], limit: int, window_tokens: int = pr.STREAM_WINDOW_TOKENS) -> Iterator[str]:
+    # The chunker holds the page plus under one window of earlier text (4 bytes a character at worst, about 4 characters
+    # a token) and copies both once more while splitting them
+    window = 4 * 4 * window_tokens
+    for text in texts:
+        if 2 * (sys.getsizeof(text) + window) > limit:
+            raise IngestMemoryError(f"Ingesting a page would hold more than {limit // 2**20} MB of text, raise MEMORA_INGEST_MEMORY_MB to allow more")
+        yield text
+
+@tr.traced("chunk_store.ingest")
+def ingest(files: List[Tuple[str, bytes]], memory_mb: int = INGEST_MEMORY_MB, directory: str | None = None) -> ChunkStore:
+    # Each file is written to a temporary file, then extracted and chunked a page at a time into the store
+    spill = tempfile.mkdtemp(prefix = "memora-upload-", dir = SPILL_ROOT)
+    def texts() -> Iterator[str]:
+        for i, (name, data) in enumerate(files):
+            path = os.path.join(spill, f"{i}{os.path.splitext(name)[1]}")
+            with open(path, "wb") as f:
+                f.write(data)
+            try:
+                yield from pr.iter_text(name, path)
+            finally:
+                os.remove(path)
+    pages = texts()
+    try:
+        return ChunkStore.write(pr.iter_generation_chunks(_bounded(pages, memory_mb * 2**20)), directory)
+    finally:
+        pages.close()
+        shutil.rmtree(spill, ignore_errors = True)
+
+def load_chunks(files: List[Tuple[str, bytes]]) -> List[str] | ChunkStore:
+    # Generation chunks for uploaded files: a list for ordinary uploads, a ChunkStore on disk for large ones
+    if should_spill(files):
+        return ingest(files)
+    return pr.generation_chunks(" ".join(pr.extract_text(name, bytes(data)) for name, data in files))
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from typing import Dict, List, TextIO
+import numpy as np
+try:
+    import src.processing as pr
+    import src.generatorGPT as gen
+    import src.async_generator as ag
+    import src.el_professor as ep
+    import src.corpora as cp
+    import src.dedup as dd
+    import src.export as ex
+    import src.knowledge_bases as kb
+    import src.lexical as lx
+    import src.vectors as vc
+    import src.http_pool as hp
+    import src.scheduler as sch
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import processing as pr
+    import generatorGPT as gen
+    import async_generator as ag
+    import el_professor as ep
+    import corpora as cp
+    import dedup as dd
+    import export as ex
+    import knowledge_bases as kb
+    import lexical as lx
+    import vectors as vc
+    import http_pool as hp
+    import scheduler as sch
+    import tracing as tr
+
+NOTES_ROOT = "./Notes"
+SOURCE_TYPES = (".pdf", ".txt", ".docx")
+EXPORT_FORMATS = {"text": "Text (Q/A)", "anki": "Anki text (::)", "csv": "CSV", "jsonl": "JSONL", "apkg": "Anki package (.apkg)"}
+
+# ------------------------------ Helpers ------------------------------ #
+
+def folder_path(folder: str, root: str = NOTES_ROOT) -> str:
+    # Accepts either a path or a subject folder name under ./Notes, like the old input() prompts
+    return folder if os.path.isdir(folder) else os.path.join(root, folder)
+
+def folder_name(folder: str) -> str:
+    return os.path.basename(os.path.normpath(folder))
+
+def read_folder(folder: str, root: str = NOTES_ROOT) -> Dict[str, bytes]:
+    path = folder_path(folder, root)
+    files = {}
+    for fn in sorted(os.listdir(path)):
+        if fn.endswith(SOURCE_TYPES):
+            with open(os.path.join(path, fn), "rb") as f:
+                files[fn] = f.read()
+    return files
+
+def folder_text(folder: str, root: str = NOTES_ROOT) -> str:
+    return " ".join(pr.extract_text(fn, data) for fn, data in read_folder(folder, root).items())
+
+class Emitter:
+    # One JSON object per line on the output stream, timing summary on stderr
+    def __init__(self, out: TextIO):
+        self.out = out
+        self.records = []
+
+    def emit(self, record: dict):
+        self.records.append(record)
+        self.out.write(json.dumps(record, ensure_ascii = False) + "\n")
+        self.out.flush()
+
+    def summary(self, command: str, elapsed: float):
+        stats = {"command": command, "items": len(self.records), "errors": sum("error" in r for r in self.records), "seconds": round(elapsed, 2)}
+        for key in ("chunks", "cards", "lost_chunks", "updated"):
+            if any(key in r for r in self.records):
+                stats[key] = sum(r.get(key, 0) for r in self.records)
+        print(json.dumps(stats), file = sys.stderr)
+        return stats
+
+async def _run_folders(folders: List[str], work, emitter: Emitter, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    async def run(folder):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                record = await work(folder)
+            except (OSError, ValueError, IndexError) as e:
+                record = {"error": f"{type(e).__name__}: {e}"}
+            emitter.emit({"folder": folder_name(folder), **record, "seconds": round(time.perf_counter() - start, 2)})
+    await asyncio.gather(*(run(folder) for folder in folders))
+
+# ------------------------------ Commands ------------------------------ #
+
+async def cmd_ingest(args, emitter: Emitter):
+    async def work(folder):
+        text = await asyncio.to_thread(folder_text, folder, args.root)
+        parents, children = pr.split_parent_child(text, source = folder_name(folder))
+        record = {"chars": len(text), "parents": len(parents), "chunks": len(children)}
+        if args.out_dir:
+            os.makedirs(args.out_dir, exist_ok = True)
+            path = os.path.join(args.out_dir, f"{folder_name(folder)}.chunks.jsonl")
+            with open(path, "w") as f:
+                f.writelines(json.dumps({"text": doc.page_content, **doc.metadata}, ensure_ascii = False) + "\n" for doc in parents + children)
+            record["output"] = path
+        return record
+    await _run_folders(args.folders, work, emitter, args.folder_concurrency)
+
+async def cmd_index(args, emitter: Emitter):
+    manager = kb.KnowledgeBaseManager(ep.embed_type_chooser("o"), root = args.vdb_root, vectors = args.vectors)
+    async def work(folder):
+        name = manager.clean_name(folder_name(folder))
+        files = await asyncio.to_thread(read_folder, folder, args.root)
+        before = manager.manifest(name, args.owner)
+        previous = before.sources if before is not None else {}
+        manifest = await asyncio.to_thread(manager.save, name, files, args.owner)
+        updated = [fn for fn, entry in manifest.sources.items() if previous.get(fn) != entry]
+        return {"knowledge_base": name, "sources": len(manifest.sources), "chunks": sum(e.chunks for e in manifest.sources.values()),
+                "updated": len(updated)}
+    await _run_folders(args.folders, work, emitter, args.folder_concurrency)
+
+async def cmd_generate(args, emitter: Emitter):
+    chat3_5, chat4 = pr.initialise_llms()
+    chain = gen.initialise_chain_no_mem(chat4 if args.model == "gpt4" else chat3_5)
+    # One semaphore and one limiter across every folder, so the whole batch respects the API limits
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limiter = ag.RateLimiter(args.rpm)
+    fmt = EXPORT_FORMATS[args.format]
+    extension, _ = ex.EXPORT_FORMATS[fmt]
+    async def work(folder):
+        subject = args.subject or folder_name(folder)
+        chunks = pr.generation_chunks(await asyncio.to_thread(folder_text, folder, args.root))
+        results, _ = await ag.gen_concurrent(chunks, chain, subject, semaphore = semaphore, limiter = limiter)
+        lost = [i for i, result in enumerate(results) if result is None]
+        bank = " ".join(filter(None, results)).replace(". Q:", ".\n\nQ:")
+        removed = 0
+        if not args.no_dedup:
+            bank, removed = dd.dedup_bank(bank)
+        doc = bank + "\n\n" + gen.AUTH_LINE
+        os.makedirs(args.out_dir, exist_ok = True)
+        path = os.path.join(args.out_dir, f"{folder_name(folder)}{extension}")
+        with open(path, "wb") as f:
+            ex.write_deck(doc, fmt, f, subject)
+        return {"subject": subject, "chunks": len(chunks), "cards": len(gen.parse_qa_pairs(doc)), "lost_chunks": len(lost),
+                "lost_chunk_indices": lost, "removed_duplicates": removed, "output": path}
+    await _run_folders(args.folders, work, emitter, args.folder_concurrency)
+
+async def cmd_ask(args, emitter: Emitter):
+    chat3_5, chat4 = pr.initialise_llms()
+    model = chat4 if args.model == "gpt4" else chat3_5
+    manager = kb.KnowledgeBaseManager(ep.embed_type_chooser("o"), root = args.vdb_root, vectors = args.vectors)
+    registry = cp.CorpusRegistry()
+    names = []
+    for base in args.base:
+        for key, docstore in manager.open(base, args.owner):
+            registry.register(f"shard:{key}", docstore, lx.BM25Index.from_faiss(docstore), pinned = True).release()
+            names.append(f"shard:{key}")
+    docstore = cp.ShardedCorpus(registry, names)
+    questions = args.questions or [line.strip() for line in sys.stdin if line.strip()]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limiter = ag.RateLimiter(args.rpm)
+    async def ask(question):
+        async with semaphore:
+            await limiter.acquire()
+            start = time.perf_counter()
+            record = {"question": question}
+            try:
+                result = await asyncio.to_thread(ep.answer_question, model, docstore, question)
+                record.update(answer = result["result"], model = result["model_name"],
+                              sources = [doc.page_content for doc in result.get("source_documents", [])])
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["seconds"] = round(time.perf_counter() - start, 2)
+            emitter.emit(record)
+    await asyncio.gather(*(ask(question) for question in questions))
+
+async def cmd_report(args, emitter: Emitter):
+    # Memory and recall of each vector storage option, to pick one per corpus
+    manager = kb.KnowledgeBaseManager(ep.embed_type_chooser("o"), root = args.vdb_root)
+    for base in args.bases:
+        start = time.perf_counter()
+        vectors = np.concatenate([vc.reconstruct(docstore.index, np.arange(docstore.index.ntotal)) for _, docstore in manager.open(base, args.owner)])
+        for record in await asyncio.to_thread(vc.storage_report, vectors, args.vectors or vc.VECTOR_KINDS, args.k):
+            emitter.emit({"knowledge_base": base, **record, "seconds": round(time.perf_counter() - start, 2)})
+
+COMMANDS = {"ingest": cmd_ingest, "index": cmd_index, "generate": cmd_generate, "ask": cmd_ask, "report": cmd_report}
+
+# ------------------------------ Entry point ------------------------------ #
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog = "memora", description = "Batch ingest, indexing, flashcard generation and Q&A over folders of notes.")
+    parser.add_argument("-o", "--output", help = "write JSONL results here instead of stdout")
+    parser.add_argument("--trace", metavar = "PATH", help = "write a Chrome trace of the run's stages here (open in ui.perfetto.dev)")
+    parser.add_argument("--profile", choices = tr.PROFILERS, help = "profile the run and print the busiest functions to stderr")
+    parser.add_argument("--root", default = NOTES_ROOT, help = "folder that holds subject folders (default: %(default)s)")
+    parser.add_argument("--vdb-root", default = ep.VDB_ROOT, help = "where knowledge bases are saved (default: %(default)s)")
+    parser.add_argument("--owner", default = kb.LOCAL_OWNER, help = "owner whose knowledge bases are used (default: %(default)s)")
+    parser.add_argument("--folder-concurrency", type = int, default = 4, help = "folders processed at once (default: %(default)s)")
+    sub = parser.add_subparsers(dest = "command", required = True)
+
+    ingest = sub.add_parser("ingest", help = "extract and chunk folders")
+    ingest.add_argument("folders", nargs = "+")
+    ingest.add_argument("--out-dir", help = "also write each folder's chunks as JSONL")
+
+    index = sub.add_parser("index", help = "build or refresh a knowledge base per folder")
+    index.add_argument("folders", nargs = "+")
+    index.add_argument("--vectors", choices = vc.VECTOR_KINDS, default = "flat", help = "also prepare compressed vector storage (default: %(default)s)")
+
+    report = sub.add_parser("report", help = "compare memory and recall of the vector storage options")
+    report.add_argument("bases", nargs = "+")
+    report.add_argument("--vectors", choices = vc.VECTOR_KINDS, action = "append", help = "storage options to compare (default: all)")
+    report.add_argument("-k", type = int, default = 10, help = "recall@k (default: %(default)s)")
+
+    for name, helptext in (("generate", "generate flashcard decks for folders"), ("ask", "answer questions from knowledge bases")):
+        command = sub.add_parser(name, help = helptext)
+        command.add_argument("--model", choices = ["gpt3_5", "gpt4"], default = "gpt3_5")
+        command.add_argument("--concurrency", type = int, default = ag.CONCURRENT_CALLS_LIMIT, help = "LLM calls in flight across all folders (default: %(default)s)")
+        command.add_argument("--rpm", type = int, default = ag.REQUESTS_PER_MINUTE, help = "LLM requests per minute across all folders (default: %(default)s)")
+        if name == "generate":
+            command.add_argument("folders", nargs = "+")
+            command.add_argument("--subject", help = "subject name for the prompt (default: the folder name)")
+            command.add_argument("--format", choices = list(EXPORT_FORMATS), default = "text")
+            command.add_argument("--out-dir", default = "./Decks")
+            command.add_argument("--no-dedup", action = "store_true", help = "keep near-duplicate questions")
+        else:
+            command.add_argument("questions", nargs = "*", help = "questions to ask (default: one per line on stdin)")
+            command.add_argument("--base", action = "append", required = True, help = "knowledge base to search, can be repeated")
+            command.add_argument("--vectors", choices = vc.VECTOR_KINDS, default = "flat", help = "vector storage to search with (default: %(default)s)")
+    return parser
+
+async def run_command(args, emitter: Emitter):
+    # Unbound if starting the trace fails (e.g. the profiler is unavailable), which must not hide that error
+    trace = None
+    try:
+        with tr.trace(args.command, profile = args.profile) as trace:
+            await COMMANDS[args.command](args, emitter)
+    finally:
+        # The pooled aiohttp session belongs to this loop, close it before asyncio.run tears the loop down
+        await hp.default_pool().aclose()
+        if trace is not None:
+            if args.trace:
+                trace.export(args.trace)
+            if trace.profile:
+                print(trace.profile, file = sys.stderr)
+
+def main(argv: List[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    out = open(args.output, "w") if args.output else sys.stdout
+    emitter = Emitter(out)
+    if hasattr(args, "concurrency"):
+        # One command runs one kind of call, so nothing needs slots kept free for interactive ones
+        sch.default_scheduler().configure(concurrency = args.concurrency, rpm = args.rpm, reserved = 0)
+    start = time.perf_counter()
+    try:
+        # Library code prints progress messages, keep them off the JSONL stream
+        with contextlib.redirect_stdout(sys.stderr):
+            asyncio.run(run_command(args, emitter))
+    except KeyError as e:
+        print(f"memora: {e.args[0]}", file = sys.stderr)
+        return 2
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    stats = emitter.summary(args.command, time.perf_counter() - start)
+    # Non-zero exit lets nightly jobs notice failed folders and chunks that produced no cards
+    return 1 if stats["errors"] or stats.get("lost_chunks") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import math
+import re
+from typing import List, Sequence, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+try:
+    from src.lexical import tokenize
+except ModuleNotFoundError:
+    from lexical import tokenize
+
+# Fraction of each chunk's sentences that is kept, never fewer than MIN_SENTENCES
+KEEP_RATIO = 0.3
+MIN_SENTENCES = 2
+GAP = " … "
+
+_SENTENCE = re.compile(r"[^.!?\n]+(?:[.!?]+[\"')\]]*|\n|$)")
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    # (start, end) character spans of the non-empty sentences in text
+    spans = []
+    for match in _SENTENCE.finditer(text):
+        start, end = match.span()
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            spans.append((start, end))
+    return spans
+
+def lexical_scores(sentences: Sequence[str], question: str) -> np.ndarray:
+    # Query-term overlap weighted by idf over the retrieved sentences, damped for long sentences
+    terms = list(dict.fromkeys(tokenize(question)))
+    tokens = [set(tokenize(s)) for s in sentences]
+    if not terms or not sentences:
+        return np.zeros(len(sentences), dtype = np.float32)
+    presence = np.array([[t in sent for sent in tokens] for t in terms], dtype = np.float32)
+    idf = np.log(1 + len(sentences) / (1 + presence.sum(axis = 1)))
+    lengths = np.array([len(sent) for sent in tokens], dtype = np.float32)
+    return (idf @ presence) / (1 + np.log1p(lengths))
+
+def compress_documents(docs: List[Document], question: str, keep_ratio: float = KEEP_RATIO) -> List[Document]:
+    # Keeps the sentences of each chunk that best match the question, in their original order. The full chunk and the
+    # kept spans in it go in metadata["original"] and metadata["spans"], so the sources view can highlight them.
+    # Scoring is lexical: it runs locally with no embedding calls, including on the exact-term fast path.
+    spans = [split_sentences(doc.page_content) for doc in docs]
+    sentences = [doc.page_content[s:e] for doc, doc_spans in zip(docs, spans) for s, e in doc_spans]
+    scores = lexical_scores(sentences, question)
+    compressed = []
+    offset = 0
+    for doc, doc_spans in zip(docs, spans):
+        doc_scores = scores[offset:offset + len(doc_spans)]
+        offset += len(doc_spans)
+        keep = max(MIN_SENTENCES, math.ceil(keep_ratio * len(doc_spans)))
+        if len(doc_spans) <= keep or not np.any(doc_scores > 0):
+            # Nothing to gain, or retrieved for meaning rather than wording: keep the chunk whole
+            compressed.append(doc)
+            continue
+        top = sorted(np.argsort(-doc_scores, kind = "stable")[:keep])
+        parts = []
+        for n, i in enumerate(top):
+            if n and i != top[n - 1] + 1:
+                parts.append(GAP)
+            elif n:
+                parts.append(" ")
+            start, end = doc_spans[i]
+            parts.append(doc.page_content[start:end])
+        metadata = {**doc.metadata, "spans": [doc_spans[i] for i in top], "original": doc.page_content}
+        compressed.append(Document(page_content = "".join(parts), metadata = metadata))
+    return compressed
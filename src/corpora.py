@@ -0,0 +1,157 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+try:
+    import src.el_professor as ep
+    from src.lexical import BM25Index, reciprocal_rank_fusion
+    from src.vectors import MMR_FETCH_FACTOR, MMR_LAMBDA, reconstruct, mmr_select
+    from src.resources import Handle, ResourceManager, default_manager
+except ModuleNotFoundError:
+    import el_professor as ep
+    from lexical import BM25Index, reciprocal_rank_fusion
+    from vectors import MMR_FETCH_FACTOR, MMR_LAMBDA, reconstruct, mmr_select
+    from resources import Handle, ResourceManager, default_manager
+
+SHARD_WORKERS = 8
+
+_search_pool = ThreadPoolExecutor(max_workers = SHARD_WORKERS, thread_name_prefix = "shard-search")
+
+@dataclass
+class Shard:
+    name: str
+    docstore: FAISS
+    lexical: BM25Index | None = None
+    # Pinned shards (prebuilt corpora) are never evicted
+    pinned: bool = False
+
+    @property
+    def ntotal(self) -> int:
+        return self.docstore.index.ntotal
+
+    def lexical_hits(self, question: str, k: int) -> List[Tuple[int, float]]:
+        return self.lexical.search(question, k = k) if self.lexical is not None else []
+
+    def candidates(self, embedding: np.ndarray, k: int, extra: List[int]) -> Tuple[np.ndarray, np.ndarray, List[int]]:
+        # Vector top-k plus the extra (lexical) positions, all scored by exact L2 distance so vector ranks are comparable across shards
+        _, indices = self.docstore.index.search(embedding[None, :], min(k, self.ntotal))
+        positions = [int(i) for i in indices[0] if i != -1]
+        seen = set(positions)
+        positions += [i for i in extra if i not in seen]
+        vectors = reconstruct(self.docstore.index, positions)
+        distances = ((vectors - embedding) ** 2).sum(axis = 1)
+        return distances, vectors, positions
+
+class CorpusRegistry:
+    # Process-wide set of searchable shards: prebuilt corpora, users' uploads and per-file shards.
+    # Shards live in a ResourceManager, so unreferenced ones count towards the server's memory budget.
+    def __init__(self, resources: ResourceManager | None = None):
+        self.resources = resources if resources is not None else default_manager()
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return f"corpus:{name}"
+
+    def register(self, name: str, docstore: FAISS, lexical: BM25Index | None = None, pinned: bool = False) -> Handle:
+        # Held, so the shard cannot be evicted before whoever registered it has a corpus holding it; an existing shard wins
+        return self.resources.acquire(self._key(name), lambda: Shard(name, docstore, lexical, pinned), pinned = pinned)
+
+    def hold(self, name: str) -> Handle | None:
+        try:
+            return self.resources.acquire(self._key(name))
+        except KeyError:
+            return None
+
+    def unregister(self, name: str):
+        self.resources.discard(self._key(name))
+
+    def __contains__(self, name: str) -> bool:
+        return self._key(name) in self.resources
+
+    def get(self, names: List[str]) -> List[Shard]:
+        shards = [self.resources.peek(self._key(name)) for name in names]
+        return [shard for shard in shards if shard is not None]
+
+    def acquire(self, names: List[str]) -> List[Handle]:
+        # Held shards are never evicted; names that are no longer registered are skipped
+        return [handle for handle in map(self.hold, names) if handle is not None]
+
+    def covers(self, version: str) -> bool:
+        # Whether every shard of a corpus version ("|"-joined shard names) is still registered
+        return all(name in self for name in version.split("|"))
+
+    def names(self) -> List[str]:
+        return [key[len(self._key("")):] for key in self.resources.keys(self._key(""))]
+
+class ShardedCorpus:
+    # Stands in for a single FAISS docstore in el_professor: retrieve_context delegates to retrieve()
+    def __init__(self, registry: CorpusRegistry, names: List[str]):
+        self.registry = registry
+        self.names = list(names)
+        # Whoever holds the corpus (a user's session) keeps its shards in memory
+        self._handles = registry.acquire(self.names)
+        # Shards evicted before the corpus could hold them; callers report these rather than answer without them
+        held = {handle.value.name for handle in self._handles}
+        self.missing = [name for name in self.names if name not in held]
+
+    @property
+    def shards(self) -> List[Shard]:
+        return [handle.value for handle in self._handles]
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def embedding_function(self):
+        return self.shards[0].docstore.embedding_function
+
+    def retrieve(self, question: str, speed: float = 0.52, lambda_mult: float = MMR_LAMBDA, compress: bool = True, embedding = None) -> List[Document]:
+        # retrieve_context across shards: the lexical fast path, then vector and per-shard BM25 ranks fused with RRF and re-ranked by MMR
+        shards = self.shards
+        if not shards:
+            return []
+        fetch_size = sum(shard.ntotal for shard in shards)
+        _k = round(fetch_size**speed) * (ep.COMPRESSED_K_FACTOR if compress else 1)
+        fetch = MMR_FETCH_FACTOR * _k
+        lexical = list(_search_pool.map(lambda shard: shard.lexical_hits(question, _k), shards))
+        # Exact-term questions skip the embedding round-trip, as long as only one shard has a hit with every term
+        covering = [s for s, hits in enumerate(lexical) if hits and shards[s].lexical.coverage(question, hits[0][0]) >= 1.0]
+        if len(covering) == 1 and shards[covering[0]].lexical.is_confident(question, lexical[covering[0]]):
+            docstore = shards[covering[0]].docstore
+            docs = ep._docs_at(docstore, [i for i, _ in lexical[covering[0]]])
+            return ep._fit_context(ep._expand_parents([(docstore, doc) for doc in docs]), question, fetch_size, speed, compress)
+        # All shards share one embedding model, so the question is embedded once (or not at all when the caller has it)
+        if embedding is None:
+            embedding = shards[0].docstore.embedding_function(question)
+        embedding = np.array(embedding, dtype = np.float32)
+        futures = [_search_pool.submit(shard.candidates, embedding, fetch, [i for i, _ in hits]) for shard, hits in zip(shards, lexical)]
+        rows = {}
+        for s, future in enumerate(futures):
+            distances, vectors, positions = future.result()
+            for j, position in enumerate(positions):
+                rows[(s, position)] = (float(distances[j]), vectors[j])
+        if not rows:
+            return []
+        candidates = heapq.nsmallest(fetch, rows, key = lambda key: rows[key][0])
+        relevance = None
+        rankings = [[(s, i) for i, _ in hits] for s, hits in enumerate(lexical) if hits]
+        if rankings:
+            # BM25 scores are not comparable across shards, their ranks are
+            fused = reciprocal_rank_fusion([candidates] + rankings)[:fetch]
+            candidates = [key for key, _ in fused]
+            scores = np.array([score for _, score in fused], dtype = np.float32)
+            relevance = scores / scores.max()
+        vectors = np.stack([rows[key][1] for key in candidates])
+        selected = mmr_select(vectors, embedding, _k, lambda_mult, relevance)
+        hits = []
+        for i in selected:
+            s, position = candidates[i]
+            docstore = shards[s].docstore
+            hits.extend((docstore, doc) for doc in ep._docs_at(docstore, [position]))
+        docs = ep._expand_parents(hits)
+        # One token budget shared by every shard
+        return ep._fit_context(docs, question, fetch_size, speed, compress)
@@ -0,0 +1,59 @@
+import contextlib
+import hmac
+import json
+import os
+from typing import Any, Callable, Dict, Iterator
+import streamlit as st
+try:
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import tracing as tr
+
+# Hidden sidebar panel with the stage breakdown of the session's last traced run. Off unless the server sets
+# MEMORA_DEBUG_TOKEN; then open any page with ?debug=<token>. The panel can switch profilers on, so it is not for visitors.
+DEBUG_PARAM = "debug"
+DEBUG_TOKEN = os.getenv("MEMORA_DEBUG_TOKEN", "")
+BREAKDOWN_COLUMNS = ("stage", "calls", "total_s", "self_s", "share")
+
+def enabled() -> bool:
+    if not DEBUG_TOKEN:
+        return False
+    given = st.experimental_get_query_params().get(DEBUG_PARAM, [""])[0]
+    return hmac.compare_digest(given.encode("utf-8"), DEBUG_TOKEN.encode("utf-8"))
+
+@contextlib.contextmanager
+def traced(name: str) -> Iterator[tr.Trace]:
+    # Runs that did any traced work become the session's last run; the profiler is picked in the panel
+    profile = st.session_state.get("profiler") if enabled() else None
+    with tr.trace(name, profile = profile) as trace:
+        yield trace
+    if trace.spans:
+        st.session_state.last_trace = trace.to_json()
+
+def remember(fetch: Callable[[], Dict[str, Any]]):
+    # For runs traced elsewhere (engine jobs); the engine only keeps its recent traces
+    if not enabled():
+        return
+    try:
+        st.session_state.last_trace = fetch()
+    except KeyError:
+        pass
+
+def render(profiling: bool = True):
+    if not enabled():
+        return
+    with st.sidebar.expander(":stopwatch: Last run", expanded = True):
+        if profiling:
+            st.selectbox("Profile the next run", [None, *tr.PROFILERS], key = "profiler", format_func = lambda p: p or "off")
+        else:
+            st.caption("Runs happen in the engine, set MEMORA_PROFILE there to profile them.")
+        trace = st.session_state.get("last_trace")
+        if trace is None:
+            st.caption("Nothing traced yet.")
+            return
+        st.caption(f"{trace['name']}: {trace['duration_s']:.2f} s over {len(trace['spans'])} spans")
+        st.table([{column: row[column] for column in BREAKDOWN_COLUMNS} for row in trace["breakdown"]])
+        st.download_button("Chrome trace", json.dumps(tr.chrome_trace(trace)), file_name = f"memora-{trace['id']}.trace.json", mime = "application/json")
+        st.download_button("Trace JSON", json.dumps(trace), file_name = f"memora-{trace['id']}.json", mime = "application/json")
+        if trace["profile"]:
+            st.code(trace["profile"], language = None)
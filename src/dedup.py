@@ -0,0 +1,107 @@
+import re
+import zlib
+from typing import List, Tuple
+import numpy as np
+try:
+    from src.generatorGPT import parse_qa_pairs
+except ModuleNotFoundError:
+    from generatorGPT import parse_qa_pairs
+
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 3
+JACCARD_THRESHOLD = 0.6
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 8
+COSINE_THRESHOLD = 0.92
+BATCH_SIZE = 2048
+
+# Largest 32-bit prime: a * h + b stays below 2**64 for 32-bit shingle hashes
+_PRIME = np.uint64(4294967291)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, int(_PRIME), size = NUM_PERM, dtype = np.uint64)
+_PERM_B = _rng.randint(0, int(_PRIME), size = NUM_PERM, dtype = np.uint64)
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    words = re.findall(r"\w+", text.casefold())
+    if len(words) < SHINGLE_SIZE:
+        shingles = [" ".join(words)]
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(sh.encode()) for sh in shingles), dtype = np.uint64)
+
+def minhash_signatures(texts: List[str]) -> np.ndarray:
+    signatures = np.empty((len(texts), NUM_PERM), dtype = np.uint64)
+    for start in range(0, len(texts), BATCH_SIZE):
+        batch = [_shingle_hashes(text) for text in texts[start:start + BATCH_SIZE]]
+        offsets = np.cumsum([0] + [len(h) for h in batch[:-1]])
+        hashes = np.concatenate(batch)
+        permuted = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _PRIME
+        signatures[start:start + len(batch)] = np.minimum.reduceat(permuted, offsets, axis = 1).T
+    return signatures
+
+def _band_candidates(keys: np.ndarray, bands: int) -> Tuple[np.ndarray, np.ndarray]:
+    # For every band, pair each row with the first row that landed in the same bucket
+    rows = keys.shape[1] // bands
+    left, right = [], []
+    for b in range(bands):
+        band = np.ascontiguousarray(keys[:, b * rows:(b + 1) * rows])
+        band = band.view(np.dtype((np.void, band.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(band, return_index = True, return_inverse = True)
+        reps = first[inverse]
+        mask = reps != np.arange(len(keys))
+        left.append(np.nonzero(mask)[0])
+        right.append(reps[mask])
+    if not left:
+        return np.empty(0, dtype = int), np.empty(0, dtype = int)
+    return np.concatenate(left), np.concatenate(right)
+
+def _simhash_keys(embeddings: np.ndarray) -> np.ndarray:
+    planes = np.random.RandomState(2).standard_normal((embeddings.shape[1], SIMHASH_BITS)).astype(np.float32)
+    return (embeddings @ planes > 0).astype(np.uint8)
+
+def _find(parent: np.ndarray, i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _union(parent: np.ndarray, left: np.ndarray, right: np.ndarray):
+    for i, j in zip(left.tolist(), right.tolist()):
+        root_i, root_j = _find(parent, i), _find(parent, j)
+        if root_i != root_j:
+            # Keep the earliest card of each cluster as its root
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+def near_duplicate_groups(questions: List[str], embeddings: np.ndarray | None = None,
+                          jaccard_threshold: float = JACCARD_THRESHOLD,
+                          cosine_threshold: float = COSINE_THRESHOLD) -> np.ndarray:
+    n = len(questions)
+    parent = np.arange(n)
+    if n < 2:
+        return parent
+    signatures = minhash_signatures(questions)
+    left, right = _band_candidates(signatures, BANDS)
+    similar = (signatures[left] == signatures[right]).mean(axis = 1) >= jaccard_threshold
+    _union(parent, left[similar], right[similar])
+    if embeddings is not None:
+        vectors = np.asarray(embeddings, dtype = np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+        left, right = _band_candidates(_simhash_keys(vectors), SIMHASH_BANDS)
+        similar = np.einsum("ij,ij->i", vectors[left], vectors[right]) >= cosine_threshold
+        _union(parent, left[similar], right[similar])
+    return np.array([_find(parent, i) for i in range(n)])
+
+def dedup_cards(cards: List[Tuple[str, str]], embeddings: np.ndarray | None = None,
+                jaccard_threshold: float = JACCARD_THRESHOLD,
+                cosine_threshold: float = COSINE_THRESHOLD) -> Tuple[List[Tuple[str, str]], int]:
+    groups = near_duplicate_groups([q for q, _ in cards], embeddings, jaccard_threshold, cosine_threshold)
+    kept = [card for i, card in enumerate(cards) if groups[i] == i]
+    return kept, len(cards) - len(kept)
+
+def dedup_bank(bank: str, embeddings: np.ndarray | None = None) -> Tuple[str, int]:
+    cards = [(q.strip(), a.strip()) for q, a in parse_qa_pairs(bank)]
+    if not cards:
+        return bank, 0
+    kept, removed = dedup_cards(cards, embeddings)
+    return "\n\n".join(f"Q: {q}\nA: {a}" for q, a in kept), removed
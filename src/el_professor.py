@@ -1,48 +1,125 @@
 # Path: RetrievalQA_MMR.py
+import html
 import os
+import contextvars
+import pickle
+import queue
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Iterator, Tuple
 from dotenv import load_dotenv
 from langchain.chains import LLMChain
+from langchain.docstore.document import Document
 from langchain.llms import OpenAI
 from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
+from langchain.memory import ConversationSummaryBufferMemory
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.embeddings.base import Embeddings
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chains import HypotheticalDocumentEmbedder
 from langchain.vectorstores import FAISS
+from langchain.callbacks.base import BaseCallbackHandler, CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 import tiktoken
+import numpy as np
 try:
     from src.processing import (
-        TOKEN_LIMIT, Dict, List, Document, 
-        get_pdfs, extract_text_loaders, text_splitter, initialise_llms, extract_text_from_docs
+        TOKEN_LIMIT, Dict, List,
+        get_pdfs, extract_text_loaders, text_splitter, initialise_llms, extract_text_from_docs, is_grounded,
+        split_parent_child
         )
     from src.RetrievalQA_mod import RetrievalQA
+    from src.lexical import BM25Index, reciprocal_rank_fusion
+    from src.vectors import MMR_FETCH_FACTOR, MMR_LAMBDA, reconstruct, mmr_select
+    from src.compression import compress_documents
+    import src.http_pool as hp
+    import src.tracing as tr
 except ModuleNotFoundError:
     from processing import *
     from RetrievalQA_mod import RetrievalQA
-
-# TO-DOS:
-# - Implement Conversational RetrievalQA
+    from lexical import BM25Index, reciprocal_rank_fusion
+    from vectors import MMR_FETCH_FACTOR, MMR_LAMBDA, reconstruct, mmr_select
+    from compression import compress_documents
+    import http_pool as hp
+    import tracing as tr
 
 load_dotenv()
 
+VDB_ROOT = "./VectorDBs"
+HISTORY_TOKEN_LIMIT = 500
+# Compressed chunks keep only their best-matching sentences, so this many times more chunks are retrieved
+COMPRESSED_K_FACTOR = 2
+# ...and they share a smaller prompt budget than uncompressed chunks
+COMPRESSED_TOKEN_LIMIT = TOKEN_LIMIT * 3 // 4
+# Only the start of each answer is kept in the history, so summarising old turns stays cheap
+ANSWER_MEMORY_CHARS = 1500
+
 def _make_fetch_size(docstore: FAISS) -> int:
+    if hasattr(docstore, "ntotal"):
+        return docstore.ntotal
     size = docstore.index.ntotal
     return size
 
-def _token_limiter(docstore: FAISS, question: str, fetch_size: int, _k: int) -> FAISS | bool:
-    docs = docstore.similarity_search(question, k = _k, fetch_k = fetch_size)
-    text = extract_text_from_docs(docs)
+@tr.traced("_token_limiter")
+def _token_limiter(docs: List[Document], fetch_size: int, speed: float) -> List[Document]:
+    # Shrinks k the same way as before, but over one ranked result list instead of re-searching
     enc = tiktoken.get_encoding("cl100k_base")
-    tokens = enc.encode(text)
-    if TOKEN_LIMIT > len(tokens):
-        return docstore
-    return False
+    total = 0
+    totals = []
+    for doc in docs:
+        total += len(enc.encode(doc.page_content)) + 1
+        totals.append(total)
+    _k = len(docs)
+    while _k > 1 and totals[_k - 1] >= TOKEN_LIMIT:
+        speed -= 0.025
+        _k = max(min(round(fetch_size**speed), len(docs)), 1)
+    return docs[:_k]
+
+def _fit_context(docs: List[Document], question: str, fetch_size: int, speed: float, compress: bool) -> List[Document]:
+    if not compress:
+        return _token_limiter(docs, fetch_size, speed)
+    # Compressed chunks are filled in rank order up to the token budget instead of shrinking k
+    enc = tiktoken.get_encoding("cl100k_base")
+    fitted = []
+    total = 0
+    with tr.span("compress_documents", docs = len(docs)):
+        compressed = compress_documents(docs, question)
+    for doc in compressed:
+        total += len(enc.encode(doc.page_content)) + 1
+        if fitted and total >= COMPRESSED_TOKEN_LIMIT:
+            break
+        fitted.append(doc)
+    return fitted
+
+def build_docstore(text: str, embed_type: Embeddings, source: str | None = None, **chunking) -> FAISS:
+    # Only the child chunks are embedded; parents sit in the same docstore under their own ids
+    parents, children = split_parent_child(text, source = source, **chunking)
+    with tr.span("FAISS.from_documents", chunks = len(children)):
+        docstore = FAISS.from_documents(documents = children, embedding = embed_type)
+    docstore.docstore.add({parent.metadata["id"]: parent for parent in parents})
+    return docstore
+
+def _expand_parents(hits: List[Tuple[FAISS, Document]]) -> List[Document]:
+    # Child chunks are swapped for their parent span, each parent once, in rank order;
+    # indices built before parent/child chunking pass through unchanged
+    docs = []
+    seen = set()
+    for docstore, doc in hits:
+        parent_id = doc.metadata.get("parent")
+        if parent_id is None:
+            docs.append(doc)
+            continue
+        if (id(docstore), parent_id) in seen:
+            continue
+        seen.add((id(docstore), parent_id))
+        parent = docstore.docstore.search(parent_id)
+        docs.append(parent if isinstance(parent, Document) else doc)
+    return docs
 
 def create_vdb(foldername: str, embed_type: Embeddings) -> FAISS:
     loaders = get_pdfs(foldername)
     text = extract_text_loaders(loaders)
-    chunks = text_splitter(text, docs = True)
-    docstore = FAISS.from_documents(documents = chunks, embedding = embed_type)
+    docstore = build_docstore(text, embed_type, source = foldername)
     return docstore
 
 def create_vdb_from_txts(foldername: str, embed_type: Embeddings) -> FAISS:
@@ -56,21 +133,33 @@ def create_vdb_from_txts(foldername: str, embed_type: Embeddings) -> FAISS:
     docstore = FAISS.from_texts(texts = bank, embedding = embed_type)
     return docstore
 
-def save_vdb(docstore: FAISS, foldername: str):
-    docstore.save_local(f"./VectorDBs/{foldername}.faiss")
+def save_vdb(docstore: FAISS, foldername: str, root: str = VDB_ROOT):
+    docstore.save_local(f"{root}/{foldername}.faiss")
+
+@tr.traced("load_vdb")
+def load_vdb(foldername: str, embed_type: Embeddings, root: str = VDB_ROOT) -> FAISS | None:
+    path = f"{root}/{foldername}.faiss"
+    if not (os.path.isfile(f"{path}/index.faiss") and os.path.isfile(f"{path}/index.pkl")):
+        return None
+    return FAISS.load_local(path, embeddings = embed_type)
 
 def choose_vdb(foldername: str, embed_type: Embeddings) -> FAISS:
     try:
-        # docstore = FAISS.load_local(f"./VectorDBs/{foldername}.faiss", hembeddings)
-        docstore = FAISS.load_local(f"./VectorDBs/{foldername}.faiss", embeddings = embed_type)
+        docstore = load_vdb(foldername, embed_type)
+    except (RuntimeError, OSError, EOFError, pickle.UnpicklingError) as e:
+        # faiss raises RuntimeError for unreadable indices, pickle errors mean a truncated docstore
+        print(f"Saved knowledge base '{foldername}' could not be loaded ({e})")
+        docstore = None
+    if docstore is not None:
         print("Loaded from file")
         return docstore
-    except:
-        docstore = create_vdb(foldername, embed_type)
-        print("Created new knowledge base")
-        return docstore
+    docstore = create_vdb(foldername, embed_type)
+    print("Created new knowledge base")
+    return docstore
 
+@lru_cache(maxsize = 8)
 def embed_type_chooser(embed_type: str, api_key: str = os.getenv("OPENAI_API_KEY")) -> Embeddings:
+    hp.default_pool()
     if embed_type in ["h", "H", "hypo"]:
         llm = OpenAI(temperature = 0, openai_api_key = api_key)
         hembeddings = HypotheticalDocumentEmbedder.from_llm(llm=llm, base_embeddings = base_embeddings, prompt_key = "web_search")
@@ -81,6 +170,7 @@ def embed_type_chooser(embed_type: str, api_key: str = os.getenv("OPENAI_API_KEY
         return base_embeddings
     raise ValueError("Invalid Embedding Type: Choose 'h' for Hypothetical Embeddings or 'o' for OpenAI Embeddings.")
 
+@lru_cache(maxsize = None)
 def _make_prompt_assist():
     system_template = """You will be provided with a chunk of context information, delimited by triple backticks. Use the context and your prior knowledge to understand the content fully.
     Your job is to answer the question that is based around the content of the given context. You may use your prior knowledge to explain further any ideas relevant to the qustion that are found in the context.
@@ -118,26 +208,173 @@ def _make_prompt_assist():
     final_prompt = ChatPromptTemplate.from_messages(messages)
     return final_prompt
 
-def answer_question(model, docstore: FAISS, question: str, speed: int = 0.52) -> Dict[str, List[Document]]:
+_STREAM_END = object()
+_STREAM_RESET = object()
+
+class _QueueCallbackHandler(StreamingStdOutCallbackHandler):
+    def __init__(self, tokens: queue.Queue):
+        self.tokens = tokens
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.put(token)
+
+    def reset(self):
+        self.tokens.put(_STREAM_RESET)
+
+class TokenStream:
+    # Iterating runs the chain on a worker thread and yields tokens as they arrive.
+    # Once exhausted, `text` holds the full completion and `result` the chain output.
+    def __init__(self, run: Callable[[BaseCallbackHandler], Any]):
+        self._run = run
+        self._tokens = queue.Queue()
+        self.text = ""
+        self.result = None
+        self.error = None
+
+    def _worker(self):
+        try:
+            self.result = self._run(_QueueCallbackHandler(self._tokens))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._tokens.put(_STREAM_END)
+
+    def __iter__(self) -> Iterator[str]:
+        # The worker runs in the caller's context so its spans land in the caller's trace
+        threading.Thread(target = contextvars.copy_context().run, args = (self._worker,), daemon = True).start()
+        while True:
+            token = self._tokens.get()
+            if token is _STREAM_END:
+                break
+            if token is _STREAM_RESET:
+                # The answer is being regenerated (e.g. escalated to a stronger model)
+                self.text = ""
+                yield ""
+                continue
+            self.text += token
+            yield token
+        if self.error is not None:
+            raise self.error
+
+def _streaming_model(model, handler: BaseCallbackHandler):
+    return model.copy(update = {"streaming": True, "callback_manager": CallbackManager([handler])})
+
+def _docs_at(docstore: FAISS, positions: List[int]) -> List[Document]:
+    return [docstore.docstore.search(docstore.index_to_docstore_id[i]) for i in positions]
+
+@tr.traced("retrieve_context")
+def retrieve_context(docstore: FAISS, question: str, speed: float = 0.52, lexical: BM25Index | None = None,
+                     lambda_mult: float = MMR_LAMBDA, compress: bool = True, embedding = None) -> List[Document]:
+    # `embedding`, when the caller already has the question's (e.g. from an answer cache lookup), saves embedding it again
+    if hasattr(docstore, "retrieve"):
+        # Multi-corpus searches (see corpora.ShardedCorpus) fan out and merge on their own
+        return docstore.retrieve(question, speed, lambda_mult, compress, embedding = embedding)
     fetch_size = _make_fetch_size(docstore)
-    _k = round(fetch_size**speed)
-    docstore_trimed = _token_limiter(docstore, question, fetch_size, _k)
-    while not docstore_trimed:
-        speed -= 0.025
-        _k = round(fetch_size**speed)
-        docstore_trimed = _token_limiter(docstore, question, fetch_size, _k)
+    _k = round(fetch_size**speed) * (COMPRESSED_K_FACTOR if compress else 1)
+    hits = []
+    if lexical is not None:
+        hits = lexical.search(question, k = _k)
+        if lexical.is_confident(question, hits):
+            # Exact-term questions: skip the embedding round-trip entirely
+            docs = _docs_at(docstore, [i for i, _ in hits])
+            return _fit_context(_expand_parents([(docstore, doc) for doc in docs]), question, fetch_size, speed, compress)
+    # Re-rank a bounded candidate pool with MMR so overlapping neighbouring chunks don't crowd the context
+    if embedding is None:
+        with tr.span("embed_query"):
+            embedding = docstore.embedding_function(question)
+    embedding = np.array([embedding], dtype = np.float32)
+    with tr.span("faiss.search", k = _k):
+        _, indices = docstore.index.search(embedding, min(MMR_FETCH_FACTOR * _k, fetch_size))
+    candidates = [int(i) for i in indices[0] if i != -1]
+    relevance = None
+    if lexical is not None:
+        fused = reciprocal_rank_fusion([candidates, [i for i, _ in hits]])[:MMR_FETCH_FACTOR * _k]
+        candidates = [i for i, _ in fused]
+        scores = np.array([score for _, score in fused], dtype = np.float32)
+        relevance = scores / scores.max()
+    with tr.span("mmr_select", candidates = len(candidates)):
+        selected = mmr_select(reconstruct(docstore.index, candidates), embedding[0], _k, lambda_mult, relevance)
+    docs = _docs_at(docstore, [candidates[i] for i in selected])
+    return _fit_context(_expand_parents([(docstore, doc) for doc in docs]), question, fetch_size, speed, compress)
+
+def answer_question(model, docstore: FAISS, question: str, speed: int = 0.52, docs: List[Document] | None = None, lexical: BM25Index | None = None,
+                    embedding = None) -> Dict[str, List[Document]]:
+    if docs is None:
+        docs = retrieve_context(docstore, question, speed, lexical, embedding = embedding)
     PROMPT = _make_prompt_assist()
     qachain = load_qa_chain(llm = model, chain_type = "stuff", prompt = PROMPT)
     rqa = RetrievalQA(combine_documents_chain = qachain,
-                      docstore = docstore_trimed,
+                      docstore = docstore,
                       return_source_documents = True,
-                      k = _k,
-                      fetch_size = fetch_size)
-    answer_and_sources = rqa({"query": question})
+                      k = len(docs),
+                      fetch_size = _make_fetch_size(docstore),
+                      docs = docs)
+    with tr.span("llm.answer", model = model.model_name, docs = len(docs)):
+        answer_and_sources = rqa({"query": question})
+    answer_and_sources["model_name"] = model.model_name
     print("Answer generated")
     # print(answer_and_sources["source_documents"])
     return answer_and_sources
 
+def answer_question_stream(model, docstore: FAISS, question: str, speed: int = 0.52, lexical: BM25Index | None = None, embedding = None) -> TokenStream:
+    def run(handler: BaseCallbackHandler) -> Dict[str, List[Document]]:
+        return answer_question(_streaming_model(model, handler), docstore, question, speed, lexical = lexical, embedding = embedding)
+    return TokenStream(run)
+
+def _cascade(fast_model, strong_model, docstore: FAISS, question: str, speed: float, lexical: BM25Index | None = None, on_escalate: Callable[[], None] | None = None,
+             embedding = None) -> Dict[str, List[Document]]:
+    docs = retrieve_context(docstore, question, speed, lexical, embedding = embedding)
+    answer_and_sources = answer_question(fast_model, docstore, question, speed, docs = docs)
+    if is_grounded(answer_and_sources["result"], extract_text_from_docs(docs)):
+        return answer_and_sources
+    print(f"Escalating to {strong_model.model_name}")
+    if on_escalate is not None:
+        on_escalate()
+    return answer_question(strong_model, docstore, question, speed, docs = docs)
+
+def answer_question_cascade(fast_model, strong_model, docstore: FAISS, question: str, speed: int = 0.52, lexical: BM25Index | None = None,
+                            embedding = None) -> Dict[str, List[Document]]:
+    return _cascade(fast_model, strong_model, docstore, question, speed, lexical, embedding = embedding)
+
+def answer_question_cascade_stream(fast_model, strong_model, docstore: FAISS, question: str, speed: int = 0.52, lexical: BM25Index | None = None,
+                                   embedding = None) -> TokenStream:
+    def run(handler: _QueueCallbackHandler) -> Dict[str, List[Document]]:
+        return _cascade(_streaming_model(fast_model, handler), _streaming_model(strong_model, handler),
+                        docstore, question, speed, lexical, on_escalate = handler.reset, embedding = embedding)
+    return TokenStream(run)
+
+def new_conversation(model, max_token_limit: int = HISTORY_TOKEN_LIMIT) -> ConversationSummaryBufferMemory:
+    memory = ConversationSummaryBufferMemory(llm = model, max_token_limit = max_token_limit)
+    return memory
+
+@lru_cache(maxsize = None)
+def _make_prompt_condense() -> ChatPromptTemplate:
+    template = """Given the conversation history and a follow up question, both delimited by triple backticks, rephrase the follow up question so that it is a standalone question that can be understood without the conversation history.
+    Keep any equations, symbols and key terms from the follow up question. If the follow up question is already a standalone question, return it unchanged.
+    Only output the standalone question.
+    ----------------
+    Conversation history: ```{history}```
+    ----------------
+    Follow up question: ```{question}```"""
+    prompt = ChatPromptTemplate.from_messages([HumanMessagePromptTemplate.from_template(template)])
+    return prompt
+
+def condense_followup(model, memory: ConversationSummaryBufferMemory, question: str) -> str:
+    # The history is a running summary plus the most recent turns, kept under memory.max_token_limit
+    history = memory.load_memory_variables({})["history"]
+    if not history:
+        return question
+    chain = LLMChain(llm = model, prompt = _make_prompt_condense())
+    standalone = chain.run(history = history, question = question).strip().strip("`").strip()
+    return standalone or question
+
+def remember_turn(memory: ConversationSummaryBufferMemory, question: str, answer: str):
+    memory.save_context({"input": question}, {"output": answer[:ANSWER_MEMORY_CHARS]})
+
 def get_sources(answer_and_sources: Dict[str, List[Document]]) -> str:
     sources = ""
     for source in answer_and_sources["source_documents"]:
@@ -145,7 +382,23 @@ def get_sources(answer_and_sources: Dict[str, List[Document]]) -> str:
     sources = " ".join(sources.split())
     return sources
 
-def regen_answer(answer: str, detail: int, model) -> str:
+def get_marked_sources(answer_and_sources: Dict[str, List[Document]]) -> str:
+    # Sources as HTML: each whole chunk, with the sentences compression kept for the prompt marked
+    paragraphs = []
+    for source in answer_and_sources["source_documents"]:
+        text = source.metadata.get("original", source.page_content)
+        parts = []
+        last = 0
+        for start, end in source.metadata.get("spans", []):
+            parts.append(html.escape(text[last:start]))
+            parts.append(f"<mark>{html.escape(text[start:end])}</mark>")
+            last = end
+        parts.append(html.escape(text[last:]))
+        paragraphs.append("<p>" + " ".join("".join(parts).split()) + "</p>")
+    return "\n\n".join(paragraphs)
+
+@lru_cache(maxsize = None)
+def _make_prompt_regen() -> ChatPromptTemplate:
     system_template = """Your job is to use your own knowledge and best judgement to increase the level of detail in the provided answer.
     The detail level is out of 10 and the higher the number, the more detail you should add. For reference, detail level of 10 should be the most detailed answer possible including comprehensive explainations of all relevant ideas and concepts.
     Make sure to explain what each term means in equations and include an explaination of any relevant keywords and ideas.
@@ -158,10 +411,18 @@ def regen_answer(answer: str, detail: int, model) -> str:
         SystemMessagePromptTemplate.from_template(system_template),
     ]
     prompt = ChatPromptTemplate.from_messages(messages)
-    chain = LLMChain(llm=model, prompt=prompt)
+    return prompt
+
+def regen_answer(answer: str, detail: int, model) -> str:
+    chain = LLMChain(llm=model, prompt=_make_prompt_regen())
     answer = chain.run(detail = detail, answer = answer)
     return answer
 
+def regen_answer_stream(answer: str, detail: int, model) -> TokenStream:
+    def run(handler: BaseCallbackHandler) -> str:
+        return regen_answer(answer, detail, _streaming_model(model, handler))
+    return TokenStream(run)
+
 
 # Main loop
 if __name__ == "__main__":
@@ -0,0 +1,328 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List
+try:
+    import src.processing as pr
+    import src.el_professor as ep
+    import src.generatorGPT as gen
+    import src.async_generator as ag
+    import src.corpora as cp
+    import src.dedup as dd
+    import src.knowledge_bases as kb
+    import src.lexical as lx
+    import src.semantic_cache as sc
+    import src.resources as rs
+    import src.http_pool as hp
+    import src.tracing as tr
+    import src.chunk_store as cs
+    import src.scheduler as sch
+except ModuleNotFoundError:
+    import processing as pr
+    import el_professor as ep
+    import generatorGPT as gen
+    import async_generator as ag
+    import corpora as cp
+    import dedup as dd
+    import knowledge_bases as kb
+    import lexical as lx
+    import semantic_cache as sc
+    import resources as rs
+    import http_pool as hp
+    import tracing as tr
+    import chunk_store as cs
+    import scheduler as sch
+
+# Set to the address of a running `memora-engine` to share one engine between several Streamlit processes
+ENGINE_URL = os.getenv("MEMORA_ENGINE_URL")
+RUNNING_JOBS = 4
+JOB_HISTORY = 200
+JOB_KINDS = {"flashcards": "QA", "guide": "guide"}
+# Guide segments are merged with this prompt after the per-chunk map step
+MERGE_PROMPT = "guide_merge"
+MODELS = ("gpt3_5", "gpt4", "auto")
+GUIDE_FOOTER = "Generated by Memora - Study Wise"
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    subject: str
+    total: int
+    model: str = "gpt3_5"
+    dedup: bool = True
+    state: str = "queued"
+    done: int = 0
+    result: str | None = None
+    lost: List[int] = field(default_factory = list)
+    removed: int = 0
+    error: str | None = None
+    created: float = field(default_factory = time.time)
+    finished: float | None = None
+    trace: str | None = None
+    stage: str = "generate"
+    reduce: Dict[str, Any] | None = None
+
+    @property
+    def pending(self) -> bool:
+        return self.state in ("queued", "running")
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+class Engine:
+    # Ingestion, indexing, generation and QA behind one async API. One engine owns the LLM clients, the job queue
+    # and the shared caches, whichever UI process is calling it. Its LLM calls go through the process-wide scheduler;
+    # concurrency, rpm and tpm, when given, set that scheduler's ceilings.
+    def __init__(self, api_key: str | None = None, root: str = ep.VDB_ROOT, vectors: str = "fp16",
+                 concurrency: int | None = None, rpm: int | None = None, tpm: int | None = None, running_jobs: int = RUNNING_JOBS,
+                 resources: rs.ResourceManager | None = None):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.chat3_5, self.chat4 = pr.initialise_llms_with_key(self.api_key)
+        self.knowledge_bases = kb.KnowledgeBaseManager(ep.embed_type_chooser("o", self.api_key), root = root, vectors = vectors)
+        self.resources = resources if resources is not None else rs.default_manager()
+        self.registry = cp.CorpusRegistry(self.resources)
+        self.answers = sc.SemanticAnswerCache()
+        self.scheduler = sch.default_scheduler()
+        self.scheduler.configure(concurrency = concurrency, rpm = rpm, tpm = tpm)
+        self._job_slots = asyncio.Semaphore(running_jobs)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._chains: Dict[tuple, Any] = {}
+
+    def _model(self, model: str):
+        return self.chat4 if model == "gpt4" else self.chat3_5
+
+    def _chain(self, model: str, prompt: str):
+        key = (model, prompt)
+        if key not in self._chains:
+            self._chains[key] = gen.initialise_chain_no_mem(self._model(model), type = prompt)
+        return self._chains[key]
+
+    # ------------------------------ Ingestion and indexing ------------------------------ #
+
+    async def chunks(self, files: Dict[str, bytes]) -> List[str]:
+        # Generation chunks, shared by content with every other caller that sends the same files
+        key = rs.content_key("chunks", *(part for file in files.items() for part in file))
+        def build():
+            return pr.generation_chunks(" ".join(pr.extract_text(name, data) for name, data in files.items()))
+        with tr.trace("chunks"), await asyncio.to_thread(self.resources.acquire, key, build) as handle:
+            return list(handle.value)
+
+    async def index(self, files: Dict[str, bytes]) -> List[str]:
+        with tr.trace("index"):
+            return await self._index(files)
+
+    async def _index(self, files: Dict[str, bytes]) -> List[str]:
+        # Shard names for ask(); files that can't be processed are skipped
+        names = []
+        for filename, data in files.items():
+            key = self.knowledge_bases.store.key(kb.file_hash(data))
+            name = f"shard:{key}"
+            if name not in self.registry:
+                try:
+                    # Kept in memory only; knowledge bases are what gets saved to disk
+                    key, docstore = await asyncio.to_thread(self.knowledge_bases.store.shard, filename, data, persist = False)
+                except IndexError:
+                    continue
+                with tr.span("BM25Index.from_faiss"):
+                    lexical = await asyncio.to_thread(lx.BM25Index.from_faiss, docstore)
+                self.registry.register(name, docstore, lexical).release()
+            names.append(name)
+        return names
+
+    async def open_base(self, name: str, owner: str = kb.LOCAL_OWNER) -> List[str]:
+        names = []
+        for key, docstore in await asyncio.to_thread(self.knowledge_bases.open, name, owner):
+            if f"shard:{key}" not in self.registry:
+                self.registry.register(f"shard:{key}", docstore, await asyncio.to_thread(lx.BM25Index.from_faiss, docstore)).release()
+            names.append(f"shard:{key}")
+        return names
+
+    # ------------------------------ Question answering ------------------------------ #
+
+    async def ask(self, question: str, shards: List[str], model: str = "gpt3_5") -> Dict[str, Any]:
+        with tr.trace("ask") as trace:
+            answer = await self._ask(question, shards, model)
+        return {**answer, "trace": trace.id}
+
+    async def _ask(self, question: str, shards: List[str], model: str) -> Dict[str, Any]:
+        if model not in MODELS:
+            raise ValueError(f"Unknown model '{model}', choose from {', '.join(MODELS)}")
+        corpus = cp.ShardedCorpus(self.registry, shards)
+        if not corpus.shards:
+            raise KeyError("None of the requested shards are loaded, index the files first")
+        if corpus.missing:
+            # Evicted since they were indexed; answering without them would silently ignore those files
+            raise KeyError(f"Shards no longer loaded, index their files again: {', '.join(corpus.missing)}")
+        version = "|".join(sorted(set(shards)))
+        self.answers.prune(self.registry.covers)
+        with tr.span("answer_cache.lookup"):
+            response, embedding = await asyncio.to_thread(self.answers.lookup, version, model, question, lambda: corpus.embedding_function(question))
+        cached = response is not None
+        if not cached:
+            # Interactive priority: the scheduler starts it ahead of any queued generation calls
+            if model == "auto":
+                response = await asyncio.to_thread(ep.answer_question_cascade, self.chat3_5, self.chat4, corpus, question, embedding = embedding)
+            else:
+                response = await asyncio.to_thread(ep.answer_question, self._model(model), corpus, question, embedding = embedding)
+            self.answers.put(version, model, question, response, embedding = embedding)
+        return {"answer": response["result"], "model": response.get("model_name", model), "cached": cached,
+                "sources": [doc.page_content for doc in response.get("source_documents", [])]}
+
+    # ------------------------------ Generation jobs ------------------------------ #
+
+    def submit(self, kind: str, chunks: List[str], subject: str, model: str = "gpt3_5", dedup: bool = True, session: str | None = None) -> Job:
+        # Must be called on the engine's event loop; the job keeps running if the submitting page reruns or disconnects.
+        # Jobs from one session share its turn in the scheduler's round robin; without a session each job gets its own.
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind '{kind}', choose from {', '.join(JOB_KINDS)}")
+        if model not in ("gpt3_5", "gpt4"):
+            raise ValueError("Generation jobs run on 'gpt3_5' or 'gpt4'")
+        job = Job(uuid.uuid4().hex, kind, subject, len(chunks), model, dedup)
+        self._jobs[job.id] = job
+        # A ChunkStore is read lazily while the job runs instead of being copied into a list
+        chunks = chunks if isinstance(chunks, cs.ChunkStore) else list(chunks)
+        with sch.context(session = session or job.id):
+            self._tasks[job.id] = asyncio.create_task(self._run(job, chunks))
+        self._forget_finished()
+        return job
+
+    async def _run(self, job: Job, chunks: List[str]):
+        with tr.trace(f"job:{job.kind}") as trace:
+            job.trace = trace.id
+            await self._run_traced(job, chunks)
+
+    async def _run_traced(self, job: Job, chunks: List[str]):
+        with tr.span("job.queued"):
+            await self._job_slots.acquire()
+        try:
+            job.state = "running"
+            progress = asyncio.Queue()
+            async def track():
+                while True:
+                    job.done = await progress.get()
+            tracker = asyncio.create_task(track())
+            try:
+                results, _ = await ag.gen_concurrent(chunks, self._chain(job.model, JOB_KINDS[job.kind]), job.subject, progress,
+                                                     limiter = self.scheduler)
+                job.lost = [i for i, result in enumerate(results) if result is None]
+                if job.kind == "guide":
+                    # Progress restarts for every merge round: done/total counts that round's calls
+                    def next_round(number: int, calls: int):
+                        job.stage, job.done, job.total = f"merging sections, round {number}", 0, calls
+                    sections, job.reduce = await ag.reduce_concurrent(results, self._chain(job.model, MERGE_PROMPT), job.subject, progress,
+                                                                      limiter = self.scheduler, on_round = next_round)
+                    job.result = "\n\n".join(sections) + "\n\n" + GUIDE_FOOTER
+                else:
+                    bank = " ".join(filter(None, results)).replace(". Q:", ".\n\nQ:")
+                    if job.dedup:
+                        with tr.span("dedup_bank"):
+                            bank, job.removed = dd.dedup_bank(bank)
+                    job.result = bank + "\n\n" + gen.AUTH_LINE
+                job.state = "failed" if chunks and len(job.lost) == len(chunks) else "done"
+                if job.state == "failed":
+                    job.error = "Every request failed, check the API key and rate limits"
+            except asyncio.CancelledError:
+                job.state = "cancelled"
+                raise
+            except Exception as e:
+                job.state = "failed"
+                job.error = f"{type(e).__name__}: {e}"
+            finally:
+                tracker.cancel()
+                job.finished = time.time()
+                self._tasks.pop(job.id, None)
+        finally:
+            self._job_slots.release()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.pending]
+        for job_id in finished[:max(0, len(self._jobs) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def job(self, job_id: str) -> Job:
+        return self._jobs[job_id]
+
+    def cancel(self, job_id: str) -> Job:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        return self._jobs[job_id]
+
+    async def wait(self, job_id: str, timeout: float | None = None) -> Job:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        return self._jobs[job_id]
+
+    def traces(self) -> List[Dict[str, Any]]:
+        return [{"id": t.id, "name": t.name, "created": t.created, "duration_s": round(t.duration, 4)} for t in tr.recent()]
+
+    def trace(self, trace_id: str) -> Dict[str, Any]:
+        return tr.find(trace_id).to_json()
+
+    def stats(self) -> Dict[str, Any]:
+        states: Dict[str, int] = {}
+        for job in self._jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {"jobs": states, "answer_cache": self.answers.stats(), "resources": self.resources.stats(),
+                "shards": len(self.registry.names()), "http": hp.default_pool().stats(), "scheduler": self.scheduler.stats()}
+
+class LocalClient:
+    # Synchronous access to an engine running on a background event loop in this process
+    def __init__(self, **engine_kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target = self._loop.run_forever, name = "memora-engine", daemon = True)
+        self._thread.start()
+        self.engine = self._call(self._create, engine_kwargs)
+
+    @staticmethod
+    async def _create(kwargs) -> Engine:
+        return Engine(**kwargs)
+
+    def _call(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self._loop).result()
+
+    async def _sync(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def chunks(self, files: Dict[str, bytes]) -> List[str]:
+        return self._call(self.engine.chunks, files)
+
+    def index(self, files: Dict[str, bytes]) -> List[str]:
+        return self._call(self.engine.index, files)
+
+    def ask(self, question: str, shards: List[str], model: str = "gpt3_5") -> Dict[str, Any]:
+        return self._call(self.engine.ask, question, shards, model)
+
+    def submit(self, kind: str, chunks: List[str], subject: str, model: str = "gpt3_5", dedup: bool = True, session: str | None = None) -> Dict[str, Any]:
+        return self._call(self._sync, self.engine.submit, kind, chunks, subject, model, dedup, session).to_json()
+
+    def job(self, job_id: str) -> Dict[str, Any]:
+        return self._call(self._sync, self.engine.job, job_id).to_json()
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        return self._call(self._sync, self.engine.cancel, job_id).to_json()
+
+    def trace(self, trace_id: str) -> Dict[str, Any]:
+        return self._call(self._sync, self.engine.trace, trace_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._call(self._sync, self.engine.stats)
+
+@lru_cache(maxsize = 8)
+def connect(url: str | None = ENGINE_URL, api_key: str | None = None):
+    # One client per process: HTTP to a shared engine when a URL is configured, otherwise an in-process engine
+    if url:
+        try:
+            from src.engine_server import HTTPClient
+        except ModuleNotFoundError:
+            from engine_server import HTTPClient
+        return HTTPClient(url)
+    return LocalClient(api_key = api_key)
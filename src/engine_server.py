@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import base64
+import json
+from typing import Any, Dict, Iterable, Iterator, List
+import requests
+from aiohttp import web
+try:
+    from src.engine import JOB_KINDS, Engine
+    from src.scheduler import CONCURRENCY, RPM, TPM
+    from src.el_professor import VDB_ROOT
+    from src.knowledge_bases import LOCAL_OWNER
+    import src.chunk_store as cs
+except ModuleNotFoundError:
+    from engine import JOB_KINDS, Engine
+    from scheduler import CONCURRENCY, RPM, TPM
+    from el_professor import VDB_ROOT
+    from knowledge_bases import LOCAL_OWNER
+    import chunk_store as cs
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+CLIENT_TIMEOUT = 600
+# Chunks per piece of a streamed job body
+STREAM_BATCH = 64
+
+# Local HTTP front for one Engine, so several Streamlit processes share its caches, LLM scheduler and job queue.
+# Files travel as base64 strings in JSON: {"files": {"notes.pdf": "<base64>"}}. Chunks spilled to a ChunkStore are
+# streamed to POST /jobs/stream as JSON lines instead, and the engine spills them to its own store as they arrive.
+
+def _files(body: dict) -> Dict[str, bytes]:
+    return {name: base64.b64decode(data) for name, data in body.get("files", {}).items()}
+
+def _lines(chunks: Iterable[str], batch: int = STREAM_BATCH) -> Iterator[bytes]:
+    lines = []
+    for chunk in chunks:
+        lines.append(json.dumps(chunk, ensure_ascii = False) + "\n")
+        if len(lines) == batch:
+            yield "".join(lines).encode("utf-8")
+            lines = []
+    if lines:
+        yield "".join(lines).encode("utf-8")
+
+async def _receive_chunks(request) -> "cs.ChunkStore":
+    # A JSON-lines body written to a ChunkStore as it arrives, so no more than a piece of it is held at once
+    writer = cs.ChunkWriter()
+    try:
+        buffer = b""
+        async for data in request.content.iter_any():
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    writer.add(json.loads(line))
+        if buffer.strip():
+            writer.add(json.loads(buffer))
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+def build_app(engine: Engine) -> web.Application:
+    routes = web.RouteTableDef()
+
+    @routes.post("/chunks")
+    async def chunks(request):
+        return web.json_response({"chunks": await engine.chunks(_files(await request.json()))})
+
+    @routes.post("/index")
+    async def index(request):
+        return web.json_response({"shards": await engine.index(_files(await request.json()))})
+
+    @routes.post("/bases/{name}/open")
+    async def open_base(request):
+        body = await request.json() if request.can_read_body else {}
+        return web.json_response({"shards": await engine.open_base(request.match_info["name"], body.get("owner", LOCAL_OWNER))})
+
+    @routes.post("/ask")
+    async def ask(request):
+        body = await request.json()
+        if not body.get("question") or not body.get("shards"):
+            raise ValueError("'question' and 'shards' are required")
+        return web.json_response(await engine.ask(body["question"], body["shards"], body.get("model", "gpt3_5")))
+
+    @routes.post("/jobs")
+    async def submit(request):
+        body = await request.json()
+        if not body.get("subject"):
+            raise ValueError("'subject' is required")
+        chunks = body["chunks"] if "chunks" in body else await engine.chunks(_files(body))
+        job = engine.submit(body.get("kind", "flashcards"), chunks, body["subject"], body.get("model", "gpt3_5"), body.get("dedup", True), body.get("session"))
+        return web.json_response(job.to_json(), status = 202)
+
+    @routes.post("/jobs/stream")
+    async def submit_stream(request):
+        # Same as POST /jobs with the options in the query string and the chunks as JSON lines in the body
+        query = request.query
+        if not query.get("subject"):
+            raise ValueError("'subject' is required")
+        chunks = await _receive_chunks(request)
+        job = engine.submit(query.get("kind", "flashcards"), chunks, query["subject"], query.get("model", "gpt3_5"),
+                            query.get("dedup", "true") == "true", query.get("session"))
+        return web.json_response(job.to_json(), status = 202)
+
+    @routes.get("/jobs/{job_id}")
+    async def job(request):
+        return web.json_response(engine.job(request.match_info["job_id"]).to_json())
+
+    @routes.delete("/jobs/{job_id}")
+    async def cancel(request):
+        return web.json_response(engine.cancel(request.match_info["job_id"]).to_json())
+
+    @routes.get("/traces")
+    async def traces(request):
+        return web.json_response(engine.traces())
+
+    @routes.get("/traces/{trace_id}")
+    async def trace(request):
+        return web.json_response(engine.trace(request.match_info["trace_id"]))
+
+    @routes.get("/stats")
+    async def stats(request):
+        return web.json_response(engine.stats())
+
+    @web.middleware
+    async def errors(request, handler):
+        try:
+            return await handler(request)
+        except KeyError as e:
+            return web.json_response({"error": f"Not found: {e}"}, status = 404)
+        except (ValueError, TypeError) as e:
+            return web.json_response({"error": f"{type(e).__name__}: {e}"}, status = 400)
+
+    app = web.Application(middlewares = [errors], client_max_size = 200 * 2**20)
+    app.add_routes(routes)
+    return app
+
+class HTTPClient:
+    # Same methods as engine.LocalClient, against a running memora-engine
+    def __init__(self, url: str, timeout: float = CLIENT_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _request(self, method: str, path: str, body: dict | None = None, **kwargs) -> Any:
+        response = self.session.request(method, self.url + path, json = body, timeout = self.timeout, **kwargs)
+        if response.status_code == 404:
+            raise KeyError(response.json().get("error", path))
+        if response.status_code == 400:
+            raise ValueError(response.json().get("error", path))
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _encode(files: Dict[str, bytes]) -> Dict[str, str]:
+        return {name: base64.b64encode(data).decode("ascii") for name, data in files.items()}
+
+    def chunks(self, files: Dict[str, bytes]) -> List[str]:
+        return self._request("POST", "/chunks", {"files": self._encode(files)})["chunks"]
+
+    def index(self, files: Dict[str, bytes]) -> List[str]:
+        return self._request("POST", "/index", {"files": self._encode(files)})["shards"]
+
+    def ask(self, question: str, shards: List[str], model: str = "gpt3_5") -> Dict[str, Any]:
+        return self._request("POST", "/ask", {"question": question, "shards": shards, "model": model})
+
+    def submit(self, kind: str, chunks: List[str], subject: str, model: str = "gpt3_5", dedup: bool = True, session: str | None = None) -> Dict[str, Any]:
+        if isinstance(chunks, cs.ChunkStore):
+            # Read from disk and sent a batch at a time rather than copied into one JSON body
+            params = {"kind": kind, "subject": subject, "model": model, "dedup": "true" if dedup else "false"}
+            if session is not None:
+                params["session"] = session
+            return self._request("POST", "/jobs/stream", params = params, data = _lines(chunks))
+        return self._request("POST", "/jobs", {"kind": kind, "chunks": list(chunks), "subject": subject, "model": model, "dedup": dedup, "session": session})
+
+    def job(self, job_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def trace(self, trace_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/traces/{trace_id}")
+
+    def stats(self) -> Dict[str, Any]:
+        return self._request("GET", "/stats")
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, **engine_kwargs) -> web.AppRunner:
+    runner = web.AppRunner(build_app(Engine(**engine_kwargs)))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(prog = "memora-engine", description = "Serve one shared Memora engine to several UI processes (set MEMORA_ENGINE_URL in each).")
+    parser.add_argument("--host", default = DEFAULT_HOST, help = "default: %(default)s, keep it local, there is no authentication")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT, help = "default: %(default)s")
+    parser.add_argument("--vdb-root", default = VDB_ROOT, help = "where shards and knowledge bases are saved (default: %(default)s)")
+    parser.add_argument("--concurrency", type = int, default = CONCURRENCY, help = "LLM calls in flight across all clients (default: %(default)s)")
+    parser.add_argument("--rpm", type = int, default = RPM, help = "LLM requests per minute across all clients (default: %(default)s)")
+    parser.add_argument("--tpm", type = int, default = TPM, help = "LLM tokens per minute across all clients (default: %(default)s)")
+    args = parser.parse_args(argv)
+    async def run():
+        runner = await serve(args.host, args.port, root = args.vdb_root, concurrency = args.concurrency, rpm = args.rpm, tpm = args.tpm)
+        print(f"Memora engine on http://{args.host}:{args.port} (job kinds: {', '.join(JOB_KINDS)})")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
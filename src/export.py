@@ -0,0 +1,172 @@
+import csv
+import hashlib
+import html
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+try:
+    from src.generatorGPT import AUTH_LINE, iter_qa_pairs
+except ModuleNotFoundError:
+    from generatorGPT import AUTH_LINE, iter_qa_pairs
+
+# Raw decks are written in pieces of this many characters
+WRITE_CHUNK = 1024 * 1024
+BATCH_SIZE = 1000
+
+EXPORT_FORMATS = {
+    "Text (Q/A)": (".txt", "text/plain"),
+    "Anki text (::)": (".txt", "text/plain"),
+    "CSV": (".csv", "text/csv"),
+    "JSONL": (".jsonl", "application/jsonl"),
+    "Anki package (.apkg)": (".apkg", "application/octet-stream"),
+}
+
+def _batched(cards: Iterable[Tuple[str, str]], size: int = BATCH_SIZE) -> Iterator[List[Tuple[str, str]]]:
+    batch = []
+    for card in cards:
+        batch.append(card)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _write_raw(text: str, fp: io.TextIOBase, chunk_size: int = WRITE_CHUNK):
+    for start in range(0, len(text), chunk_size):
+        fp.write(text[start:start + chunk_size])
+
+def write_anki_text(cards: Iterable[Tuple[str, str]], fp: io.TextIOBase):
+    fp.write("Question::Answer\n" + ("-" * 160) + "\n")
+    for batch in _batched(cards):
+        fp.write("".join(f"{q}::{a}\n" for q, a in batch))
+    fp.write("\n" + AUTH_LINE)
+
+def write_csv(cards: Iterable[Tuple[str, str]], fp: io.TextIOBase):
+    writer = csv.writer(fp)
+    writer.writerow(["Question", "Answer"])
+    for batch in _batched(cards):
+        writer.writerows(batch)
+
+def write_jsonl(cards: Iterable[Tuple[str, str]], fp: io.TextIOBase):
+    for batch in _batched(cards):
+        fp.write("".join(json.dumps({"question": q, "answer": a}, ensure_ascii = False) + "\n" for q, a in batch))
+
+# ------------------------------ Anki package ------------------------------ #
+
+_ANKI_SCHEMA = """
+CREATE TABLE col (id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null, dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null, decks text not null, dconf text not null, tags text not null);
+CREATE TABLE notes (id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null, tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null, data text not null);
+CREATE TABLE cards (id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null, usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null, factor integer not null, reps integer not null, lapses integer not null, left integer not null, odue integer not null, odid integer not null, flags integer not null, data text not null);
+CREATE TABLE revlog (id integer primary key, cid integer not null, usn integer not null, ivl integer not null, lastIvl integer not null, factor integer not null, time integer not null, type integer not null);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+"""
+
+def _stable_id(name: str) -> int:
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:12], 16) % (1 << 40) + (1 << 40)
+
+def _anki_collection(deck_name: str, deck_id: int, model_id: int, now: int) -> Tuple:
+    model = {
+        "id": model_id, "name": "Memora Basic", "type": 0, "mod": now, "usn": -1, "sortf": 0, "did": deck_id,
+        "tmpls": [{"name": "Card 1", "ord": 0, "qfmt": "{{Question}}", "afmt": "{{FrontSide}}<hr id=answer>{{Answer}}",
+                   "did": None, "bqfmt": "", "bafmt": ""}],
+        "flds": [{"name": name, "ord": i, "sticky": False, "rtl": False, "font": "Arial", "size": 20, "media": []}
+                 for i, name in enumerate(["Question", "Answer"])],
+        "css": ".card { font-family: arial; font-size: 20px; text-align: left; }",
+        "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n",
+        "latexPost": "\\end{document}", "tags": [], "vers": [], "req": [[0, "all", [0]]],
+    }
+    def deck(did: int, name: str) -> dict:
+        return {"id": did, "name": name, "mod": now, "usn": -1, "lrnToday": [0, 0], "revToday": [0, 0],
+                "newToday": [0, 0], "timeToday": [0, 0], "collapsed": False, "desc": "", "dyn": 0, "conf": 1,
+                "extendNew": 10, "extendRev": 50}
+    dconf = {"1": {"id": 1, "name": "Default", "mod": 0, "usn": 0, "maxTaken": 60, "autoplay": True, "timer": 0,
+                   "replayq": True, "dyn": False,
+                   "new": {"delays": [1, 10], "ints": [1, 4, 7], "initialFactor": 2500, "order": 1, "perDay": 20, "bury": True, "separate": True},
+                   "rev": {"perDay": 100, "ease4": 1.3, "fuzz": 0.05, "maxIvl": 36500, "bury": True, "minSpace": 1},
+                   "lapse": {"delays": [10], "mult": 0, "minInt": 1, "leechFails": 8, "leechAction": 0}}}
+    conf = {"nextPos": 1, "estTimes": True, "activeDecks": [1], "sortType": "noteFld", "timeLim": 0,
+            "sortBackwards": False, "addToCur": True, "curDeck": 1, "newBury": True, "newSpread": 0,
+            "dueCounts": True, "curModel": str(model_id), "collapseTime": 1200}
+    decks = {"1": deck(1, "Default"), str(deck_id): deck(deck_id, deck_name)}
+    return (1, now, now * 1000, now * 1000, 11, 0, 0, 0, json.dumps(conf), json.dumps({str(model_id): model}),
+            json.dumps(decks), json.dumps(dconf), "{}")
+
+def _anki_field(text: str) -> str:
+    return html.escape(text).replace("\n", "<br>")
+
+def write_apkg(cards: Iterable[Tuple[str, str]], fp: BinaryIO, deck_name: str = "Memora"):
+    now = int(time.time())
+    deck_id = _stable_id("deck:" + deck_name)
+    model_id = _stable_id("model:Memora Basic")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "collection.anki2")
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.executescript(_ANKI_SCHEMA)
+            conn.execute("INSERT INTO col VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", _anki_collection(deck_name, deck_id, model_id, now))
+            position = 0
+            for batch in _batched(cards):
+                notes, anki_cards = [], []
+                for q, a in batch:
+                    # Ids and guid come from the deck, position and question, so re-exporting a deck updates its notes
+                    # in Anki while another deck (or the same question elsewhere) never collides with them
+                    identity = f"note:{deck_name}:{position}:{q}"
+                    note_id = _stable_id(identity)
+                    guid = hashlib.sha1(identity.encode("utf-8")).hexdigest()[:10]
+                    sort_field = _anki_field(q)
+                    checksum = int(hashlib.sha1(sort_field.encode("utf-8")).hexdigest()[:8], 16)
+                    notes.append((note_id, guid, model_id, now, -1, "", sort_field + "\x1f" + _anki_field(a),
+                                  sort_field, checksum, 0, ""))
+                    anki_cards.append((note_id, note_id, deck_id, 0, now, -1, 0, 0, position, 0, 0, 0, 0, 0, 0, 0, 0, ""))
+                    position += 1
+                conn.executemany("INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)", notes)
+                conn.executemany("INSERT INTO cards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", anki_cards)
+            conn.commit()
+        finally:
+            conn.close()
+        with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as package:
+            package.write(db_path, "collection.anki2")
+            package.writestr("media", "{}")
+
+# ------------------------------ Entry point ------------------------------ #
+
+# The stored deck is already in this format, so it is passed through untouched
+RAW_FORMAT = "Text (Q/A)"
+_TEXT_WRITERS = {
+    "Anki text (::)": write_anki_text,
+    "CSV": write_csv,
+    "JSONL": write_jsonl,
+}
+
+def write_deck(text: str, fmt: str, out: BinaryIO, deck_name: str = "Memora"):
+    # Streams the deck into a binary file, e.g. straight to disk for the CLI
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid export format: choose one of {', '.join(EXPORT_FORMATS)}")
+    if fmt != RAW_FORMAT and fmt not in _TEXT_WRITERS:
+        write_apkg(iter_qa_pairs(text), out, deck_name)
+        return
+    wrapper = io.TextIOWrapper(out, encoding = "utf-8", newline = "")
+    if fmt == RAW_FORMAT:
+        _write_raw(text, wrapper)
+    else:
+        _TEXT_WRITERS[fmt](iter_qa_pairs(text), wrapper)
+    wrapper.flush()
+    wrapper.detach()
+
+def export_deck(text: str, fmt: str, deck_name: str = "Memora") -> bytes:
+    # Bytes for st.download_button, which only takes str, bytes or in-memory buffers and reads them whole anyway
+    out = io.BytesIO()
+    write_deck(text, fmt, out, deck_name)
+    return out.getvalue()
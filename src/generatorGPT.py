@@ -1,17 +1,41 @@
+import logging
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 from langchain import PromptTemplate, LLMChain
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain.callbacks import get_openai_callback
 from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
 try:
-    from src.processing import initialise_llms, get_pdfs, extract_text_loaders, text_splitter
+    from src.processing import initialise_llms, get_pdfs, extract_text_loaders, generation_chunks, is_grounded
+    import src.scheduler as sch
+    import src.tracing as tr
 except ModuleNotFoundError:
-    from processing import initialise_llms, get_pdfs, extract_text_loaders, text_splitter
+    from processing import initialise_llms, get_pdfs, extract_text_loaders, generation_chunks, is_grounded
+    import scheduler as sch
+    import tracing as tr
 
 bank = ""
 progress = 0
 cost = 0
 
+EXPLAIN_CACHE_SIZE = 512
+# Explanations are meant to expand on the card, so less of their wording comes from it
+EXPLAIN_GROUNDING_THRESHOLD = 0.2
+PREFETCH_WORKERS = 2
+# One explain chain per client object (processing.initialise_llms_with_key keeps 8 key pairs)
+EXPLAIN_CHAINS = 16
+
+# id(client) -> (client, chain); holding the client keeps its id from being reused
+_explain_chains: "OrderedDict[int, Tuple[object, LLMChain]]" = OrderedDict()
+_explanations: "OrderedDict[Tuple[str, str, str, str], str]" = OrderedDict()
+_pending_explanations: Dict[Tuple[str, str, str, str], Future] = {}
+_explain_lock = threading.Lock()
+_prefetch_pool = ThreadPoolExecutor(max_workers = PREFETCH_WORKERS, thread_name_prefix = "explain-prefetch")
+log = logging.getLogger(__name__)
+
 def _make_prompt_gen(type: str) -> HumanMessagePromptTemplate:
     if type == "QA":
         human_prompt = HumanMessagePromptTemplate(
@@ -65,6 +89,27 @@ def _make_prompt_gen(type: str) -> HumanMessagePromptTemplate:
                 input_variables = ["subject", "num" ,"chunk"],
                 )
         )
+    elif type == "guide_merge":
+        human_prompt = HumanMessagePromptTemplate(
+            prompt = PromptTemplate(
+                template= """Task: Given consecutive learning guide segments and a specified subject or module name, both delimited by triple backticks, merge the segments into one consolidated learning guide section.
+                The segments appear in the order of the original notes and are separated by lines of dashes. Keep that order, combine overlapping explanations, remove repetition and keep every key equation, definition and fact.
+                Keep at most the best two practice questions, with their correct answers, from each segment.
+                The merged section must be no longer than the longest input segment, so condense wording rather than dropping concepts.
+                The output should follow the specified output format.
+                ----------------------------------------
+                Output Format: Keep equations in a printable format, each on its own line.
+                Give the section a sensible and clear title and number it with the provided section number, then use numbered subheadings for its parts.
+                DO NOT include any information that includes (cid...) tags.
+                ----------------------------------------
+                Subject or module name: ```{subject}```
+                ----------------------------------------
+                Section number: ```{num}```
+                ----------------------------------------
+                Segments: ```{chunk}```""",
+                input_variables = ["subject", "num" ,"chunk"],
+                )
+        )
     elif type == "explain":
         human_prompt = HumanMessagePromptTemplate(
             prompt = PromptTemplate(
@@ -113,7 +158,7 @@ def _make_prompt_gen(type: str) -> HumanMessagePromptTemplate:
             #     )
         )        
     else:
-        raise ValueError("Invalid type has to be either 'QA', 'guide' or 'explain'")
+        raise ValueError("Invalid type has to be either 'QA', 'guide', 'guide_merge' or 'explain'")
     return human_prompt
 
 def initialise_chain_no_mem(chat, type: str = "QA") -> LLMChain:
@@ -122,30 +167,116 @@ def initialise_chain_no_mem(chat, type: str = "QA") -> LLMChain:
     chain = LLMChain(llm=chat, prompt=chat_prompt)
     return chain
 
-def regen_answer_gen(question: str, answer: str, model) -> str:
-    human_prompt = _make_prompt_gen("explain")
-    chat_prompt = ChatPromptTemplate.from_messages([human_prompt])
-    chain = LLMChain(llm = model, prompt = chat_prompt)
-    answer = chain.run(answer = answer, question = question)
-    return answer
+def _model_key(model) -> str:
+    return getattr(model, "model_name", type(model).__name__)
 
-def anki_formatter(text: str) -> str:
-    auth_line = "\nGenerated by Memora - Study Wise"
-    qna_list = []
+def get_explain_chain(model) -> LLMChain:
+    # Keyed on the client itself, so a client with another API key, timeout or temperature gets its own chain
+    key = id(model)
+    with _explain_lock:
+        entry = _explain_chains.get(key)
+        if entry is not None and entry[0] is model:
+            _explain_chains.move_to_end(key)
+            return entry[1]
+        chain = initialise_chain_no_mem(model, type = "explain")
+        _explain_chains[key] = (model, chain)
+        while len(_explain_chains) > EXPLAIN_CHAINS:
+            _explain_chains.popitem(last = False)
+    return chain
+
+def _explain_key(model, card: str, answer: str, question: str, strong_model = None) -> Tuple[str, str, str, str]:
+    model_key = _model_key(model)
+    if strong_model is not None:
+        model_key += ">" + _model_key(strong_model)
+    return (model_key, card.strip(), answer.strip(), (question or "").strip())
+
+def _claim_explanation(key) -> Tuple[str | None, Future | None, bool]:
+    # Returns (cached explanation, in-flight future, whether the caller owns the future)
+    with _explain_lock:
+        if key in _explanations:
+            _explanations.move_to_end(key)
+            return _explanations[key], None, False
+        future = _pending_explanations.get(key)
+        if future is not None:
+            return None, future, False
+        future = Future()
+        _pending_explanations[key] = future
+        return None, future, True
+
+def _compute_explanation(key, model, strong_model, answer: str, question: str, future: Future) -> str:
+    try:
+        with tr.span("llm.explain", model = _model_key(model)):
+            explanation = get_explain_chain(model).run(answer = answer, question = question)
+        if strong_model is not None and not is_grounded(explanation, f"{question}\n{answer}", EXPLAIN_GROUNDING_THRESHOLD):
+            with tr.span("llm.explain", model = _model_key(strong_model)):
+                explanation = get_explain_chain(strong_model).run(answer = answer, question = question)
+    except BaseException as e:
+        with _explain_lock:
+            _pending_explanations.pop(key, None)
+        future.set_exception(e)
+        raise
+    with _explain_lock:
+        _explanations[key] = explanation
+        while len(_explanations) > EXPLAIN_CACHE_SIZE:
+            _explanations.popitem(last = False)
+        _pending_explanations.pop(key, None)
+    future.set_result(explanation)
+    return explanation
+
+def regen_answer_gen(question: str, answer: str, model, card: str = "", strong_model = None) -> str:
+    # With a strong_model, the explanation escalates to it when the first one fails the grounding check
+    key = _explain_key(model, card, answer, question, strong_model)
+    explanation, future, owner = _claim_explanation(key)
+    if explanation is not None:
+        return explanation
+    if not owner:
+        return future.result()
+    return _compute_explanation(key, model, strong_model, answer, question, future)
+
+def prefetch_explanation(card: str, answer: str, model, question: str = "", strong_model = None) -> bool:
+    key = _explain_key(model, card, answer, question, strong_model)
+    _, future, owner = _claim_explanation(key)
+    if not owner:
+        return False
+    # Prefetches run at the lowest priority, after every explanation someone is waiting for
+    task = _prefetch_pool.submit(sch.copy_context(priority = sch.BACKGROUND).run, _compute_explanation, key, model, strong_model, answer, question, future)
+    task.add_done_callback(_log_prefetch_failure)
+    return True
+
+def _log_prefetch_failure(task: Future):
+    # Nobody waits on a prefetch, so its failure (rate limit, bad key) would otherwise go unseen until a user asks
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("Explanation prefetch failed: %r", task.exception())
+
+def clear_explanations():
+    with _explain_lock:
+        _explanations.clear()
+
+AUTH_LINE = "Generated by Memora - Study Wise"
+_QA_PATTERN = re.compile(r'Q: (.*?)\nA: (.*?)(?=\n\nQ: |\Z)', re.DOTALL)
+
+def iter_qa_pairs(text: str) -> Iterator[Tuple[str, str]]:
     # qna_pairs = re.findall(r'Q: (.*?)\nA: (.*?)\n', text, re.DOTALL)
-    qna_pairs = re.findall(r'Q: (.*?)\nA: (.*?)(?=\n\nQ: |\Z)', text, re.DOTALL)
-    for q, a in qna_pairs:
-        qna_list.append({"Question": q.strip(), "Answer": a.strip()})
-    formatted_output = "Question".ljust(80) + "::" + "Answer\n" + ("-" * 160) + "\n"
-    for qna in qna_list:
-        formatted_output += qna["Question"].ljust(80) + "::" + qna["Answer"] + "\n"
+    text = text.rstrip()
+    if text.endswith(AUTH_LINE):
+        text = text[:-len(AUTH_LINE)].rstrip()
+    for match in _QA_PATTERN.finditer(text):
+        yield match.group(1).strip(), match.group(2).strip()
+
+def parse_qa_pairs(text: str) -> List[Tuple[str, str]]:
+    return list(iter_qa_pairs(text))
+
+def anki_formatter(text: str) -> str:
+    lines = ["Question::Answer", "-" * 160]
+    for q, a in iter_qa_pairs(text):
+        lines.append(q + "::" + a)
     # print("Anki format complete")
-    formatted_output += auth_line
-    return formatted_output
+    lines.append("\n" + AUTH_LINE)
+    return "\n".join(lines)
 
 def main_loop_sync(chunk, local_chain: LLMChain, bank, subject):
     bank = ""
-    with get_openai_callback() as cb:
+    with get_openai_callback() as cb, tr.span("llm.generate"):
         response = local_chain.run(subject = subject, chunk = chunk)
         print("success")
         # print(f"Step: {progress}/{len(chunks)} Tokens: {cb.total_tokens}")
@@ -181,5 +312,5 @@ if __name__ == "__main__":
     print("Extracting text from PDFs...")
     text = extract_text_loaders(loaders)
     print("Splitting text into chunks...")
-    chunks = text_splitter(text)
+    chunks = generation_chunks(text)
     print("Generating Q&A pairs...(this may take a while depending on the size of your document(s))")
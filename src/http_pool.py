@@ -0,0 +1,136 @@
+import asyncio
+import os
+import threading
+import weakref
+from functools import lru_cache
+from typing import Any, Dict
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+# One keep-alive connection pool for every OpenAI call in the process. The openai client otherwise opens a
+# requests.Session per thread (Streamlit runs each rerun on a new thread) and an aiohttp session per async call.
+# requests and aiohttp only speak HTTP/1.1, so reuse comes from keep-alive rather than HTTP/2 multiplexing.
+PER_HOST_CONNECTIONS = int(os.getenv("MEMORA_HTTP_PER_HOST", "20"))
+TOTAL_CONNECTIONS = int(os.getenv("MEMORA_HTTP_TOTAL", "100"))
+KEEPALIVE_SECONDS = float(os.getenv("MEMORA_HTTP_KEEPALIVE", "60"))
+HOST_POOLS = 10
+CONNECT_RETRIES = 2
+
+def _proxies() -> Dict[str, str]:
+    if isinstance(openai.proxy, str):
+        return {"http": openai.proxy, "https": openai.proxy}
+    return dict(openai.proxy or {})
+
+class _AsyncCounters:
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+class HTTPPool:
+    def __init__(self, per_host: int = PER_HOST_CONNECTIONS, total: int = TOTAL_CONNECTIONS, keepalive: float = KEEPALIVE_SECONDS):
+        self.per_host = per_host
+        self.total = total
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._session: requests.Session | None = None
+        # One aiohttp session per event loop, aiohttp sessions can't be shared between loops
+        self._async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+        self._async = _AsyncCounters()
+
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                # pool_block makes per_host a hard limit: callers wait for a free connection instead of opening extras
+                adapter = HTTPAdapter(pool_connections = HOST_POOLS, pool_maxsize = self.per_host, pool_block = True, max_retries = CONNECT_RETRIES)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.proxies = _proxies()
+                self._session = session
+            return self._session
+
+    def _trace(self) -> aiohttp.TraceConfig:
+        counters = self._async
+        trace = aiohttp.TraceConfig()
+        async def request_start(session, context, params):
+            counters.requests += 1
+            counters.in_flight += 1
+            counters.max_in_flight = max(counters.max_in_flight, counters.in_flight)
+        async def request_done(session, context, params):
+            counters.in_flight -= 1
+        async def created(session, context, params):
+            counters.created += 1
+        async def reused(session, context, params):
+            counters.reused += 1
+        trace.on_request_start.append(request_start)
+        trace.on_request_end.append(request_done)
+        trace.on_request_exception.append(request_done)
+        trace.on_connection_create_end.append(created)
+        trace.on_connection_reuseconn.append(reused)
+        return trace
+
+    def async_session(self) -> aiohttp.ClientSession:
+        # Must be called from inside the event loop that will use the session
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit = self.total, limit_per_host = self.per_host, keepalive_timeout = self.keepalive, ttl_dns_cache = 300)
+                session = aiohttp.ClientSession(connector = connector, trace_configs = [self._trace()])
+                self._async_sessions[loop] = session
+            return session
+
+    def install(self):
+        # Sync calls from any thread now share one session; existing per-thread sessions are left to finish
+        openai.requestssession = self.session()
+
+    def use_async(self) -> aiohttp.ClientSession:
+        # Async openai calls made by the current task, and tasks it creates afterwards, go through the loop's pooled session
+        session = self.async_session()
+        openai.aiosession.set(session)
+        return session
+
+    async def aclose(self):
+        # Closes the current loop's session; call before a short-lived loop (asyncio.run) ends
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        hosts = []
+        with self._lock:
+            session = self._session
+            async_sessions = len(self._async_sessions)
+        if session is not None:
+            manager = session.get_adapter("https://").poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                idle = sum(conn is not None for conn in list(pool.pool.queue))
+                hosts.append({"host": f"{pool.scheme}://{pool.host}:{pool.port}", "requests": pool.num_requests,
+                              "connections_opened": pool.num_connections, "in_use": pool.pool.maxsize - pool.pool.qsize(), "idle": idle})
+        sync_requests = sum(h["requests"] for h in hosts)
+        sync_opened = sum(h["connections_opened"] for h in hosts)
+        counters = self._async
+        return {
+            "per_host_limit": self.per_host,
+            "sync": {"requests": sync_requests, "connections_opened": sync_opened,
+                     "reuse_rate": round(1 - sync_opened / sync_requests, 3) if sync_requests else 0.0, "hosts": hosts},
+            "async": {"sessions": async_sessions, "requests": counters.requests, "connections_opened": counters.created,
+                      "reused": counters.reused, "in_flight": counters.in_flight, "max_in_flight": counters.max_in_flight,
+                      "reuse_rate": round(counters.reused / counters.requests, 3) if counters.requests else 0.0},
+        }
+
+@lru_cache(maxsize = 1)
+def default_pool() -> HTTPPool:
+    pool = HTTPPool()
+    pool.install()
+    return pool
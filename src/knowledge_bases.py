@@ -0,0 +1,387 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, List, Tuple
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import FAISS
+try:
+    import src.el_professor as ep
+    from src.processing import CHILD_TOKENS, CHILD_OVERLAP, PARENT_TOKENS, extract_text
+    from src.vectors import compress_docstore
+except ModuleNotFoundError:
+    import el_professor as ep
+    from processing import CHILD_TOKENS, CHILD_OVERLAP, PARENT_TOKENS, extract_text
+    from vectors import compress_docstore
+
+MANIFEST_VERSION = 2
+_SAFE_NAME = re.compile(r"[^\w\- ]")
+_SAFE_OWNER = re.compile(r"[\w\-]+")
+
+# Only saved knowledge bases are written to disk. Bases unused for KB_RETENTION_DAYS are deleted, then the least recently
+# used ones while saved indices and sources take more than KB_MAX_MB, along with any files no remaining base refers to.
+KB_RETENTION_DAYS = float(os.getenv("MEMORA_KB_RETENTION_DAYS", "90"))
+KB_MAX_MB = int(os.getenv("MEMORA_KB_MAX_MB", "2048"))
+# Unreferenced files younger than this may belong to a save in progress (here or in another process)
+PRUNE_GRACE = 3600
+# Base names are scoped per owner; the CLI and engine use this one, Streamlit users one derived from their key
+LOCAL_OWNER = "local"
+MIN_KEY_CHARS = 8
+
+# Layout under VDB_ROOT:
+#   shards/<key>.faiss/         one parent/child FAISS index per saved source file, keyed by file hash + embedding model + chunking
+#                               params, plus vectors.npy and index.<fp16|pq>.faiss once loaded with compressed vector storage
+#   sources/<sha1>              a copy of each saved source file, so stale shards can be rebuilt without a re-upload
+#   bases/<owner>/<name>.json   manifest of a named knowledge base; its mtime is when the base was last used
+
+def embedding_model(embedder: Embeddings) -> str:
+    return getattr(embedder, "model", type(embedder).__name__)
+
+def file_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def owner_id(key: str) -> str:
+    # Owner of a user's bases, from a key only they know; the key itself is never stored
+    if len(key) < MIN_KEY_CHARS:
+        raise ValueError(f"Knowledge base keys need at least {MIN_KEY_CHARS} characters.")
+    return hashlib.sha256(f"memora-kb:{key}".encode("utf-8")).hexdigest()[:32]
+
+def _tree_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, fn)) for folder, _, fns in os.walk(path) for fn in fns)
+
+@dataclass
+class SourceEntry:
+    sha1: str
+    shard: str
+    chunks: int
+    built_at: float
+
+@dataclass
+class Manifest:
+    name: str
+    embedding_model: str
+    built_at: float
+    # Older manifests lack these, so they load as stale and get rebuilt
+    child_tokens: int = 0
+    child_overlap: int = 0
+    parent_tokens: int = 0
+    sources: Dict[str, SourceEntry] = field(default_factory = dict)
+    version: int = MANIFEST_VERSION
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Manifest":
+        sources = {name: SourceEntry(**entry) for name, entry in data.pop("sources", {}).items()}
+        known = {f.name for f in fields(cls)}
+        return cls(sources = sources, **{k: v for k, v in data.items() if k in known})
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+class ShardStore:
+    # Content-addressed per-file indices: saved ones on disk, shared by every knowledge base, unsaved ones built in memory
+    def __init__(self, embedder: Embeddings, root: str = ep.VDB_ROOT, vectors: str = "flat",
+                 child_tokens: int = CHILD_TOKENS, parent_tokens: int = PARENT_TOKENS):
+        self.embedder = embedder
+        self.root = root
+        # "flat" keeps float32 vectors in memory, "fp16" and "pq" keep compressed codes and re-score from disk
+        self.vectors = vectors
+        self.child_tokens = child_tokens
+        self.child_overlap = CHILD_OVERLAP
+        self.parent_tokens = parent_tokens
+        self.embedding_model = embedding_model(embedder)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def key(self, sha1: str) -> str:
+        params = f"{sha1}:{self.embedding_model}:{self.child_tokens}:{self.child_overlap}:{self.parent_tokens}"
+        return hashlib.sha1(params.encode("utf-8")).hexdigest()
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _source_path(self, sha1: str) -> str:
+        return os.path.join(self.root, "sources", sha1)
+
+    def has_source(self, sha1: str) -> bool:
+        return os.path.isfile(self._source_path(sha1))
+
+    def read_source(self, sha1: str) -> bytes:
+        with open(self._source_path(sha1), "rb") as f:
+            return f.read()
+
+    def _write_source(self, sha1: str, data: bytes):
+        path = self._source_path(sha1)
+        if os.path.isfile(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def load(self, key: str, chunks: int | None = None) -> FAISS | None:
+        # Returns None for missing, unreadable or (given the expected chunk count) incomplete shards
+        try:
+            docstore = ep.load_vdb(f"shards/{key}", self.embedder, root = self.root)
+        except (RuntimeError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if docstore is None or (chunks is not None and docstore.index.ntotal != chunks):
+            return None
+        return self._compress(key, docstore)
+
+    def _compress(self, key: str, docstore: FAISS) -> FAISS:
+        return compress_docstore(docstore, self.vectors, os.path.join(self.root, "shards", f"{key}.faiss"))
+
+    def chunking(self) -> Dict[str, int]:
+        return {"child_tokens": self.child_tokens, "child_overlap": self.child_overlap, "parent_tokens": self.parent_tokens}
+
+    def shard(self, filename: str, data: bytes, text: str | None = None, rebuild: bool = False, persist: bool = True,
+              docstore: FAISS | None = None) -> Tuple[str, FAISS]:
+        # Loads the file's index if a saved knowledge base already embedded it, otherwise builds it (or takes `docstore`,
+        # built from the same file earlier). Only persisted shards are written to disk, together with a copy of the file.
+        sha1 = file_hash(data)
+        key = self.key(sha1)
+        with self._lock(key):
+            saved = None if rebuild else self.load(key)
+            if saved is not None:
+                return key, saved
+            if docstore is None or rebuild:
+                if text is None:
+                    text = extract_text(filename, data)
+                docstore = ep.build_docstore(text, self.embedder, source = filename, **self.chunking())
+            if not persist:
+                return key, docstore
+            self._write_source(sha1, data)
+            ep.save_vdb(docstore, f"shards/{key}", root = self.root)
+            # Compressed copies of a previous build would otherwise be reused
+            derived = os.path.join(self.root, "shards", f"{key}.faiss", "vectors.npy")
+            if os.path.isfile(derived):
+                os.remove(derived)
+            docstore = self._compress(key, docstore)
+        return key, docstore
+
+class KnowledgeBaseManager:
+    def __init__(self, embedder: Embeddings, root: str = ep.VDB_ROOT, vectors: str = "flat",
+                 child_tokens: int = CHILD_TOKENS, parent_tokens: int = PARENT_TOKENS,
+                 retention_days: float = KB_RETENTION_DAYS, max_mb: int = KB_MAX_MB):
+        self.store = ShardStore(embedder, root, vectors, child_tokens, parent_tokens)
+        self.root = root
+        self.retention_days = retention_days
+        self.max_mb = max_mb
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._adopt_unowned()
+
+    def _lock(self, name: str, owner: str) -> threading.Lock:
+        # Every read-modify-write of a manifest holds its base's lock
+        with self._locks_lock:
+            return self._locks.setdefault((owner, name), threading.Lock())
+
+    @staticmethod
+    def _check_owner(owner: str) -> str:
+        if not _SAFE_OWNER.fullmatch(owner):
+            raise ValueError(f"Invalid knowledge base owner '{owner}'")
+        return owner
+
+    def _folder(self, owner: str) -> str:
+        return os.path.join(self.root, "bases", self._check_owner(owner))
+
+    def _manifest_path(self, name: str, owner: str) -> str:
+        return os.path.join(self._folder(owner), f"{name}.json")
+
+    def _adopt_unowned(self):
+        # Bases saved before names were scoped per owner become LOCAL_OWNER's, so pruning keeps their files
+        folder = os.path.join(self.root, "bases")
+        if not os.path.isdir(folder):
+            return
+        for fn in os.listdir(folder):
+            if fn.endswith(".json") and os.path.isfile(os.path.join(folder, fn)):
+                os.makedirs(self._folder(LOCAL_OWNER), exist_ok = True)
+                os.replace(os.path.join(folder, fn), os.path.join(self._folder(LOCAL_OWNER), fn))
+
+    @staticmethod
+    def clean_name(name: str) -> str:
+        # Every public method takes names through here, so "Quantum Mechanics!" opens what save() stored as
+        # "Quantum Mechanics" and no name reaches the filesystem unchecked
+        name = _SAFE_NAME.sub("", name).strip()
+        if not name:
+            raise ValueError("Invalid knowledge base name: use letters, numbers, spaces, '-' or '_'.")
+        return name
+
+    def names(self, owner: str = LOCAL_OWNER) -> List[str]:
+        folder = self._folder(owner)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(fn[:-len(".json")] for fn in os.listdir(folder) if fn.endswith(".json"))
+
+    def manifest(self, name: str, owner: str = LOCAL_OWNER) -> Manifest | None:
+        name = self.clean_name(name)
+        try:
+            with open(self._manifest_path(name, owner), "r") as f:
+                return Manifest.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError) as e:
+            print(f"Manifest of knowledge base '{name}' is invalid ({e})")
+            return None
+
+    def _write_manifest(self, manifest: Manifest, owner: str):
+        path = self._manifest_path(manifest.name, owner)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest.to_json(), f, indent = 2)
+        os.replace(path + ".tmp", path)
+
+    def touch(self, name: str, owner: str = LOCAL_OWNER):
+        # Marks a base as used, which is what retention counts from
+        name = self.clean_name(name)
+        try:
+            os.utime(self._manifest_path(name, owner))
+        except FileNotFoundError:
+            pass
+
+    def _current(self, manifest: Manifest) -> bool:
+        return (manifest.version == MANIFEST_VERSION and manifest.embedding_model == self.store.embedding_model
+                and all(getattr(manifest, k) == v for k, v in self.store.chunking().items()))
+
+    def stale_sources(self, name: str, owner: str = LOCAL_OWNER) -> List[str]:
+        # Sources whose shard was built with other settings or is missing from disk
+        manifest = self.manifest(name, owner)
+        if manifest is None:
+            return []
+        if not self._current(manifest):
+            return list(manifest.sources)
+        return [source for source, entry in manifest.sources.items()
+                if entry.shard != self.store.key(entry.sha1)
+                or not all(os.path.isfile(os.path.join(self.root, "shards", f"{entry.shard}.faiss", fn)) for fn in ("index.faiss", "index.pkl"))]
+
+    def save(self, name: str, files: Dict[str, bytes], owner: str = LOCAL_OWNER, built: Dict[str, FAISS] | None = None) -> Manifest:
+        # Adds or updates files in a knowledge base; unchanged files are not re-embedded, nor are those in `built`
+        # (indices already built from these files, by filename)
+        name = self.clean_name(name)
+        built = built or {}
+        with self._lock(name, owner):
+            manifest = self.manifest(name, owner)
+            if manifest is None or not self._current(manifest):
+                previous = manifest.sources if manifest is not None else {}
+                manifest = Manifest(name, self.store.embedding_model, time.time(), sources = dict(previous), **self.store.chunking())
+            for filename, data in files.items():
+                entry = manifest.sources.get(filename)
+                if entry is not None and entry.sha1 == file_hash(data) and entry.shard == self.store.key(entry.sha1):
+                    continue
+                key, docstore = self.store.shard(filename, data, docstore = built.get(filename))
+                manifest.sources[filename] = SourceEntry(file_hash(data), key, docstore.index.ntotal, time.time())
+            manifest.built_at = time.time()
+            self._write_manifest(manifest, owner)
+        self.prune(keep = (owner, name))
+        return manifest
+
+    def open(self, name: str, owner: str = LOCAL_OWNER) -> List[Tuple[str, FAISS]]:
+        # Loads a base's shards, rebuilding only stale ones from the stored source copies
+        name = self.clean_name(name)
+        with self._lock(name, owner):
+            manifest = self.manifest(name, owner)
+            if manifest is None:
+                raise KeyError(f"No knowledge base named '{name}'")
+            shards = []
+            changed = not self._current(manifest)
+            for filename, entry in list(manifest.sources.items()):
+                key = self.store.key(entry.sha1)
+                docstore = self.store.load(key, entry.chunks) if key == entry.shard else None
+                if docstore is None:
+                    if not self.store.has_source(entry.sha1):
+                        print(f"Knowledge base '{name}': '{filename}' is stale and its source is missing, skipping")
+                        continue
+                    # Same key means the saved shard is damaged, otherwise the settings changed and it may already exist
+                    key, docstore = self.store.shard(filename, self.store.read_source(entry.sha1), rebuild = key == entry.shard)
+                    manifest.sources[filename] = SourceEntry(entry.sha1, key, docstore.index.ntotal, time.time())
+                    changed = True
+                shards.append((key, docstore))
+            if changed:
+                manifest.embedding_model = self.store.embedding_model
+                for k, v in self.store.chunking().items():
+                    setattr(manifest, k, v)
+                manifest.version = MANIFEST_VERSION
+                self._write_manifest(manifest, owner)
+            else:
+                self.touch(name, owner)
+        return shards
+
+    def delete(self, name: str, owner: str = LOCAL_OWNER):
+        # Shards and source copies stay until prune() finds no other base using them
+        name = self.clean_name(name)
+        with self._lock(name, owner):
+            try:
+                os.remove(self._manifest_path(name, owner))
+            except FileNotFoundError:
+                pass
+
+    def _bases(self) -> List[Tuple[float, str, str, Manifest]]:
+        # (last used, owner, name, manifest) of every base on disk
+        bases = []
+        folder = os.path.join(self.root, "bases")
+        for owner in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+            if not _SAFE_OWNER.fullmatch(owner) or not os.path.isdir(os.path.join(folder, owner)):
+                continue
+            for name in self.names(owner):
+                manifest = self.manifest(name, owner)
+                if manifest is not None:
+                    try:
+                        bases.append((os.path.getmtime(self._manifest_path(name, owner)), owner, name, manifest))
+                    except FileNotFoundError:
+                        continue
+        return bases
+
+    def _files(self, manifest: Manifest) -> List[str]:
+        return [p for entry in manifest.sources.values()
+                for p in (os.path.join(self.root, "shards", f"{entry.shard}.faiss"), self.store._source_path(entry.sha1))]
+
+    def prune(self, keep: Tuple[str, str] | None = None, now: float | None = None) -> Dict[str, int]:
+        # Applies the retention and size limits; `keep` (owner, name) is never deleted, e.g. the base just saved
+        now = time.time() if now is None else now
+        with self._prune_lock:
+            deleted = 0
+            live = []
+            for used, owner, name, manifest in sorted(self._bases(), key = lambda base: base[0]):
+                if (owner, name) != keep and now - used > self.retention_days * 86400:
+                    self.delete(name, owner)
+                    deleted += 1
+                else:
+                    live.append((owner, name, manifest))
+            sizes: Dict[str, int] = {}
+            for _, _, manifest in live:
+                for path in self._files(manifest):
+                    if path not in sizes and os.path.exists(path):
+                        sizes[path] = _tree_bytes(path)
+            # Least recently used first; files shared with a base that stays keep counting
+            while sum(sizes.values()) > self.max_mb * 2**20:
+                victim = next((base for base in live if base[:2] != keep), None)
+                if victim is None:
+                    break
+                live.remove(victim)
+                self.delete(victim[1], victim[0])
+                deleted += 1
+                referenced = {path for _, _, manifest in live for path in self._files(manifest)}
+                sizes = {path: size for path, size in sizes.items() if path in referenced}
+            referenced = {path for _, _, manifest in live for path in self._files(manifest)}
+            removed = 0
+            for folder in ("shards", "sources"):
+                folder = os.path.join(self.root, folder)
+                for fn in os.listdir(folder) if os.path.isdir(folder) else []:
+                    path = os.path.join(folder, fn)
+                    if path in referenced or now - os.path.getmtime(path) < PRUNE_GRACE:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors = True)
+                    else:
+                        os.remove(path)
+                    removed += 1
+        return {"bases": deleted, "files": removed}
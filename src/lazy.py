@@ -0,0 +1,31 @@
+import importlib.util
+import sys
+import threading
+from functools import lru_cache
+from types import ModuleType
+
+_import_lock = threading.Lock()
+
+def lazy_import(name: str) -> ModuleType:
+    # Returns the module at once but only executes it on first attribute access,
+    # so pages stop paying for heavy dependencies (gtts, tiktoken, ...) they may never use
+    with _import_lock:
+        if name in sys.modules:
+            return sys.modules[name]
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named '{name}'", name = name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
+
+@lru_cache(maxsize = None)
+def static_image(path: str):
+    # Decoded once per process instead of on every script rerun
+    from PIL import Image
+    image = Image.open(path)
+    image.load()
+    return image
@@ -0,0 +1,106 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+# The top lexical hit must beat the runner-up by this factor (and contain every query term) to skip vector search
+LEXICAL_MARGIN = 1.5
+
+_TOKEN = re.compile(r"\w+")
+_STOPWORDS = frozenset("""a an and are as at be but by can do does explain for from give how i in is it me of on or
+please tell that the their this to was what when where which who why with you your""".split())
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.casefold()) if t not in _STOPWORDS]
+
+class BM25Index:
+    # Postings are stored CSR-style: the postings of term t are doc_ids/tfs[offsets[t]:offsets[t + 1]]
+    def __init__(self, texts: Iterable[str], k1: float = BM25_K1, b: float = BM25_B):
+        vocab: Dict[str, int] = {}
+        term_docs: List[List[int]] = []
+        term_tfs: List[List[int]] = []
+        doc_len = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_id = vocab.setdefault(term, len(vocab))
+                if term_id == len(term_docs):
+                    term_docs.append([])
+                    term_tfs.append([])
+                term_docs[term_id].append(doc_id)
+                term_tfs[term_id].append(tf)
+        self.vocab = vocab
+        self.k1 = k1
+        self.b = b
+        self.doc_len = np.array(doc_len, dtype = np.float32)
+        self.n_docs = len(doc_len)
+        lengths = np.array([len(d) for d in term_docs], dtype = np.int64)
+        self.offsets = np.zeros(len(vocab) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = self.offsets[1:])
+        self.doc_ids = np.fromiter((d for docs in term_docs for d in docs), dtype = np.int32, count = int(self.offsets[-1]))
+        self.tfs = np.fromiter((tf for tfs in term_tfs for tf in tfs), dtype = np.float32, count = int(self.offsets[-1]))
+        self.idf = np.log(1 + (self.n_docs - lengths + 0.5) / (lengths + 0.5)).astype(np.float32)
+        avg_len = self.doc_len.mean() if self.n_docs else 1.0
+        self._norm = (k1 * (1 - b + b * self.doc_len / max(avg_len, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def from_documents(cls, docs: List[Document], **kwargs) -> "BM25Index":
+        return cls((doc.page_content for doc in docs), **kwargs)
+
+    @classmethod
+    def from_faiss(cls, docstore: FAISS, **kwargs) -> "BM25Index":
+        # Positions match the FAISS index, so lexical and vector hits can be fused directly
+        texts = (docstore.docstore.search(docstore.index_to_docstore_id[i]).page_content for i in range(docstore.index.ntotal))
+        return cls(texts, **kwargs)
+
+    def _term_ids(self, query: str) -> List[int]:
+        return [self.vocab[t] for t in dict.fromkeys(tokenize(query)) if t in self.vocab]
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype = np.float32)
+        for term_id in self._term_ids(query):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tfs = self.tfs[start:end]
+            scores[docs] += self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + self._norm[docs])
+        return scores
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[int, float]]:
+        scores = self.scores(query)
+        k = min(k, self.n_docs)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+    def coverage(self, query: str, doc_id: int) -> float:
+        term_ids = self._term_ids(query)
+        n_terms = len(set(tokenize(query)))
+        if not n_terms:
+            return 0.0
+        hits = 0
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            hits += bool(np.any(self.doc_ids[start:end] == doc_id))
+        return hits / n_terms
+
+    def is_confident(self, query: str, hits: List[Tuple[int, float]], margin: float = LEXICAL_MARGIN) -> bool:
+        if not hits or self.coverage(query, hits[0][0]) < 1.0:
+            return False
+        if len(hits) == 1:
+            return True
+        return hits[0][1] >= margin * hits[1][1]
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key = lambda item: item[1], reverse = True)
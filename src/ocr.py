@@ -0,0 +1,177 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+try:
+    import src.resources as rs
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import resources as rs
+    import tracing as tr
+
+# PDF pages without a text layer (scans, handwritten notes) are OCR'd locally with Tesseract, in a pool of worker
+# processes so a scanned upload uses every core. Results are cached by the hash of the page's images, so a page is
+# only read once per server however many files or sessions it turns up in. Without pytesseract and the tesseract
+# binary such pages stay empty, as before.
+OCR_WORKERS = int(os.getenv("MEMORA_OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_LANG = os.getenv("MEMORA_OCR_LANG", "eng")
+OCR_CACHE_PAGES = 4096
+# Pages with fewer non-blank characters than this are treated as scans (page numbers, headers and stray marks survive scanning)
+MIN_TEXT_CHARS = 20
+
+@dataclass
+class PageResult:
+    source: str
+    page: int
+    seconds: float
+    chars: int
+    cached: bool = False
+    error: str | None = None
+
+_report: ContextVar[List[PageResult] | None] = ContextVar("memora_ocr_report", default = None)
+_cache: "OrderedDict[str, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+@lru_cache(maxsize = 1)
+def available() -> bool:
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return False
+    return True
+
+@lru_cache(maxsize = 1)
+def _pool() -> ProcessPoolExecutor:
+    # Spawned, not forked: the server process has threads (Streamlit, the engine) a fork would copy mid-flight
+    return ProcessPoolExecutor(max_workers = OCR_WORKERS, mp_context = multiprocessing.get_context("spawn"))
+
+def _recognise(images: List[bytes], lang: str) -> Tuple[str, float]:
+    # Runs in a worker process
+    import pytesseract
+    from PIL import Image
+    start = time.perf_counter()
+    texts = []
+    for data in images:
+        with Image.open(io.BytesIO(data)) as image:
+            texts.append(pytesseract.image_to_string(image, lang = lang).strip())
+    return "\n".join(text for text in texts if text), time.perf_counter() - start
+
+def needs_ocr(text: str) -> bool:
+    return sum(not c.isspace() for c in text) < MIN_TEXT_CHARS
+
+def page_images(page) -> List[bytes]:
+    # Encoded images drawn on a PDF page; images pypdf cannot decode are skipped
+    try:
+        return [image.data for image in page.images]
+    except Exception:
+        return []
+
+def _cached(key: str) -> str | None:
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    return None
+
+def _store(key: str, text: str):
+    with _cache_lock:
+        _cache[key] = text
+        while len(_cache) > OCR_CACHE_PAGES:
+            _cache.popitem(last = False)
+
+def _record(result: PageResult):
+    report = _report.get()
+    if report is not None:
+        report.append(result)
+
+@contextlib.contextmanager
+def collect() -> Iterator[List[PageResult]]:
+    # Every page OCR'd (or found in the cache) inside the block is appended to the yielded list
+    report: List[PageResult] = []
+    token = _report.set(report)
+    try:
+        yield report
+    finally:
+        _report.reset(token)
+
+def summary(report: List[PageResult]) -> str:
+    read = [r for r in report if not r.cached and r.error is None]
+    cached = sum(r.cached for r in report)
+    failed = sum(r.error is not None for r in report)
+    text = f"Read {len(report)} scanned page(s) with OCR"
+    if read:
+        text += f", {sum(r.seconds for r in read):.1f} s of OCR over {len(read)} page(s)"
+    if cached:
+        text += f", {cached} from cache"
+    if failed:
+        text += f", {failed} failed"
+    return text + "."
+
+def rows(report: List[PageResult]) -> List[Dict[str, Any]]:
+    return [{**asdict(r), "page": r.page + 1, "seconds": round(r.seconds, 2)} for r in report]
+
+def _ocr(scans: List[Tuple[int, List[bytes]]], source: str) -> Dict[int, str]:
+    # OCR text per page number; cached pages are answered straight away, the rest run in parallel in the pool
+    texts: Dict[int, str] = {}
+    pending: Dict[int, Tuple[str, Future]] = {}
+    for number, images in scans:
+        key = rs.content_key(f"ocr:{OCR_LANG}", *images)
+        text = _cached(key)
+        if text is not None:
+            texts[number] = text
+            _record(PageResult(source, number, 0.0, len(text), cached = True))
+            continue
+        try:
+            pending[number] = (key, _pool().submit(_recognise, images, OCR_LANG))
+        except BrokenProcessPool as e:
+            _pool.cache_clear()
+            _record(PageResult(source, number, 0.0, 0, error = str(e)))
+    for number, (key, future) in pending.items():
+        try:
+            text, seconds = future.result()
+        except Exception as e:
+            # A worker that died takes the pool with it; the next batch starts a new one
+            if isinstance(e, BrokenProcessPool):
+                _pool.cache_clear()
+            _record(PageResult(source, number, 0.0, 0, error = str(e) or type(e).__name__))
+            continue
+        _store(key, text)
+        texts[number] = text
+        _record(PageResult(source, number, seconds, len(text)))
+    return texts
+
+def _fill(batch: List[Tuple[int, Any, str]], source: str) -> Iterator[str]:
+    scans = []
+    for number, page, text in batch:
+        if needs_ocr(text):
+            images = page_images(page)
+            if images:
+                scans.append((number, images))
+    ocr_texts: Dict[int, str] = {}
+    if scans and available():
+        with tr.span("ocr", pages = len(scans), source = source):
+            ocr_texts = _ocr(scans, source)
+    for number, _, text in batch:
+        ocr_text = ocr_texts.get(number, "")
+        yield ocr_text if len(ocr_text.strip()) > len(text.strip()) else text
+
+def page_texts(pages: Iterable, source: str = "", window: int | None = None) -> Iterator[str]:
+    # Text of each PDF page in order. Pages without a text layer are OCR'd, up to `window` pages at a time
+    # (all of them when None), so larger windows keep more workers busy and smaller ones hold fewer pages.
+    batch: List[Tuple[int, Any, str]] = []
+    for number, page in enumerate(pages):
+        batch.append((number, page, page.extract_text()))
+        if window is not None and len(batch) >= window:
+            yield from _fill(batch, source)
+            batch = []
+    yield from _fill(batch, source)
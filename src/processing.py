@@ -1,27 +1,65 @@
+from __future__ import annotations
+import codecs
+import io
 import os
-from typing import List, Dict
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Iterable, Iterator, Tuple
 from dotenv import load_dotenv
-from langchain.docstore.document import Document
-from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader
+# langchain is imported inside the functions that need it, so importing this module (every page does) stays cheap
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+try:
+    import src.http_pool as hp
+    import src.ocr as ocr
+    import src.scheduler as sch
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import http_pool as hp
+    import ocr
+    import scheduler as sch
+    import tracing as tr
 
 TOKEN_LIMIT = 2000
 CHUNK_SIZE = 3000
 CHUNK_OVERLAP = 100
 REQ_TIMEOUT = 200
+GROUNDING_THRESHOLD = 0.35
+# Parent/child chunking: small children are embedded for search, their parent spans go to the LLM
+CHILD_TOKENS = 150
+CHILD_OVERLAP = 30
+PARENT_TOKENS = 1200
+# Streaming chunking re-splits a window of about this many tokens at a time; uploads are read in blocks of this size
+STREAM_WINDOW_TOKENS = 8 * PARENT_TOKENS
+READ_BLOCK_BYTES = 2**20
+# Streamed PDFs are read this many pages at a time, enough to keep every OCR worker busy on a scan
+STREAM_PDF_PAGES = 2 * ocr.OCR_WORKERS
 
+_CONTENT_WORD = re.compile(r"[a-z0-9]{4,}")
+_HEDGES = ("does not provide", "doesn't provide", "does not contain", "doesn't contain", "not mentioned",
+           "no information", "not enough information", "cannot answer", "can't answer", "unable to answer",
+           "unable to determine", "i'm sorry", "i am sorry", "not specified in the context")
+
+# Clients are process-wide: Streamlit reruns and every page share them instead of rebuilding them per interaction,
+# and their requests go through the shared keep-alive pool and the process-wide LLM scheduler
+@lru_cache(maxsize = 1)
 def initialise_llms():
     from langchain.chat_models import ChatOpenAI
     load_dotenv()
+    hp.default_pool()
+    sch.default_scheduler()
     chat3_5 = ChatOpenAI(temperature = 0, model_name = "gpt-3.5-turbo", request_timeout = REQ_TIMEOUT)
     chat4 = ChatOpenAI(temperature = 0, model_name = "gpt-4", request_timeout = REQ_TIMEOUT)
     chat3_5.openai_api_key = os.getenv("OPENAI_API_KEY")
     chat4.openai_api_key = os.getenv("OPENAI_API_KEY")
     return chat3_5, chat4
 
+@lru_cache(maxsize = 8)
 def initialise_llms_with_key(api_key: str):
     from langchain.chat_models import ChatOpenAI
     load_dotenv()
+    hp.default_pool()
+    sch.default_scheduler()
     chat3_5 = ChatOpenAI(temperature = 0, model_name = "gpt-3.5-turbo", openai_api_key = api_key, request_timeout = REQ_TIMEOUT)
     chat4 = ChatOpenAI(temperature = 0, model_name = "gpt-4", openai_api_key = api_key, request_timeout = REQ_TIMEOUT)
     return chat3_5, chat4
@@ -34,21 +72,162 @@ def extract_text_from_docs(docs: List[Document]) -> str:
     text = " ".join(text)
     return text
 
-def text_splitter(text: str, docs: bool = False, chnk_size: int = CHUNK_SIZE) -> List[str] | List[Document]:
+@tr.traced("text_splitter")
+def text_splitter(text: str, docs: bool = False, chnk_size: int = CHUNK_SIZE, source: str | None = None) -> List[str] | List[Document]:
     # splitter = NLTKTextSplitter(separator = ".",chunk_size = chnk_size, chunk_overlap = CHUNK_OVERLAP)
     # splitter = CharacterTextSplitter(separator = "\n", chunk_size = chnk_size, chunk_overlap = CHUNK_OVERLAP)
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
     splitter = RecursiveCharacterTextSplitter(separators = [" ",",","\n"], chunk_size = chnk_size, chunk_overlap = CHUNK_OVERLAP)
     if docs:
-        chunks = splitter.create_documents([text])
+        metadatas = [{"source": source}] if source is not None else None
+        chunks = splitter.create_documents([text], metadatas = metadatas)
         return chunks
     chunks = splitter.split_text(text)
     return chunks
 
+def _snap(starts_word: List[bool], cut: int, lower: int, reach: int) -> int:
+    # Moves a cut back to the nearest token that starts a word, so chunks don't end mid-word
+    for i in range(cut, max(lower, cut - reach), -1):
+        if starts_word[i]:
+            return i
+    return cut
+
+@tr.traced("split_parent_child")
+def split_parent_child(text: str, source: str | None = None, child_tokens: int = CHILD_TOKENS,
+                       child_overlap: int = CHILD_OVERLAP, parent_tokens: int = PARENT_TOKENS, children: bool = True) -> Tuple[List[Document], List[Document]]:
+    # One tokenization pass; parents tile the text and each child lies inside one parent.
+    # Children carry their parent's id in metadata["parent"], matching the parent's metadata["id"].
+    # With children = False only the parents are built.
+    import tiktoken
+    from langchain.docstore.document import Document
+    enc = tiktoken.get_encoding("cl100k_base")
+    token_bytes = enc.decode_tokens_bytes(enc.encode(text, disallowed_special = ()))
+    n = len(token_bytes)
+    offsets = [0]
+    for b in token_bytes:
+        offsets.append(offsets[-1] + len(b))
+    starts_word = [b[:1].isspace() for b in token_bytes] + [True]
+    data = text.encode("utf-8")
+    def span(start: int, end: int) -> str:
+        return data[offsets[start]:offsets[end]].decode("utf-8", errors = "ignore").strip()
+    base = {"source": source} if source is not None else {}
+    with_children = children
+    parents, children = [], []
+    start = 0
+    while start < n:
+        end = min(start + parent_tokens, n)
+        if end < n:
+            end = _snap(starts_word, end, start, parent_tokens // 5)
+        parent_id = f"parent:{len(parents)}"
+        parents.append(Document(page_content = span(start, end), metadata = {**base, "id": parent_id, "tokens": end - start}))
+        child = start
+        while with_children and child < end:
+            child_end = min(child + child_tokens, end)
+            if child_end < end:
+                child_end = _snap(starts_word, child_end, child, child_tokens // 5)
+            children.append(Document(page_content = span(child, child_end), metadata = {**base, "parent": parent_id}))
+            if child_end == end:
+                break
+            child = _snap(starts_word, max(child_end - child_overlap, child + 1), child, child_overlap)
+        start = end
+    return parents, [c for c in children if c.page_content]
+
+def generation_chunks(text: str) -> List[str]:
+    # Generation works on the large parent spans
+    parents, _ = split_parent_child(text, children = False)
+    return [parent.page_content for parent in parents]
+
+def iter_generation_chunks(texts: Iterable[str], window_tokens: int = STREAM_WINDOW_TOKENS) -> Iterator[str]:
+    # generation_chunks over a stream of pages, holding about one window of text at a time.
+    # The window's last parent may be cut short by the window end, so it is carried into the next window.
+    window_chars = 4 * window_tokens
+    buffer = ""
+    for text in texts:
+        buffer = f"{buffer} {text}" if buffer else text
+        if len(buffer) < window_chars:
+            continue
+        chunks = generation_chunks(buffer)
+        yield from chunks[:-1]
+        buffer = chunks[-1] if chunks else ""
+    if buffer.strip():
+        yield from generation_chunks(buffer)
+
+def grounding_score(answer: str, context: str) -> float:
+    answer_terms = set(_CONTENT_WORD.findall(answer.casefold()))
+    if not answer_terms:
+        return 0.0
+    context_terms = set(_CONTENT_WORD.findall(context.casefold()))
+    return len(answer_terms & context_terms) / len(answer_terms)
+
+def is_grounded(answer: str, context: str, threshold: float = GROUNDING_THRESHOLD) -> bool:
+    # Cheap local check used to decide whether a fast model's answer needs a stronger model
+    lowered = answer.casefold()
+    if any(hedge in lowered for hedge in _HEDGES):
+        return False
+    return grounding_score(answer, context) >= threshold
+
+@tr.traced("extract_text")
+def extract_text(filename: str, data: bytes) -> str:
+    if filename.endswith(".txt"):
+        return data.decode("utf-8")
+    if filename.endswith(".pdf"):
+        from pypdf import PdfReader
+        pdf_reader = PdfReader(io.BytesIO(data))
+        with tr.span("PdfReader.extract_text", pages = len(pdf_reader.pages)):
+            return "".join(ocr.page_texts(pdf_reader.pages, source = filename))
+    if filename.endswith(".docx"):
+        import docx2txt
+        return docx2txt.process(io.BytesIO(data))
+    return ""
+
+def iter_text(filename: str, path: str) -> Iterator[str]:
+    # extract_text from a file on disk, a page (PDF) or a block (TXT, DOCX) at a time
+    if filename.endswith(".txt"):
+        # Blocks end on whitespace so no word is split between two of them
+        decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+        tail = ""
+        with open(path, "rb") as f:
+            while block := f.read(READ_BLOCK_BYTES):
+                text = tail + decoder.decode(block)
+                cut = max(text.rfind(" "), text.rfind("\n")) + 1
+                # Text without whitespace is cut anyway once it runs past a few blocks, so no block grows without bound
+                if cut == 0 and len(text) < 4 * READ_BLOCK_BYTES:
+                    tail = text
+                    continue
+                cut = cut or len(text)
+                yield text[:cut]
+                tail = text[cut:]
+        yield tail + decoder.decode(b"", final = True)
+    elif filename.endswith(".pdf"):
+        from pypdf import PdfReader
+        # The reader reads objects from the file as pages ask for them, not the whole file up front
+        yield from ocr.page_texts(PdfReader(path).pages, source = filename, window = STREAM_PDF_PAGES)
+    elif filename.endswith(".docx"):
+        import zipfile
+        from xml.etree.ElementTree import iterparse
+        paragraph = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p"
+        block, size = [], 0
+        with zipfile.ZipFile(path) as docx, docx.open("word/document.xml") as document:
+            for _, element in iterparse(document):
+                if element.tag != paragraph:
+                    continue
+                text = "".join(element.itertext())
+                element.clear()
+                block.append(text)
+                size += len(text)
+                if size >= READ_BLOCK_BYTES:
+                    yield "\n".join(block)
+                    block, size = [], 0
+        if block:
+            yield "\n".join(block)
+
 def get_pdfs(foldername: str):
+    from langchain.document_loaders import PyPDFLoader
     folderpath = f"./Notes/{foldername}"
     loaders = [PyPDFLoader(os.path.join(folderpath, fn)) for fn in os.listdir(folderpath)]
     return loaders
 
+@tr.traced("extract_text_loaders")
 def extract_text_loaders(loaders) -> str:
     text = []
     for loader in loaders:
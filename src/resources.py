@@ -0,0 +1,220 @@
+import hashlib
+import os
+import sys
+import threading
+import types
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, List
+import numpy as np
+
+# Process-wide budget for shared objects nobody is using; objects held by a session are never evicted
+MEMORY_BUDGET_MB = int(os.getenv("MEMORA_MEMORY_BUDGET_MB", "1024"))
+
+def content_key(kind: str, *parts: bytes | str) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode("utf-8") if isinstance(part, str) else part)
+        digest.update(b"\0")
+    return f"{kind}:{digest.hexdigest()}"
+
+def approx_bytes(obj: Any, _seen: set | None = None) -> int:
+    # Rough in-memory size: arrays by nbytes, faiss indices by code size, containers and plain objects recursively.
+    # Memory-mapped arrays count as zero, their pages belong to the OS page cache.
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if obj is None or isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, (types.ModuleType, types.FunctionType, types.MethodType, type)):
+        return 0
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_bytes(k, seen) + approx_bytes(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(approx_bytes(v, seen) for v in obj)
+    if hasattr(obj, "ntotal") and hasattr(obj, "code_size"):
+        return int(obj.ntotal) * int(obj.code_size)
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + sum(approx_bytes(v, seen) for v in vars(obj).values())
+    return sys.getsizeof(obj)
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current RSS where /proc is unavailable
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+@dataclass
+class _Entry:
+    value: Any
+    nbytes: int
+    refs: int = 0
+    pinned: bool = False
+
+class Handle:
+    # A session's reference to a shared object; released explicitly or when the session state is dropped
+    __slots__ = ("key", "value", "_manager", "_entry", "_released")
+
+    def __init__(self, manager: "ResourceManager", key: str, entry: _Entry):
+        self.key = key
+        self.value = entry.value
+        self._manager = manager
+        self._entry = entry
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._manager._release(self.key, self._entry)
+
+    def __enter__(self) -> "Handle":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+class ResourceManager:
+    # Shared read-only objects (chunk lists, indices) keyed by content, reference counted and
+    # evicted least recently used first once unreferenced objects push the total over the budget
+    def __init__(self, budget_bytes: int = MEMORY_BUDGET_MB * 2**20):
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _build_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(key, threading.Lock())
+
+    def _insert(self, key: str, value: Any, nbytes: int | None, pinned: bool) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _Entry(value, approx_bytes(value) if nbytes is None else nbytes, pinned = pinned)
+            self._entries[key] = entry
+        entry.pinned = entry.pinned or pinned
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value: Any, nbytes: int | None = None, pinned: bool = False) -> Any:
+        # Adds an object without holding it; an existing object under the key wins
+        with self._lock:
+            entry = self._insert(key, value, nbytes, pinned)
+            # The newest object survives until something newer needs its room
+            self._evict(keep = key)
+            return entry.value
+
+    def acquire(self, key: str, factory: Callable[[], Any] | None = None, nbytes: int | None = None, pinned: bool = False) -> Handle:
+        # Builds the object at most once per process while it stays cached; raises KeyError if it is missing and there is no factory
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return self._hold(key, entry)
+        if factory is None:
+            raise KeyError(key)
+        with self._build_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return self._hold(key, entry)
+            value = factory()
+            with self._lock:
+                self._misses += 1
+                entry = self._insert(key, value, nbytes, pinned)
+                entry.refs += 1
+                handle = Handle(self, key, entry)
+                self._evict()
+                return handle
+
+    def _hold(self, key: str, entry: _Entry) -> Handle:
+        self._hits += 1
+        entry.refs += 1
+        self._entries.move_to_end(key)
+        return Handle(self, key, entry)
+
+    def _release(self, key: str, entry: _Entry):
+        with self._lock:
+            if entry.refs > 0:
+                entry.refs -= 1
+            self._evict()
+
+    def _evict(self, keep: str | None = None):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for key in [k for k, e in self._entries.items() if not e.refs and not e.pinned and k != keep]:
+            if total <= self.budget_bytes:
+                break
+            total -= self._entries.pop(key).nbytes
+            self._build_locks.pop(key, None)
+            self._evictions += 1
+
+    def peek(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def discard(self, key: str):
+        # Outstanding handles keep their value, the manager just stops sharing it
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def keys(self, prefix: str = "") -> List[str]:
+        with self._lock:
+            return [key for key in self._entries if key.startswith(prefix)]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._entries.values())
+            hits, misses, evictions = self._hits, self._misses, self._evictions
+        return {
+            "entries": len(entries),
+            "in_use": sum(1 for e in entries if e.refs),
+            "handles": sum(e.refs for e in entries),
+            "bytes": sum(e.nbytes for e in entries),
+            "bytes_in_use": sum(e.nbytes for e in entries if e.refs or e.pinned),
+            "budget_bytes": self.budget_bytes,
+            "hits": hits,
+            "misses": misses,
+            "evictions": evictions,
+            "rss_bytes": rss_bytes(),
+        }
+
+def hold(state, name: str, handle: Handle) -> Any:
+    # Stores a handle in a session-like mapping, releasing whatever handle it replaces
+    previous = state.get(name)
+    state[name] = handle
+    if isinstance(previous, Handle) and previous is not handle:
+        previous.release()
+    return handle.value
+
+@lru_cache(maxsize = 1)
+def default_manager() -> ResourceManager:
+    return ResourceManager()
@@ -0,0 +1,307 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator
+try:
+    import src.tracing as tr
+except ModuleNotFoundError:
+    import tracing as tr
+
+# Every chat completion in the process waits here for a slot, whichever thread, event loop or page makes it.
+# Calls run in priority order (interactive questions and explanations before batch generation, prefetching last)
+# and round robin between sessions within a priority, under one ceiling on calls in flight, requests per minute
+# and tokens per minute. Batch and background calls leave RESERVED_SLOTS and a share of the rate buckets free, so
+# a question asked during a big generation job starts straight away.
+# Priority and session come from the caller's context (see context()); threads and tasks started with a copy of it
+# inherit them. Embedding requests are not scheduled.
+CONCURRENCY = int(os.getenv("MEMORA_LLM_CONCURRENCY", "16"))
+RPM = int(os.getenv("MEMORA_LLM_RPM", "3500"))
+TPM = int(os.getenv("MEMORA_LLM_TPM", "90000"))
+RESERVED_SLOTS = int(os.getenv("MEMORA_LLM_RESERVED", "4"))
+# Rate buckets hold this many seconds of budget; batch calls only start while RATE_RESERVE of it is left
+BURST_SECONDS = 10
+RATE_RESERVE = 0.2
+# Token cost of a call before its usage is known: prompt characters / 4 plus the reply
+REPLY_TOKENS = 500
+WAIT_HISTORY = 1000
+
+INTERACTIVE, BATCH, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+DEFAULT_SESSION = "default"
+
+_priority: ContextVar[int] = ContextVar("memora_llm_priority", default = INTERACTIVE)
+_session: ContextVar[str] = ContextVar("memora_llm_session", default = DEFAULT_SESSION)
+
+@contextlib.contextmanager
+def context(priority: int | None = None, session: str | None = None) -> Iterator[None]:
+    # LLM calls made inside the block (and by tasks created in it) are scheduled with this priority and session
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    if session is not None:
+        tokens.append((_session, _session.set(session)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+def bind(session: str | None = None, priority: int | None = None):
+    # context() without an end, for a Streamlit script run: the rest of the run (and threads copying its context) use it
+    if session is not None:
+        _session.set(session)
+    if priority is not None:
+        _priority.set(priority)
+
+def copy_context(priority: int | None = None) -> contextvars.Context:
+    # For work handed to a thread pool: the caller's session, optionally at another priority
+    ctx = contextvars.copy_context()
+    if priority is not None:
+        ctx.run(_priority.set, priority)
+    return ctx
+
+def estimate_tokens(params: Dict[str, Any] | None) -> int:
+    params = params or {}
+    prompt = sum(len(str(message.get("content") or "")) for message in params.get("messages", []))
+    return prompt // 4 + int(params.get("max_tokens") or REPLY_TOKENS)
+
+class _Bucket:
+    # Token bucket refilled continuously; a call may overdraw it, later calls wait for it to refill
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait(self, floor: float) -> float:
+        # Seconds until the level reaches floor
+        return max(0.0, (floor - self.level) / self.rate)
+
+@dataclass(eq = False)
+class Ticket:
+    priority: int
+    session: str
+    tokens: int
+    queued: float = field(default_factory = time.monotonic)
+    granted: float | None = None
+    used: int | None = None
+    _grant: Callable[[], None] | None = field(default = None, repr = False)
+
+class LLMScheduler:
+    def __init__(self, concurrency: int = CONCURRENCY, rpm: int = RPM, tpm: int = TPM, reserved: int = RESERVED_SLOTS):
+        self._cond = threading.Condition()
+        self._queues: Dict[int, "OrderedDict[str, Deque[Ticket]]"] = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._in_flight = {priority: 0 for priority in PRIORITY_NAMES}
+        self._granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._waits: Dict[int, Deque[float]] = {priority: deque(maxlen = WAIT_HISTORY) for priority in PRIORITY_NAMES}
+        self.configure(concurrency, rpm, tpm, reserved)
+        self._thread = threading.Thread(target = self._dispatch, name = "llm-scheduler", daemon = True)
+        self._thread.start()
+
+    def configure(self, concurrency: int | None = None, rpm: int | None = None, tpm: int | None = None, reserved: int | None = None):
+        with self._cond:
+            self.concurrency = concurrency or getattr(self, "concurrency", CONCURRENCY)
+            self.reserved = min(reserved if reserved is not None else getattr(self, "reserved", RESERVED_SLOTS), self.concurrency - 1)
+            if rpm or not hasattr(self, "_requests"):
+                self._requests = _Bucket(rpm or RPM)
+            if tpm or not hasattr(self, "_tokens"):
+                self._tokens = _Bucket(tpm or TPM)
+            self._cond.notify_all()
+
+    def limit(self, priority: int) -> int:
+        # Calls of this priority allowed in flight across all priorities
+        if priority == INTERACTIVE:
+            return self.concurrency
+        batch = self.concurrency - self.reserved
+        return batch if priority == BATCH else max(1, batch // 2)
+
+    # ------------------------------ Dispatch ------------------------------ #
+
+    def _next(self, priority: int) -> Ticket | None:
+        # Round robin between sessions: the first session's oldest call, then that session moves to the back
+        sessions = self._queues[priority]
+        if not sessions:
+            return None
+        return next(iter(sessions.values()))[0]
+
+    def _pop(self, ticket: Ticket):
+        sessions = self._queues[ticket.priority]
+        queue = sessions.pop(ticket.session)
+        queue.popleft()
+        if queue:
+            sessions[ticket.session] = queue
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                timeout = self._grant_ready()
+                self._cond.wait(timeout)
+
+    def _grant_ready(self) -> float | None:
+        # Grants every call that can start now, highest priority first; returns how long until a rate bucket
+        # could let the next one start, None when only a finished call or a new one can change anything
+        now = time.monotonic()
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        in_flight = sum(self._in_flight.values())
+        for priority in sorted(self._queues):
+            while (ticket := self._next(priority)) is not None:
+                if in_flight >= self.limit(priority):
+                    break
+                reserve = 0.0 if priority == INTERACTIVE else RATE_RESERVE
+                wait = max(self._requests.wait(1 + reserve * self._requests.capacity),
+                           self._tokens.wait(reserve * self._tokens.capacity))
+                if wait > 0:
+                    # Lower priorities don't overtake a call held back by the rate limits
+                    return wait
+                self._requests.level -= 1
+                self._tokens.level -= ticket.tokens
+                self._pop(ticket)
+                self._in_flight[priority] += 1
+                self._granted[priority] += 1
+                in_flight += 1
+                ticket.granted = now
+                self._waits[priority].append(now - ticket.queued)
+                ticket._grant()
+        return None
+
+    def _enqueue(self, ticket: Ticket):
+        with self._cond:
+            self._queues[ticket.priority].setdefault(ticket.session, deque()).append(ticket)
+            self._cond.notify_all()
+
+    def _cancel(self, ticket: Ticket):
+        # A caller that stopped waiting: dequeued if still queued, released if granted in the meantime
+        with self._cond:
+            if ticket.granted is None:
+                queue = self._queues[ticket.priority].get(ticket.session)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[ticket.priority][ticket.session]
+                return
+        self._release(ticket)
+
+    def _release(self, ticket: Ticket):
+        with self._cond:
+            self._in_flight[ticket.priority] -= 1
+            if ticket.used is not None:
+                # Settle the estimate against the usage the API reported
+                self._tokens.level -= ticket.used - ticket.tokens
+            self._cond.notify_all()
+
+    # ------------------------------ Slots ------------------------------ #
+
+    def _ticket(self, tokens: int) -> Ticket:
+        return Ticket(_priority.get(), _session.get(), tokens)
+
+    @contextlib.contextmanager
+    def slot(self, tokens: int = REPLY_TOKENS) -> Iterator[Ticket]:
+        ticket = self._ticket(tokens)
+        granted = threading.Event()
+        ticket._grant = granted.set
+        self._enqueue(ticket)
+        try:
+            with tr.span("llm.queue", priority = PRIORITY_NAMES[ticket.priority]):
+                granted.wait()
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, tokens: int = REPLY_TOKENS) -> AsyncIterator[Ticket]:
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        ticket = self._ticket(tokens)
+        ticket._grant = lambda: loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+        self._enqueue(ticket)
+        try:
+            with tr.span("llm.queue", priority = PRIORITY_NAMES[ticket.priority]):
+                await granted
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    async def acquire(self):
+        # Stands in for async_generator.RateLimiter: rate limits are already applied to every call in slot()/aslot()
+        return None
+
+    # ------------------------------ openai hook ------------------------------ #
+
+    def install(self):
+        # Chat completions made through the openai client (langchain's included) take a slot first. Streamed replies
+        # give the slot back once the response starts, their tokens still count against the budget.
+        from openai.api_requestor import APIRequestor
+        if getattr(APIRequestor.request, "_memora_scheduler", None) is not None:
+            APIRequestor.request._memora_scheduler[0] = self
+            return
+        request, arequest = APIRequestor.request, APIRequestor.arequest
+        owner = [self]
+
+        def chat(url: str) -> bool:
+            return url.rstrip("/").endswith("/chat/completions")
+
+        def usage(result) -> int | None:
+            response, stream, _ = result
+            if stream:
+                return None
+            return (getattr(response, "data", None) or {}).get("usage", {}).get("total_tokens")
+
+        def scheduled_request(requestor, method, url, params = None, *args, **kwargs):
+            if not chat(url):
+                return request(requestor, method, url, params, *args, **kwargs)
+            with owner[0].slot(estimate_tokens(params)) as ticket:
+                result = request(requestor, method, url, params, *args, **kwargs)
+                ticket.used = usage(result)
+                return result
+
+        async def scheduled_arequest(requestor, method, url, params = None, *args, **kwargs):
+            if not chat(url):
+                return await arequest(requestor, method, url, params, *args, **kwargs)
+            async with owner[0].aslot(estimate_tokens(params)) as ticket:
+                result = await arequest(requestor, method, url, params, *args, **kwargs)
+                ticket.used = usage(result)
+                return result
+
+        scheduled_request._memora_scheduler = owner
+        APIRequestor.request = scheduled_request
+        APIRequestor.arequest = scheduled_arequest
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            classes = {}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._waits[priority])
+                classes[name] = {"limit": self.limit(priority), "in_flight": self._in_flight[priority],
+                                 "queued": sum(len(queue) for queue in self._queues[priority].values()),
+                                 "sessions_waiting": len(self._queues[priority]), "granted": self._granted[priority],
+                                 "wait_p50_s": round(statistics.median(waits), 3) if waits else 0.0,
+                                 "wait_p95_s": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else 0.0}
+            return {"concurrency": self.concurrency, "reserved_slots": self.reserved,
+                    "rpm": round(self._requests.rate * 60), "tpm": round(self._tokens.rate * 60), "classes": classes}
+
+@lru_cache(maxsize = 1)
+def default_scheduler() -> LLMScheduler:
+    scheduler = LLMScheduler()
+    scheduler.install()
+    return scheduler
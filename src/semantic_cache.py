@@ -0,0 +1,157 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+
+CACHE_MAX_ENTRIES = 2000
+CACHE_TTL = 24 * 3600
+SIMILARITY_THRESHOLD = 0.95
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize_question(question: str) -> str:
+    return " ".join(_PUNCTUATION.sub(" ", question.casefold()).split())
+
+@dataclass
+class _Entry:
+    result: Any
+    expires: float
+    embedding: np.ndarray | None = None
+
+@dataclass
+class _Namespace:
+    # Stacked unit-norm embeddings for the semantic tier, rebuilt lazily after writes
+    keys: List[str] = field(default_factory = list)
+    matrix: np.ndarray | None = None
+    dirty: bool = False
+
+class SemanticAnswerCache:
+    # Process-wide answer cache, namespaced by (corpus version, model).
+    # Lookups try the normalized question text first and then, given a query embedding,
+    # the most similar cached question above the similarity threshold.
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL, threshold: float = SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: "OrderedDict[Tuple[str, str, str], _Entry]" = OrderedDict()
+        self._namespaces: Dict[Tuple[str, str], _Namespace] = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pruned = 0
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype = np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _namespace(self, corpus: str, model: str) -> _Namespace:
+        return self._namespaces.setdefault((corpus, model), _Namespace())
+
+    def _drop(self, key: Tuple[str, str, str]):
+        self._entries.pop(key, None)
+        namespace = self._namespaces.get(key[:2])
+        if namespace is not None:
+            namespace.dirty = True
+
+    def _live(self, key: Tuple[str, str, str], now: float) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < now:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _semantic_lookup(self, corpus: str, model: str, embedding, now: float) -> _Entry | None:
+        namespace = self._namespaces.get((corpus, model))
+        if namespace is None:
+            return None
+        if namespace.dirty:
+            keys = [k[2] for k, e in self._entries.items() if k[:2] == (corpus, model) and e.embedding is not None]
+            namespace.keys = keys
+            namespace.matrix = np.stack([self._entries[(corpus, model, k)].embedding for k in keys]) if keys else None
+            namespace.dirty = False
+        if namespace.matrix is None:
+            return None
+        similarities = namespace.matrix @ self._unit(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self._live((corpus, model, namespace.keys[best]), now)
+
+    def lookup(self, corpus: str, model: str, question: str, embed: Callable[[], Any] | None = None) -> Tuple[Any | None, Any | None]:
+        # Returns (cached result or None, query embedding if one was computed) so callers can reuse it in put()
+        key = (corpus, model, normalize_question(question))
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is not None:
+                self.exact_hits += 1
+                return entry.result, None
+            if embed is None:
+                self.misses += 1
+                return None, None
+        embedding = embed()
+        with self._lock:
+            entry = self._semantic_lookup(corpus, model, embedding, time.time())
+            if entry is not None:
+                self.semantic_hits += 1
+                return entry.result, embedding
+            self.misses += 1
+            return None, embedding
+
+    def put(self, corpus: str, model: str, question: str, result: Any, embedding = None):
+        key = (corpus, model, normalize_question(question))
+        vector = self._unit(embedding) if embedding is not None else None
+        with self._lock:
+            self._entries[key] = _Entry(result, time.time() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            self._namespace(corpus, model).dirty = True
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def clear(self, corpus: str | None = None):
+        with self._lock:
+            if corpus is None:
+                self._entries.clear()
+                self._namespaces.clear()
+                return
+            for key in [k for k in self._entries if k[0] == corpus]:
+                self._drop(key)
+
+    def prune(self, live: Callable[[str], bool]) -> int:
+        # Drops every entry of corpus versions that are gone (e.g. their shards were evicted), rather than waiting for LRU
+        with self._lock:
+            corpora = {corpus for corpus, _ in self._namespaces}
+        dead = {corpus for corpus in corpora if not live(corpus)}
+        if not dead:
+            return 0
+        with self._lock:
+            keys = [key for key in self._entries if key[0] in dead]
+            for key in keys:
+                del self._entries[key]
+            for namespace in [n for n in self._namespaces if n[0] in dead]:
+                del self._namespaces[namespace]
+            self.pruned += len(keys)
+        return len(keys)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "pruned": self.pruned,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            }
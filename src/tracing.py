@@ -0,0 +1,238 @@
+import asyncio
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List
+
+# Spans around pipeline stages, grouped into one trace per user action (an upload, a question, a generation job).
+# Spans outside a trace cost one ContextVar lookup. Profiling is opt-in per trace: "cprofile" profiles the thread
+# that opened the trace, "sample" samples every thread in the process (worker threads included, other sessions too).
+RECENT_TRACES = 20
+SAMPLE_INTERVAL = 0.005
+PROFILE_LINES = 30
+PROFILE = os.getenv("MEMORA_PROFILE") or None
+PROFILERS = ("cprofile", "sample")
+# Samples whose innermost frame is in these files are idle threads (event loops, pool workers) and are dropped
+IDLE_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+@dataclass
+class Span:
+    id: int
+    name: str
+    start: float
+    end: float | None = None
+    parent: int | None = None
+    thread: int = 0
+    lane: int = 0
+    attrs: Dict[str, Any] = field(default_factory = dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+@dataclass
+class Trace:
+    name: str
+    id: str = field(default_factory = lambda: uuid.uuid4().hex[:12])
+    start: float = field(default_factory = time.perf_counter)
+    end: float | None = None
+    created: float = field(default_factory = time.time)
+    spans: List[Span] = field(default_factory = list)
+    profile: str | None = None
+    samples: Dict[str, int] = field(default_factory = dict)
+    _lock: threading.Lock = field(default_factory = threading.Lock, repr = False)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def _open(self, name: str, parent: int | None, attrs: Dict[str, Any]) -> Span:
+        with self._lock:
+            span = Span(len(self.spans), name, time.perf_counter(), parent = parent, thread = threading.get_ident(), lane = _lane(), attrs = attrs)
+            self.spans.append(span)
+        return span
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        # Per stage: calls, total time and self time (total minus child spans), slowest first.
+        # Concurrent spans (async generation, worker threads) can add up to more than the trace's wall time.
+        children: Dict[int, float] = {}
+        for span in self.spans:
+            if span.parent is not None:
+                children[span.parent] = children.get(span.parent, 0.0) + span.duration
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            stage = stages.setdefault(span.name, {"stage": span.name, "calls": 0, "total_s": 0.0, "self_s": 0.0})
+            stage["calls"] += 1
+            stage["total_s"] += span.duration
+            stage["self_s"] += max(0.0, span.duration - children.get(span.id, 0.0))
+        wall = self.duration or 1e-9
+        rows = sorted(stages.values(), key = lambda s: s["total_s"], reverse = True)
+        for row in rows:
+            row["share"] = round(row["total_s"] / wall, 3)
+            row["total_s"] = round(row["total_s"], 4)
+            row["self_s"] = round(row["self_s"], 4)
+        return rows
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"id": self.id, "name": self.name, "created": self.created, "duration_s": round(self.duration, 4),
+                "spans": [{"id": s.id, "name": s.name, "parent": s.parent, "start_s": round(s.start - self.start, 6),
+                           "duration_s": round(s.duration, 6), "thread": s.thread, "lane": s.lane, "attrs": s.attrs} for s in self.spans],
+                "breakdown": self.breakdown(), "profile": self.profile, "samples": self.samples}
+
+    def to_chrome(self) -> Dict[str, Any]:
+        return chrome_trace(self.to_json())
+
+    def export(self, path: str, chrome: bool = True):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome() if chrome else self.to_json(), f)
+
+def chrome_trace(trace: Dict[str, Any]) -> Dict[str, Any]:
+    # Chrome trace event format from a to_json() trace, open in chrome://tracing or ui.perfetto.dev.
+    # Concurrent tasks on one event loop get their own lane so their spans nest properly.
+    pid = os.getpid()
+    events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{trace['name']} {trace['id']}"}}]
+    for span in trace["spans"]:
+        events.append({"name": span["name"], "cat": "stage", "ph": "X", "pid": pid, "tid": span["lane"],
+                       "ts": round(span["start_s"] * 1e6, 1), "dur": round(span["duration_s"] * 1e6, 1),
+                       "args": {**{k: str(v) for k, v in span["attrs"].items()}, "thread": span["thread"]}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+_trace: ContextVar[Trace | None] = ContextVar("memora_trace", default = None)
+_parent: ContextVar[int | None] = ContextVar("memora_span", default = None)
+_recent: "deque[Trace]" = deque(maxlen = RECENT_TRACES)
+_recent_lock = threading.Lock()
+
+def _lane() -> int:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+def current() -> Trace | None:
+    return _trace.get()
+
+@contextlib.contextmanager
+def span(name: str, **attrs) -> Iterator[Span | None]:
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+    opened = trace._open(name, _parent.get(), attrs)
+    token = _parent.set(opened.id)
+    try:
+        yield opened
+    finally:
+        opened.end = time.perf_counter()
+        _parent.reset(token)
+
+def traced(name: str | None = None):
+    # Decorator form of span() for sync and async functions
+    def decorate(fn):
+        stage = name or fn.__qualname__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class _Sampler:
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = "memora-sampler", daemon = True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own or os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        lines = [f"{count:6d} {count / total:6.1%}  {frame}" for frame, count in leaves.most_common(PROFILE_LINES)]
+        return f"{total} busy samples every {self.interval * 1000:.0f} ms, busiest frames:\n" + "\n".join(lines)
+
+@contextlib.contextmanager
+def trace(name: str, profile: str | None = PROFILE) -> Iterator[Trace]:
+    # One trace per user action; kept in recent() once it finishes
+    if profile is not None and profile not in PROFILERS:
+        raise ValueError(f"Unknown profiler '{profile}', choose from {', '.join(PROFILERS)}")
+    current_trace = Trace(name)
+    trace_token = _trace.set(current_trace)
+    parent_token = _parent.set(None)
+    profiler = sampler = None
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == "sample":
+        sampler = _Sampler()
+        sampler.start()
+    try:
+        yield current_trace
+    finally:
+        current_trace.end = time.perf_counter()
+        if profiler is not None:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream = out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            current_trace.profile = out.getvalue()
+        if sampler is not None:
+            current_trace.profile = sampler.stop()
+            current_trace.samples = dict(sampler.stacks)
+        _parent.reset(parent_token)
+        _trace.reset(trace_token)
+        # Reruns that found everything cached trace nothing and aren't kept
+        if current_trace.spans or current_trace.profile:
+            with _recent_lock:
+                _recent.append(current_trace)
+
+def recent() -> List[Trace]:
+    with _recent_lock:
+        return list(_recent)
+
+def find(trace_id: str) -> Trace:
+    for finished in recent():
+        if finished.id == trace_id:
+            return finished
+    raise KeyError(f"No recent trace '{trace_id}'")
+
+def last(name: str | None = None) -> Trace | None:
+    for finished in reversed(recent()):
+        if name is None or finished.name == name:
+            return finished
+    return None
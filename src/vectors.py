@@ -0,0 +1,186 @@
+import os
+from typing import Dict, List, Sequence, Tuple
+import faiss
+import numpy as np
+from langchain.vectorstores import FAISS
+
+MMR_FETCH_FACTOR = 4
+MMR_LAMBDA = 0.6
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype = np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis = -1, keepdims = True), 1e-12)
+
+def reconstruct(index, ids: Sequence[int]) -> np.ndarray:
+    if len(ids) == 0:
+        return np.empty((0, index.d), dtype = np.float32)
+    ids = np.asarray(ids, dtype = np.int64)
+    if hasattr(index, "reconstruct_batch"):
+        return index.reconstruct_batch(ids)
+    return np.stack([index.reconstruct(int(i)) for i in ids])
+
+def mmr_select(candidates: np.ndarray, query: np.ndarray, k: int, lambda_mult: float = MMR_LAMBDA,
+               relevance: np.ndarray | None = None) -> List[int]:
+    # Greedy maximal marginal relevance over a small candidate set. Pairwise similarities
+    # are computed in one matrix product and each step only updates a running max.
+    n = len(candidates)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    vectors = normalize_rows(candidates)
+    if relevance is None:
+        relevance = vectors @ normalize_rows(query)
+    pairwise = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = pairwise[selected[0]].copy()
+    available = np.ones(n, dtype = bool)
+    available[selected[0]] = False
+    for _ in range(k - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise[best], out = redundancy)
+    return selected
+
+# ------------------------------ Compressed storage ------------------------------ #
+
+VECTOR_KINDS = ("flat", "fp16", "pq")
+# Compressed search over-fetches by this factor and re-scores the candidates against the exact vectors
+RESCORE_FACTOR = 4
+# PQ code size as a fraction of the float32 vector: d / 4 one-byte codes is 16x smaller
+PQ_COMPRESSION = 16
+PQ_NBITS = 8
+
+def _pq_m(d: int, compression: int = PQ_COMPRESSION) -> int:
+    m = max(1, 4 * d // compression)
+    while d % m:
+        m -= 1
+    return m
+
+def compressed_index(vectors: np.ndarray, kind: str) -> faiss.Index:
+    vectors = np.ascontiguousarray(vectors, dtype = np.float32)
+    n, d = vectors.shape
+    if kind == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif kind == "fp16":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    elif kind == "pq":
+        # k-means wants ~39 training points per centroid, so small corpora get fewer bits per code
+        nbits = min(PQ_NBITS, int(np.log2(max(n // 39, 1))))
+        if nbits < 4:
+            return compressed_index(vectors, "fp16")
+        index = faiss.IndexPQ(d, _pq_m(d), nbits, faiss.METRIC_L2)
+        index.train(vectors)
+    else:
+        raise ValueError(f"Invalid vector storage: choose one of {', '.join(VECTOR_KINDS)}")
+    index.add(vectors)
+    return index
+
+def index_bytes(index) -> int:
+    if isinstance(index, RescoredIndex):
+        index = index.index
+    return len(faiss.serialize_index(index))
+
+class RescoredIndex:
+    # Read-only stand-in for a faiss index: candidates come from the compressed index,
+    # distances and reconstructions from the exact vectors (usually a read-only memmap)
+    def __init__(self, index: faiss.Index, vectors: np.ndarray, rescore_factor: int = RESCORE_FACTOR):
+        self.index = index
+        self.vectors = vectors
+        self.rescore_factor = rescore_factor
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.index.d
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.asarray(queries, dtype = np.float32)
+        fetch = min(k * self.rescore_factor, self.ntotal)
+        _, candidates = self.index.search(queries, fetch)
+        distances = np.full((len(queries), k), np.inf, dtype = np.float32)
+        indices = np.full((len(queries), k), -1, dtype = np.int64)
+        for row, (query, ids) in enumerate(zip(queries, candidates)):
+            ids = ids[ids != -1]
+            if not len(ids):
+                continue
+            order = np.argsort(ids)
+            exact = ((np.asarray(self.vectors[ids[order]], dtype = np.float32) - query) ** 2).sum(axis = 1)
+            top = np.argsort(exact)[:k]
+            distances[row, :len(top)] = exact[top]
+            indices[row, :len(top)] = ids[order][top]
+        return distances, indices
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.asarray(self.vectors[i], dtype = np.float32)
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype = np.int64)
+        order = np.argsort(ids)
+        out = np.empty((len(ids), self.d), dtype = np.float32)
+        out[order] = self.vectors[ids[order]]
+        return out
+
+def _atomic_save(path: str, save):
+    tmp = path + ".tmp"
+    save(tmp)
+    os.replace(tmp, path)
+
+def compress_docstore(docstore: FAISS, kind: str, folder: str) -> FAISS:
+    # The exact vectors go to <folder>/vectors.npy and are memory-mapped, so only the compressed codes
+    # take up process memory and the page cache is shared between sessions and processes
+    if kind == "flat":
+        return docstore
+    if kind not in VECTOR_KINDS:
+        raise ValueError(f"Invalid vector storage: choose one of {', '.join(VECTOR_KINDS)}")
+    vectors_path = os.path.join(folder, "vectors.npy")
+    index_path = os.path.join(folder, f"index.{kind}.faiss")
+    ntotal = docstore.index.ntotal
+    # Files left over from an earlier build of the same folder are detected by their size and rebuilt
+    originals = np.load(vectors_path, mmap_mode = "r") if os.path.isfile(vectors_path) else None
+    if originals is None or originals.shape != (ntotal, docstore.index.d):
+        vectors = reconstruct(docstore.index, np.arange(ntotal))
+        def save(tmp):
+            with open(tmp, "wb") as f:
+                np.save(f, vectors)
+        _atomic_save(vectors_path, save)
+        originals = np.load(vectors_path, mmap_mode = "r")
+        if os.path.isfile(index_path):
+            os.remove(index_path)
+    index = faiss.read_index(index_path) if os.path.isfile(index_path) else None
+    if index is None or index.ntotal != ntotal:
+        index = compressed_index(originals, kind)
+        _atomic_save(index_path, lambda tmp: faiss.write_index(index, tmp))
+    return FAISS(docstore.embedding_function, RescoredIndex(index, originals), docstore.docstore, docstore.index_to_docstore_id)
+
+def storage_report(vectors: np.ndarray, kinds: Sequence[str] = VECTOR_KINDS, k: int = 10, n_queries: int = 200, seed: int = 0) -> List[Dict]:
+    # Recall@k of each storage option against exact search, using perturbed corpus vectors as queries
+    vectors = np.ascontiguousarray(vectors, dtype = np.float32)
+    n = len(vectors)
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(n, size = min(n_queries, n), replace = False)]
+    queries = queries + rng.normal(scale = float(vectors.std()) * 0.5, size = queries.shape).astype(np.float32)
+    _, truth = compressed_index(vectors, "flat").search(queries, k)
+    flat_bytes = vectors.nbytes
+    report = []
+    for kind in kinds:
+        index = compressed_index(vectors, kind)
+        _, raw = index.search(queries, k)
+        _, rescored = RescoredIndex(index, vectors).search(queries, k)
+        size = index_bytes(index)
+        report.append({
+            "storage": kind,
+            "index_type": type(index).__name__,
+            "vectors": n,
+            "index_mb": round(size / 2**20, 3),
+            "compression": round(flat_bytes / size, 2),
+            "recall": round(float(np.mean([len(set(a) & set(b)) / k for a, b in zip(raw, truth)])), 4),
+            "recall_rescored": round(float(np.mean([len(set(a) & set(b)) / k for a, b in zip(rescored, truth)])), 4),
+        })
+    return report
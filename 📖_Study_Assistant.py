@@ -1,11 +1,26 @@
 import streamlit as st
-from pypdf import PdfReader
-import docx2txt
-from langchain.vectorstores import FAISS
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import src.processing as pr
 import src.el_professor as ep
-from PIL import Image
-import io
+import src.lexical as lx
+import src.semantic_cache as sc
+import src.corpora as cp
+import src.knowledge_bases as kb
+import src.vectors as vc
+import src.lazy as lz
+import src.resources as rs
+import src.chunk_store as cs
+import src.ocr as ocr
+import src.http_pool as hp
+import src.debug_panel as dp
+import src.scheduler as sch
+from cachetools import TTLCache
+import os
+import threading
+
+# Vector storage per corpus, see `memora report` for the memory/recall trade-off
+HUBERMAN_VECTORS = "pq"
+UPLOAD_VECTORS = "fp16"
 
 def clear_cache():
     st.cache_data.clear()
@@ -13,63 +28,147 @@ def clear_cache():
         del st.session_state['upld_filename']
     if 'chunks' in st.session_state:
         del st.session_state['chunks']
+    clear_conversation()
+
+def clear_conversation():
+    if 'conversation' in st.session_state:
+        del st.session_state['conversation']
+    if 'last_turn' in st.session_state:
+        del st.session_state['last_turn']
+
+@st.cache_resource
+def answer_store():
+    # Shared by every session on this server, namespaced by corpus version and model
+    return sc.SemanticAnswerCache()
+
+@st.cache_resource
+def regen_store():
+    # Shared like the answer store and keyed by the answer itself, so an upload never makes an entry stale
+    return TTLCache(maxsize = sc.CACHE_MAX_ENTRIES, ttl = sc.CACHE_TTL), threading.Lock()
+
+@st.cache_resource
+def corpus_registry():
+    # Every searchable shard on this server: prebuilt corpora plus one shard per uploaded file
+    return cp.CorpusRegistry()
 
-def clear_answer_cache():
-    answer_cache.clear()
-
-@st.cache_data(ttl = 2*3600, max_entries = 5)
-def text_process(uploads):
-    text = ""
-    for doc in uploads:
-        if doc.name.endswith(".txt"):
-            stringio = io.StringIO(doc.getvalue().decode("utf-8"))
-            text += stringio.read()
-        if doc.name.endswith(".pdf"):
-            pdf_reader = PdfReader(doc)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text()
-        if doc.name.endswith(".docx"):
-            text += docx2txt.process(doc)
-    chunks = pr.text_splitter(text, docs = True)
-    return chunks
-
-@st.cache_data(ttl = 2*3600, max_entries = 5)
-def create_docstore(_chunks):
+def chunk_handle(uploads):
+    # Generation chunks are shared by every session (and page) that uploads the same files
+    # getbuffer() reads the upload in place; large uploads are chunked into a store on disk
+    files = [(doc.name, doc.getbuffer()) for doc in uploads]
+    key = rs.content_key("chunks", *(part for file in files for part in file))
+    return rs.default_manager().acquire(key, lambda: cs.load_chunks(files))
+
+@st.cache_resource
+def knowledge_bases():
+    # Named knowledge bases saved under ./VectorDBs, so saved files are not re-embedded after a restart; plain uploads stay in memory
     embedder = ep.embed_type_chooser(embed_type = "o", api_key=st.secrets["openai_api_key"])
-    docstore = FAISS.from_documents(_chunks, embedder)
-    return docstore
+    manager = kb.KnowledgeBaseManager(embedder, vectors = UPLOAD_VECTORS)
+    manager.prune()
+    return manager
+
+# Shard helpers return held handles, so nothing is evicted before the session's corpus holds it
+
+def register_shard(registry, key, docstore):
+    name = f"shard:{key}"
+    return registry.hold(name) or registry.register(name, docstore, lx.BM25Index.from_faiss(docstore))
+
+def upload_shard(registry, doc):
+    # Reruns find the file's shard already registered instead of reading it from disk again
+    key = knowledge_bases().store.key(kb.file_hash(doc.getvalue()))
+    handle = registry.hold(f"shard:{key}")
+    if handle is not None:
+        return handle
+    # Nothing is written to disk unless the user saves the file to a knowledge base
+    key, docstore = knowledge_bases().store.shard(doc.name, doc.getvalue(), persist = False)
+    return register_shard(registry, key, docstore)
+
+def register_knowledge_base(registry, name, owner):
+    manifest = knowledge_bases().manifest(name, owner)
+    if manifest is None:
+        return []
+    # Saved indices are only read from disk the first time a base is selected on this server
+    if not knowledge_bases().stale_sources(name, owner):
+        handles = [registry.hold(f"shard:{entry.shard}") for entry in manifest.sources.values()]
+        if all(handles):
+            knowledge_bases().touch(name, owner)
+            return handles
+        for handle in filter(None, handles):
+            handle.release()
+    return [register_shard(registry, key, docstore) for key, docstore in knowledge_bases().open(name, owner)]
 
-@st.cache_data(ttl = 2*3600, max_entries = 5)
+def save_knowledge_base(name, uploads, owner):
+    # Files this session already embedded are saved as they are
+    shards = {doc.name: corpus_registry().get([f"shard:{knowledge_bases().store.key(kb.file_hash(doc.getvalue()))}"]) for doc in uploads}
+    built = {filename: found[0].docstore for filename, found in shards.items() if found}
+    try:
+        manifest = knowledge_bases().save(name, {doc.name: doc.getvalue() for doc in uploads}, owner = owner, built = built)
+        st.session_state.kb_saved = f"Saved {len(manifest.sources)} file(s) to '{manifest.name}'."
+    except (ValueError, IndexError) as e:
+        st.session_state.kb_saved = f"Could not save the knowledge base: {e}"
+
+@st.cache_resource
 def load_huberman():
+    # One shared copy per server; PQ codes in memory, exact vectors memory-mapped from ./Huberman
     embedder = ep.embed_type_chooser(embed_type = "o", api_key=st.secrets["openai_api_key"])
+    from langchain.vectorstores import FAISS
     docstore = FAISS.load_local("./Huberman", embedder)
-    return docstore
+    return vc.compress_docstore(docstore, HUBERMAN_VECTORS, "./Huberman")
 
 def source_cache(resp):
-    sources = ep.get_sources(resp)
+    sources = ep.get_marked_sources(resp)
     return sources
 
-@st.cache_data(ttl = 2*3600, max_entries = 5, show_spinner=False)
-def answer_cache(question, _docstore):
-    if model_choice:
-        response = ep.answer_question(model = chat4, docstore = _docstore, question = question)
+def render_stream(stream, box):
+    for _ in stream:
+        box.markdown("Answer: " + stream.text.replace(":", r"\:"))
+    return stream.result
+
+def followup_question(question):
+    # Reruns re-submit the same question, so only condense and remember each turn once
+    if 'last_turn' in st.session_state and st.session_state.last_turn["question"] == question:
+        return st.session_state.last_turn["standalone"]
+    if 'conversation' not in st.session_state:
+        st.session_state.conversation = ep.new_conversation(chat3_5)
+    standalone = ep.condense_followup(chat3_5, st.session_state.conversation, question)
+    st.session_state.last_turn = {"question": question, "standalone": standalone, "saved": False}
+    return standalone
+
+def answer_cache(question, _docstore, _lexical, box):
+    corpus = st.session_state.docstore["corpus"]
+    answer_store().prune(corpus_registry().covers)
+    response, embedding = answer_store().lookup(corpus, model_mode, question, embed = lambda: _docstore.embedding_function(question))
+    if response is not None:
         return response
-    response = ep.answer_question(model = chat3_5, docstore = _docstore, question = question)
+    if model_mode == "auto":
+        stream = ep.answer_question_cascade_stream(fast_model = chat3_5, strong_model = chat4, docstore = _docstore, question = question, lexical = _lexical, embedding = embedding)
+    else:
+        stream = ep.answer_question_stream(model = chat4 if model_mode == "gpt4" else chat3_5, docstore = _docstore, question = question, lexical = _lexical, embedding = embedding)
+    response = render_stream(stream, box)
+    answer_store().put(corpus, model_mode, question, response, embedding = embedding)
     return response
 
-@st.cache_data(ttl = 2*3600, max_entries = 5, show_spinner=False)
-def regen(answer, detail):
-    if model_choice:
-        new_answer = ep.regen_answer(answer, detail, model=chat4)
+def regen(answer, detail, box, model_name):
+    # Detail is added by whichever model produced the answer
+    key = (model_name, answer, detail)
+    store, lock = regen_store()
+    with lock:
+        new_answer = store.get(key)
+    if new_answer is not None:
         return new_answer
-    new_answer = ep.regen_answer(answer, detail, model=chat3_5)
+    model = chat4 if model_name == chat4.model_name else chat3_5
+    new_answer = render_stream(ep.regen_answer_stream(answer, detail, model = model), box)
+    with lock:
+        store[key] = new_answer
     return new_answer
 
 # ------------------------------ Page Logic --------------------------------
 
-logo = Image.open("./static/logo_2.png")
+MODEL_LABELS = {"gpt3_5": "GPT-3.5 (fastest)", "auto": "Auto (GPT-3.5, switches to GPT-4 when unsure)", "gpt4": "GPT-4 (slower but better output)"}
+
+logo = lz.static_image("./static/logo_2.png")
 st.set_page_config(page_title = "Memora - Study Wise", page_icon = logo, layout="wide")
+# Questions from this session take turns with other sessions' calls in the LLM scheduler
+sch.bind(session = get_script_run_ctx().session_id)
     
 col1, col2= st.columns([0.5, 2])
 col1.image(logo, output_format="PNG", clamp=True, use_column_width=True)
@@ -80,7 +179,9 @@ with col2:
     st.title("Memora - Study Wise")
     st.subheader("Study Assistant")
     st.markdown("##### Upload your lecture notes/slides and ask your virtual professor any questions.")
-    st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "This tool is not affiliated with Memora")
+    # Scanned pages are OCR'd on the server when Tesseract is installed
+    if not ocr.available():
+        st.markdown("""Use this tool to allow handwritten study materials to be analysed: <a href = "https://tools.pdf24.org/en/ocr-pdf">PDF OCR</a>""", unsafe_allow_html = True, help = "This tool is not affiliated with Memora")
 
 uploaded_files = st.file_uploader("Upload Study Materials", type = ["pdf","txt","docx"], accept_multiple_files = True, on_change = clear_cache, key = "assistant_uploads")
 st.session_state.upld_filename = [doc.name for doc in uploaded_files]
@@ -92,29 +193,93 @@ else:
     filenames = "None"
 
 with st.sidebar:
-    model_choice = st.checkbox(":sparkle: Use GPT-4 (slower but better output)", key = "model_choice", on_change = clear_answer_cache, value = False, help = "Make sure you have access to GPT-4 API before using this option.")
+    model_mode = st.radio(":sparkle: Model", ["gpt3_5", "auto", "gpt4"], format_func = MODEL_LABELS.get, key = "model_mode", help = "'Auto' answers with GPT-3.5 and switches to GPT-4 only when the answer isn't well supported by your notes. Make sure you have access to GPT-4 API before using the GPT-4 or Auto options.")
     filenames_slt = st.empty()
+    cache_stats = answer_store().stats()
+    if cache_stats["exact_hits"] + cache_stats["semantic_hits"] + cache_stats["misses"]:
+        st.caption(f"Shared answer cache: {cache_stats['hit_rate']:.0%} hit rate ({cache_stats['semantic_hits']} similar-question hits, {cache_stats['entries']} answers stored)")
+    memory = rs.default_manager().stats()
+    if memory["entries"]:
+        st.caption(f"Shared memory: {memory['bytes']/2**20:.0f} MB cached of {memory['budget_bytes']/2**20:.0f} MB ({memory['handles']} in use by sessions), server RSS {memory['rss_bytes']/2**20:.0f} MB")
+    connections = hp.default_pool().stats()["sync"]
+    if connections["requests"]:
+        st.caption(f"OpenAI connections: {connections['connections_opened']} opened for {connections['requests']} requests ({connections['reuse_rate']:.0%} reused)")
+    queue = sch.default_scheduler().stats()["classes"]
+    if queue["batch"]["in_flight"] or queue["batch"]["queued"]:
+        st.caption(f"LLM queue: {queue['batch']['in_flight']} generation calls running, {queue['batch']['queued']} waiting; questions wait {queue['interactive']['wait_p95_s']:.2f} s (p95)")
     st.divider()
     st.caption("Special Features:")
+    conversational = st.checkbox(":speech_balloon: Conversation mode", value = False, key = "conversational", on_change = clear_conversation, help = "Follow-up questions can refer to earlier questions and answers, e.g. 'Can you explain that in simpler terms?'. Older turns are summarised so answers stay fast.")
+    if conversational:
+        st.button("Start a new conversation", on_click = clear_conversation, key = "reset_conversation")
+    kb_key = st.text_input(":key: Knowledge base key", type = "password", key = "kb_key", help = f"Your knowledge bases are only listed and opened with this key, so keep it somewhere safe. At least {kb.MIN_KEY_CHARS} characters. Uploads are only kept on the server once you save them to a knowledge base, and bases unused for {kb.KB_RETENTION_DAYS:.0f} days are deleted.")
+    kb_owner = None
+    if kb_key:
+        try:
+            kb_owner = kb.owner_id(kb_key)
+        except ValueError as e:
+            st.caption(str(e))
+    saved_bases = st.multiselect(":books: Knowledge bases", knowledge_bases().names(kb_owner) if kb_owner else [], key = "saved_bases", disabled = kb_owner is None, help = "Knowledge bases you have saved with this key. They load instantly and are searched together with any files you upload.")
+    if uploaded_files:
+        kb_name = st.text_input("Save uploads as a knowledge base", key = "kb_name", placeholder = "e.g. Quantum Mechanics", disabled = kb_owner is None)
+        st.button("Save", key = "kb_save", disabled = not kb_name or kb_owner is None, on_click = save_knowledge_base, args = (kb_name, uploaded_files, kb_owner))
+    if "kb_saved" in st.session_state:
+        st.caption(st.session_state.pop("kb_saved"))
     huberman = st.checkbox("Enable 'Chat with Dr. Huberman'", value = False, key = "huberman", help = "Enabling this will load the transcripts of 90 episodes of the Huberman Lab Podcast so you can 'ask Dr. Huberman questions'.")
     # vid = st.checkbox("LoFi music", value = False, key = "vid")
     # if vid:
     #     st.video("https://youtu.be/jfKfPfyJRdk")
 
-if uploaded_files or huberman:
+if uploaded_files or huberman or saved_bases:
+    registry = corpus_registry()
+    held = []
     if huberman:
-        st.write("Virtual Dr. Huberman enabled!")
-        docstore = load_huberman()
-    else:
-        chunks = text_process(uploaded_files)
-        if "chunks" not in st.session_state or st.session_state.chunks == [] or st.session_state.chunks is None:
-            st.session_state.chunks = chunks
-        try:
-            docstore = create_docstore(chunks)
-        except IndexError:
-            st.warning("One or more of your documents were unable to be processed. Please make sure any PDFs are searchable (**use the PDF OCR tool linked above) and try again.")
-            st.stop()
-    st.session_state.docstore = {"filenames" : filenames, "docstore" : docstore}
+        st.write("Virtual Dr. Huberman enabled!" + (" Your notes are searched too." if uploaded_files or saved_bases else ""))
+        # Named by the index's mtime, so answers cached for an older index are not served for a new one
+        huberman_name = f"huberman:{os.path.getmtime('./Huberman/index.faiss')}"
+        handle = registry.hold(huberman_name)
+        if handle is None:
+            huberman_docstore = load_huberman()
+            handle = registry.register(huberman_name, huberman_docstore, lx.BM25Index.from_faiss(huberman_docstore), pinned = True)
+        held.append(handle)
+    for base in saved_bases:
+        held += register_knowledge_base(registry, base, kb_owner)
+    processed = []
+    with dp.traced("upload"), ocr.collect() as ocr_pages:
+        for doc in uploaded_files:
+            try:
+                held.append(upload_shard(registry, doc))
+            except IndexError:
+                if ocr.available():
+                    st.warning(f"'{doc.name}' was unable to be processed, no text could be read from it even with OCR.")
+                else:
+                    st.warning(f"'{doc.name}' was unable to be processed. Please make sure any PDFs are searchable (**use the PDF OCR tool linked above) and try again.")
+                continue
+            processed.append(doc)
+        if processed and ("chunks" not in st.session_state or not st.session_state.chunks.value):
+            # Shared with the Flashcards page, which generates from parent-sized chunks
+            try:
+                rs.hold(st.session_state, "chunks", chunk_handle(processed))
+            except cs.IngestMemoryError as e:
+                st.warning(f"These files are too large to generate flashcards from on this server. {e}")
+    if ocr_pages:
+        with st.expander(ocr.summary(ocr_pages)):
+            st.table(ocr.rows(ocr_pages))
+    if not held:
+        st.stop()
+    if saved_bases:
+        filenames = ", ".join(saved_bases + ([filenames] if uploaded_files else []))
+    shard_names = list(dict.fromkeys(handle.value.name for handle in held))
+    docstore = cp.ShardedCorpus(registry, shard_names)
+    for handle in held:
+        handle.release()
+    if docstore.missing:
+        st.warning(f"{len(docstore.missing)} of your files were dropped from memory while loading, refresh the page to load them again.")
+    # Retrieval runs the lexical fast path and fuses BM25 ranks per shard, so there is no corpus-wide index to pass along
+    lexical = None
+    # The corpus version names its shards, which are content-addressed; answers are pruned once any shard is gone
+    corpus = "|".join(sorted(shard_names))
+    st.session_state.docstore = {"filenames" : filenames, "docstore" : docstore, "lexical" : lexical, "corpus" : corpus}
 
 try:
     if st.session_state.docstore["docstore"] is not None:
@@ -124,8 +289,15 @@ try:
         question = st.text_area("What would you like to know?", key = "question", max_chars = 1000, height = 100, placeholder = "You can ask me anything about the subject/module you have uploaded.\ne.g. 'Explain equation (*)' or 'What is the definition of (*)?' or even questions from past papers/problem sets.")
         answer_box = st.empty()
         if question:
-            with st.spinner("Thinking..."):
-                response = answer_cache(_docstore = docstore, question = question)
+            with st.spinner("Thinking..."), dp.traced("ask"):
+                lookup_question = followup_question(question) if conversational else question
+                response = answer_cache(_docstore = docstore, _lexical = st.session_state.docstore["lexical"], question = lookup_question, box = answer_box)
+            if conversational:
+                if lookup_question != question:
+                    st.caption(f"Answering: {lookup_question}")
+                if not st.session_state.last_turn["saved"]:
+                    ep.remember_turn(st.session_state.conversation, question, response["result"])
+                    st.session_state.last_turn["saved"] = True
             answer: str = response["result"]
             answer = answer.replace(":", r"\:")
             sources = source_cache(response)
@@ -138,17 +310,19 @@ try:
             regen_button_slt = st.empty()
             detail = regen_slider.slider("Level of Detail:", min_value = 1, max_value = 10, value = 1, step = 1, key = "detail_level")
             regen_button = regen_button_slt.button("Increase Answer Detail", key = "regen", type = "primary")
-            source_box.text_area(label = "sources", value = sources, height=500, label_visibility = "hidden", key = "sources")
+            source_box.markdown(sources, unsafe_allow_html = True)
             if regen_button:
-                with st.spinner("Thinking..."):
-                    new_answer = regen(answer, detail)
+                with st.spinner("Thinking..."), dp.traced("regen"):
+                    new_answer = regen(answer, detail, box = answer_box, model_name = response["model_name"])
                 with answer_box:
                     st.write("Answer:", new_answer)
                 if new_answer:
-                    source_box.text_area(label = "sources",value = sources, disabled = True, height = 500, label_visibility = "hidden", key = "sources_")
+                    source_box.markdown(sources, unsafe_allow_html = True)
 except:
     pass
 
+dp.render()
+
 st.divider()
 st.caption("*If something stops working, refresh the page twice and try again.")
 